@@ -1,15 +1,88 @@
 import tkinter as tk
-from tkinter import scrolledtext, messagebox, ttk
+from tkinter import scrolledtext, messagebox, ttk, filedialog
+import tkinter.font as tkfont
 import threading
+import asyncio
 import os
 import re
 import json
 import sys
+import time
+import sqlite3
+import queue
+import hashlib
+import heapq
+import zlib
+import struct
+import csv
+import random
+import tracemalloc
+import argparse
+import tempfile
+import shutil
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict, Counter, deque
 
 # --- Configuration ---
-HISTORY_FILE = 'ollama_chat_history.json'
+HISTORY_FILE = 'ollama_chat_history.json'  # Legacy whole-file history, migrated into the library on load
+JOURNAL_FILE = 'ollama_chat_history.jsonl'  # Legacy single-conversation journal, migrated likewise
+JOURNAL_FSYNC_BATCH = 8  # fsync after this many records...
+JOURNAL_FSYNC_INTERVAL = 2.0  # ...or after this many seconds, whichever comes first
+JOURNAL_COMPACT_THRESHOLD = 500  # records written since the last snapshot before compacting
+LIBRARY_DIR = 'ollama_chats'  # One journal per conversation plus a small metadata index
+LIBRARY_INDEX_FILE = 'index.json'
+SEARCH_DB_FILE = 'search.db'  # SQLite FTS5 full-text index over every saved message, kept in LIBRARY_DIR
+PERSIST_QUEUE_SIZE = 256  # History writes waiting for the writer thread before callers block
+PERSIST_FLUSH_TIMEOUT = 10.0  # Seconds closing the app waits for queued writes to reach disk
+ARCHIVE_EXTENSION = '.ocz'  # Compressed history archives (export/import in the history window, --archive)
+ARCHIVE_CODEC = 'zstd'  # Frame compression for archives; 'zlib' is used when the zstandard package is missing
+ARCHIVE_INLINE_CHARS = 256  # Shorter message pieces live in the archive index instead of their own frame
 DEFAULT_MODEL = 'llama3'
 FALLBACK_MODELS = ['llama3', 'mistral', 'dolphin-mixtral']
+STREAM_FRAME_RATE = 30  # Hz; how often streamed chunks are flushed into the chat view
+TRANSCRIPT_PAGE_SIZE = 20  # Messages materialized at a time when scrolling through a long chat
+TRANSCRIPT_MAX_RENDERED = 60  # Messages kept in the chat view before the far end is released
+RESIZE_DEBOUNCE_MS = 60  # Resize work runs once the window edge has stopped moving this long
+MARKDOWN_CACHE_SIZE = 2000  # Parsed messages (display lists) kept for redraws...
+MARKDOWN_CACHE_MAX_CHARS = 2000000  # ...holding at most this much message text
+HISTORY_MEMORY_CAP_BYTES = 16 * 1024 * 1024  # Message text of the open conversation kept in RAM; older turns are paged to disk
+HISTORY_RESIDENT_MESSAGES = 40  # Newest messages that always stay in RAM (the context window and the visible page)
+HIGHLIGHT_CACHE_SIZE = 512  # Tokenized code blocks kept, keyed by (language, content hash)
+HIGHLIGHT_MAX_CHARS = 100000  # Larger code blocks are shown without highlighting
+CODE_BLOCK_POOL_SIZE = 24  # Idle code-block widgets kept around for reuse
+CONTEXT_TOKEN_BUDGET = 4096  # Approximate tokens of history sent to the model per request
+CONTEXT_HEAD_MESSAGES = 2  # 'Keep first N + last M' strategy: N
+CONTEXT_TAIL_MESSAGES = 10  # 'Keep first N + last M' strategy: M
+CONTEXT_SUMMARY_SHARE = 0.25  # Fraction of the budget reserved for the rolling summary
+DEFAULT_CONTEXT_STRATEGY = 'sliding_window'
+OLLAMA_HOST = os.environ.get('OLLAMA_HOST')  # None lets the ollama library use its default
+OLLAMA_MAX_CONCURRENT_REQUESTS = 4  # Streaming requests allowed in flight at once
+MODEL_CACHE_FILE = 'ollama_models_cache.json'  # Last known model catalog, shown before the server answers
+HEALTH_CHECK_INTERVAL_MS = 15000  # How often the server is probed (and the model catalog refreshed)
+BACKGROUND_POLL_MS = 50  # How often Tk checks for results of background work
+RESPONSE_CACHE_ENABLED = True  # Replay identical requests from the response cache (toggle in the toolbar)
+RESPONSE_CACHE_DIR = 'ollama_response_cache'  # One file per cached reply plus an LRU index
+RESPONSE_CACHE_MAX_ENTRIES = 500
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Least recently used replies are evicted beyond this
+MODEL_KEEP_ALIVE_SECONDS = 600  # How long the server keeps a model loaded after each request or ping
+WARMUP_PING_INTERVAL_MS = 240000  # Keep-alive pings for the selected model, well inside the keep-alive window
+WARMUP_IDLE_TIMEOUT = 1800  # Seconds without user activity after which pings stop and the model may unload
+WARMUP_PREWARM_COUNT = 0  # Most-used models (by history) preloaded at startup; 0 disables
+GENERATION_MAX_CONCURRENT = 2  # Model jobs (prompts, background summaries, warm-ups) the app runs at once
+JOB_DEFAULT_SECONDS = 10.0  # Assumed job length for queue wait estimates until that kind of job has been measured
+TELEMETRY_MAX_TURNS = 1000  # Per-turn performance records kept for the metrics panel
+BATCH_WORKERS = 2  # Prompts streamed at once in --batch mode (the client's own limit still applies)
+PROXY_HOST = '127.0.0.1'  # --serve listens here; use 0.0.0.0 to share the proxy with other machines
+PROXY_PORT = 11500
+PROXY_MAX_CONCURRENT = 4  # Generations the proxy runs at once across all clients
+PROXY_PER_CLIENT_CONCURRENT = 2  # ...and per client, so one client cannot take every slot
+PROXY_MAX_QUEUED_PER_CLIENT = 16  # Further requests from a client are refused with HTTP 429
+PROXY_CLIENT_TIMEOUT = 300  # Seconds the GUI waits on the proxy (as a thin client) before giving up
+BENCHMARK_BASELINE_FILE = 'ollama_benchmark_baseline.json'  # Results `--benchmark` compares against
+BENCHMARK_TOLERANCE = 0.25  # A metric regresses when it is this much worse than its baseline...
+BENCHMARK_MIN_DELTA = 2.0  # ...and by at least this much in absolute terms (ms, KB), to ignore noise
 
 # --- Persona Templates (Unchanged) ---
 LLAMA3_SYSTEM_PROMPT = (
@@ -24,6 +97,12 @@ GENERAL_SYSTEM_PROMPT_TEMPLATE = (
     "Do not use slang, memes, or informal language."
 )
 
+SUMMARY_PROMPT_TEMPLATE = (
+    "Summarize the following conversation between a user and an AI assistant in a few short paragraphs. "
+    "Keep names, decisions, facts, code identifiers and open questions. Do not add commentary.\n\n"
+    "{previous}{transcript}"
+)
+
 # --- Color Schemes (Unchanged) ---
 COLOR_SCHEMES = {
     "light": {
@@ -36,6 +115,8 @@ COLOR_SCHEMES = {
         "btn_new_bg": "#4CAF50", "btn_new_fg": "#FFFFFF", "btn_clear_bg": "#E53935",
         "btn_clear_fg": "#FFFFFF", "btn_history_bg": "#2196F3", "btn_history_fg": "#FFFFFF",
         "btn_toggle_bg": "#607D8B", "btn_toggle_fg": "#FFFFFF", "btn_stop_bg": "#FFC107",
+        "syn_keyword": "#C678DD", "syn_string": "#98C379", "syn_comment": "#7F848E",
+        "syn_number": "#D19A66", "syn_function": "#61AFEF",
     },
     "dark": {
         "bg_main": "#282C34", "bg_control": "#33373E", "fg_text": "#E0E0E0",
@@ -47,6 +128,8 @@ COLOR_SCHEMES = {
         "btn_new_bg": "#5cb85c", "btn_new_fg": "#FFFFFF", "btn_clear_bg": "#dc3545",
         "btn_clear_fg": "#FFFFFF", "btn_history_bg": "#007bff", "btn_history_fg": "#FFFFFF",
         "btn_toggle_bg": "#607D8B", "btn_toggle_fg": "#FFFFFF", "btn_stop_bg": "#FF8C00",
+        "syn_keyword": "#569CD6", "syn_string": "#CE9178", "syn_comment": "#6A9955",
+        "syn_number": "#B5CEA8", "syn_function": "#DCDCAA",
     }
 }
 # --- End Color Schemes ---
@@ -58,10 +141,15 @@ class MockOllama:
         # Simulate a successful connection, listing models 
         return {'models': [{'name': 'llama3'}, {'name': 'dolphin-mixtral'}, {'name': 'mistral'}]}
     
-    def chat(self, model, messages, stream):
+    def chat(self, model, messages, stream, **kwargs):
+        """Simulates the chat response with persona separation (streamed or as one message)."""
+        if stream:
+            return self._stream_chat(model, messages)
+        content = ''.join(chunk['message']['content'] for chunk in self._stream_chat(model, messages))
+        return {'message': {'role': 'assistant', 'content': content}}
+
+    def _stream_chat(self, model, messages):
         """Simulates the streaming chat response with persona separation."""
-        import time
-        
         last_user_message = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), "No prompt found.")
         
         if model == 'llama3':
@@ -103,25 +191,3232 @@ class MockOllama:
                 "This ensures proper operator precedence."
             )
 
-        # Simulate streaming
-        for word in simulated_response.split(' '):
-            time.sleep(0.005) 
-            yield {'message': {'content': word + ' '}}
-        # Ensure final yield for the newline/completion
-        yield {'message': {'content': '\n'}}
+        # Simulate streaming
+        for word in simulated_response.split(' '):
+            time.sleep(0.005) 
+            yield {'message': {'content': word + ' '}}
+        # Ensure final yield for the newline/completion
+        yield {'message': {'content': '\n'}}
+
+try:
+    import ollama
+    # The server is probed in the background after the window is up (see HealthMonitor)
+except ImportError:
+    print("Warning: The 'ollama' library is not installed. Using MockOllama.")
+    ollama = MockOllama()
+# The real client library (None if not installed); `ollama` is switched between it and MockOllama at runtime
+_ollama_module = None if isinstance(ollama, MockOllama) else ollama
+# --- End Global Stub ---
+
+# --- Model Catalog & Server Health ---
+class ModelCatalog:
+    """On-disk cache of the server's model catalog, so the model list is available instantly at startup."""
+    def __init__(self, path=MODEL_CACHE_FILE):
+        self.path = path
+        self.models = {}
+        self.updated = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError, IOError):
+            return
+        for entry in data.get('models', []):
+            if isinstance(entry, str):  # Older cache files stored bare names
+                entry = {'name': entry}
+            self.models[entry['name']] = entry
+        self.updated = data.get('updated')
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'models': list(self.models.values()), 'updated': self.updated}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except IOError as e:
+            print(f"Warning: Could not save the model list cache. {e}")
+
+    def update(self, entries):
+        """Replaces the catalog with a fresh server listing. Returns True if anything changed."""
+        fresh = {entry['name']: entry for entry in entries}
+        changed = fresh != self.models
+        self.models = fresh
+        self.updated = time.time()
+        return changed
+
+    def names(self):
+        return list(self.models)
+
+    def describe(self, name):
+        """Short human-readable summary of one model, e.g. '4.7 GB, llama, Q4_0'."""
+        entry = self.models.get(name)
+        if not entry:
+            return ""
+        parts = []
+        if entry.get('size'):
+            parts.append(f"{entry['size'] / 1e9:.1f} GB")
+        parts.extend(entry[k] for k in ('family', 'parameter_size', 'quantization') if entry.get(k))
+        return ', '.join(parts)
+
+    @staticmethod
+    def parse(list_response):
+        """Turns an ollama.list() response (dicts or response objects) into catalog entries."""
+        entries = []
+        models = list_response['models'] if 'models' in list_response else []
+        for m in models:
+            name = m.get('name') or m.get('model')
+            # Filter out codellama explicitly (or any model not wanted)
+            if not name or name == 'codellama':
+                continue
+            details = m.get('details') or {}
+            modified = m.get('modified_at')
+            entries.append({
+                'name': name,
+                'size': m.get('size'),
+                'family': details.get('family'),
+                'parameter_size': details.get('parameter_size'),
+                'quantization': details.get('quantization_level'),
+                'modified': modified.isoformat() if hasattr(modified, 'isoformat') else modified,
+            })
+        return entries
+
+
+class HealthMonitor:
+    """
+    Probes the Ollama server by listing its models (which also refreshes the catalog) and
+    tracks reachability and latency. check() blocks and runs on a background thread.
+    """
+    def __init__(self, module):
+        self.module = module
+        self.reachable = None
+        self.latency_ms = None
+        self.last_error = None
+        self.failures = 0
+
+    def check(self):
+        """Returns fresh catalog entries, or None if the server could not be reached."""
+        if self.module is None:
+            self.reachable = False
+            return None
+        started = time.perf_counter()
+        try:
+            response = self.module.list()
+        except Exception as e:
+            self.reachable = False
+            self.last_error = e
+            self.failures += 1
+            return None
+        self.latency_ms = (time.perf_counter() - started) * 1000
+        self.reachable = True
+        self.last_error = None
+        self.failures = 0
+        return ModelCatalog.parse(response)
+
+    def state_label(self):
+        if self.module is None:
+            return "\u25cf Offline (ollama not installed, mock)"
+        if self.reachable is None:
+            return "\u25cf Checking server..."
+        if self.reachable:
+            return f"\u25cf Connected ({self.latency_ms:.0f} ms)"
+        return "\u25cf Server unreachable (mock)"
+# --- End Model Catalog & Server Health ---
+
+# --- Startup Profiling ---
+class StartupProfiler:
+    """
+    Times the startup phases. Blocking phases record their duration; background phases
+    record when they finished, relative to the start of the app.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = []
+        self.milestones = []
+        self._pending = set()
+
+    class _Phase:
+        def __init__(self, profiler, name):
+            self.profiler = profiler
+            self.name = name
+
+        def __enter__(self):
+            self.start = time.perf_counter()
+
+        def __exit__(self, *exc):
+            self.profiler.durations.append((self.name, (time.perf_counter() - self.start) * 1000))
+
+    def phase(self, name):
+        """Context manager timing a blocking phase."""
+        return self._Phase(self, name)
+
+    def expect(self, *names):
+        """Declares background milestones that must arrive before the report is complete."""
+        self._pending.update(names)
+
+    def mark(self, name):
+        """Records that a background milestone finished. Returns True once all expected ones have."""
+        self.milestones.append((name, (time.perf_counter() - self.started) * 1000))
+        self._pending.discard(name)
+        return not self._pending
+
+    def report(self):
+        blocking = ', '.join(f"{name} {ms:.0f} ms" for name, ms in self.durations)
+        background = ', '.join(f"{name} at {ms:.0f} ms" for name, ms in self.milestones)
+        return f"Startup: {blocking} | {background}"
+# --- End Startup Profiling ---
+
+# --- Streaming Render Pipeline ---
+class StreamBuffer:
+    """
+    Thread-safe hand-off between the model worker thread and the Tk render pump.
+    The worker pushes chunks as they arrive; the pump drains everything queued once per frame.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._closed = False
+        self.error = None
+
+        # Counters exposed to the status bar
+        self.tokens_received = 0
+        self.frames_rendered = 0
+        self.frames_dropped = 0
+        self.max_queue_depth = 0
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.last_token_at = None
+        self.context_info = {}  # What the context manager sent (tokens, message counts)
+        self.cache_key = None  # Response cache key of this request
+        self.from_cache = False  # True when the reply is replayed from the response cache
+        self.model_warm = False  # Whether the model was believed loaded when the request was sent
+        self.token_gaps_ms = []  # Inter-token latencies
+        self.render_ms = 0.0  # Tk time spent rendering this stream
+        self.render_max_ms = 0.0
+        self.pending_since = None  # When the oldest undrained chunk arrived (for render latency)
+        self.drain_lag_ms = None  # How long the oldest chunk returned by the last drain() had waited
+
+    def push(self, chunk):
+        """Called from the worker thread for every streamed chunk."""
+        now = time.monotonic()
+        with self._lock:
+            if not self._chunks:
+                self.pending_since = now
+            self._chunks.append(chunk)
+            self.tokens_received += 1
+            if self.first_token_at is None:
+                self.first_token_at = now
+            else:
+                self.token_gaps_ms.append((now - self.last_token_at) * 1000)
+            self.last_token_at = now
+            if len(self._chunks) > self.max_queue_depth:
+                self.max_queue_depth = len(self._chunks)
+
+    def close(self, error=None):
+        """Marks the stream as complete (or failed). No more chunks will be pushed."""
+        with self._lock:
+            self.error = error
+            self._closed = True
+
+    def drain(self):
+        """Returns all queued chunks as a single string and empties the buffer."""
+        with self._lock:
+            if not self._chunks:
+                return ''
+            text = ''.join(self._chunks)
+            self._chunks = []
+            self.drain_lag_ms = (time.monotonic() - self.pending_since) * 1000
+            self.pending_since = None
+            return text
+
+    def is_finished(self):
+        """True once the stream was closed and every chunk has been drained."""
+        with self._lock:
+            return self._closed and not self._chunks
+
+    @property
+    def queue_depth(self):
+        with self._lock:
+            return len(self._chunks)
+
+    def tokens_per_second(self):
+        if self.first_token_at is None or self.last_token_at is None:
+            return 0.0
+        elapsed = self.last_token_at - self.first_token_at
+        if elapsed <= 0:
+            return 0.0
+        return self.tokens_received / elapsed
+
+    def note_render(self, ms):
+        """Called by the Tk pump with the time one frame's render took."""
+        self.render_ms += ms
+        self.render_max_ms = max(self.render_max_ms, ms)
+
+    def stats(self):
+        """Snapshot of the pipeline counters."""
+        return {
+            'tokens': self.tokens_received,
+            'tokens_per_sec': self.tokens_per_second(),
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'frames_rendered': self.frames_rendered,
+            'frames_dropped': self.frames_dropped,
+            'context_tokens': self.context_info.get('tokens', 0),
+            'context_messages': self.context_info.get('sent', 0),
+        }
+# --- End Streaming Render Pipeline ---
+
+# --- Incremental Markdown Rendering ---
+def _partial_suffix_len(text, token):
+    """Length of the longest proper prefix of `token` that `text` ends with."""
+    for k in range(min(len(token) - 1, len(text)), 0, -1):
+        if text.endswith(token[:k]):
+            return k
+    return 0
+
+
+class StreamingMarkdownRenderer:
+    """
+    Incremental, single-pass markdown tokenizer. Consumes text chunk by chunk and emits display
+    operations to a sink as soon as they are unambiguous:
+
+        sink.insert_text(text, tags)   sink.open_code(language)
+        sink.append_code(text)         sink.close_code()
+
+    Handles fences, inline code, headings, list items, bold and italic. Fences are detected
+    as they arrive, so code blocks are built while streaming. Markers that may still be
+    completed by the next chunk ('`', '**', '## ', ...) are held back. Complete messages go
+    through the same tokenizer once and are then replayed from a MarkdownCache display list.
+    """
+    FENCE = '```'
+    CLOSING_FENCE = '\n```'
+    MAX_FENCE_HEADER = 64
+    _INLINE_RE = re.compile(r'\*\*|\*|`')
+    _LANGUAGE_RE = re.compile(r'^[A-Za-z0-9_+#.-]*\s*$')
+    _LINE_PREFIX_RE = re.compile(r'(#{1,6})[ \t]|([ \t]*)([-*+]|\d{1,3}[.)])[ \t]')
+    _PARTIAL_PREFIX_RE = re.compile(r'[ \t]*(?:#{1,6}|[-*+]|\d{1,3}[.)]?)?')
+
+    def __init__(self, sink, bubble_tag):
+        self.sink = sink
+        self.bubble_tag = bubble_tag
+        self._pending = ''
+        self._mode = 'text'  # 'text', 'fence_header' or 'code'
+        self._bold = False
+        self._italic = False
+        self._code_span = False
+        self._line_tag = None  # 'heading1'..'heading3' or 'list_item' for the current line
+        self._at_line_start = True
+        self._last_char = '\n'
+        self._code_len = 0
+        self._skip_fence_newline = False
+
+    def feed(self, chunk):
+        """Consumes the next streamed chunk."""
+        if chunk:
+            self._pending += chunk
+            self._process(final=False)
+
+    def close(self):
+        """Flushes anything held back and closes a still-open code block."""
+        self._process(final=True)
+        if self._mode == 'code':
+            self.sink.close_code()
+        self._mode = 'text'
+        self._bold = self._italic = self._code_span = False
+        self._line_tag = None
+        self._at_line_start = True
+
+    def _process(self, final):
+        while self._pending:
+            if self._mode == 'text':
+                if not self._process_text(final):
+                    return
+            elif self._mode == 'fence_header':
+                if not self._process_fence_header(final):
+                    return
+            elif not self._process_code(final):
+                return
+
+    def _process_text(self, final):
+        pending = self._pending
+        if self._skip_fence_newline:
+            self._skip_fence_newline = False
+            if pending.startswith('\n'):
+                self._pending = pending[1:]
+                return True
+
+        if self._at_line_start:
+            if not self._process_line_start(final):
+                return False
+            pending = self._pending
+
+        # One line at a time, so headings and list items are recognized at every line start
+        nl = pending.find('\n')
+        idx = pending.find(self.FENCE)
+        if idx != -1 and (nl == -1 or idx < nl):
+            self._emit_inline(pending[:idx], True)
+            self._pending = pending[idx + len(self.FENCE):]
+            self._mode = 'fence_header'
+            return True
+        if nl != -1:
+            self._emit_inline(pending[:nl + 1], True)
+            self._pending = pending[nl + 1:]
+            return True
+
+        cut = len(pending) if final else len(pending) - _partial_suffix_len(pending, self.FENCE)
+        consumed = self._emit_inline(pending[:cut], final)
+        self._pending = pending[consumed:]
+        return False
+
+    def _process_line_start(self, final):
+        """Consumes a heading ('## ') or list marker ('- ', '1. ') at the start of a line."""
+        pending = self._pending
+        if not final and self._PARTIAL_PREFIX_RE.fullmatch(pending):
+            return False  # Could still turn into a marker
+        self._at_line_start = False
+        match = self._LINE_PREFIX_RE.match(pending)
+        if match is None:
+            return True
+        self._pending = pending[match.end():]
+        if match.group(1):
+            self._line_tag = f'heading{min(3, len(match.group(1)))}'
+        else:
+            self._line_tag = 'list_item'
+            marker = match.group(3)
+            bullet = '\u2022' if marker in ('-', '*', '+') else marker
+            self._emit_segment(f"{match.group(2)}{bullet} ")
+        return True
+
+    def _process_fence_header(self, final):
+        pending = self._pending
+        nl = pending.find('\n')
+        if nl == -1 and not final and len(pending) < self.MAX_FENCE_HEADER:
+            return False  # Wait for the end of the language line
+
+        header = pending if nl == -1 else pending[:nl]
+        if not self._LANGUAGE_RE.match(header):
+            # Not a fence after all (e.g. inline ```code```): show the backticks literally
+            self._emit_segment(self.FENCE)
+            self._mode = 'text'
+            return True
+
+        self._pending = '' if nl == -1 else pending[nl + 1:]
+        self.sink.open_code(header.strip() or "Code")
+        self._mode = 'code'
+        self._code_len = 0
+        return True
+
+    def _process_code(self, final):
+        pending = self._pending
+        if self._code_len == 0 and pending.startswith(self.FENCE):
+            # Empty code block
+            self._pending = pending[len(self.FENCE):]
+            self._end_code()
+            return True
+        if self._code_len == 0 and not final and self.FENCE.startswith(pending):
+            return False
+
+        idx = pending.find(self.CLOSING_FENCE)
+        if idx == -1:
+            cut = len(pending) if final else len(pending) - _partial_suffix_len(pending, self.CLOSING_FENCE)
+            if cut:
+                self.sink.append_code(pending[:cut])
+                self._code_len += cut
+            self._pending = pending[cut:]
+            return False
+
+        if idx:
+            self.sink.append_code(pending[:idx])
+        self._pending = pending[idx + len(self.CLOSING_FENCE):]
+        self._end_code()
+        return True
+
+    def _end_code(self):
+        self.sink.close_code()
+        self._mode = 'text'
+        self._skip_fence_newline = True
+        self._at_line_start = True
+        self._last_char = '\n'
+
+    def _emit_inline(self, text, final):
+        """
+        Emits text with inline code and bold/italic tags. Returns how many characters were
+        consumed; a trailing marker is held back until the following character is known.
+        """
+        pos = 0
+        for match in self._INLINE_RE.finditer(text):
+            start, end = match.span()
+            # Emit what precedes the marker first so newline resets apply before it is judged
+            self._emit_segment(text[pos:start])
+            pos = start
+            if end == len(text) and not final:
+                return start
+
+            marker = match.group()
+            if marker == '`':
+                self._code_span = not self._code_span
+                pos = end
+                continue
+            if self._code_span:
+                continue  # Emphasis markers are literal inside inline code
+
+            prev_char = text[start - 1] if start > 0 else self._last_char
+            next_char = text[end] if end < len(text) else ' '
+            is_open = self._bold if marker == '**' else self._italic
+
+            if is_open and not prev_char.isspace():
+                toggle = True
+            elif not is_open and not next_char.isspace():
+                toggle = True
+            else:
+                toggle = False
+
+            if not toggle:
+                continue
+
+            if marker == '**':
+                self._bold = not self._bold
+            else:
+                self._italic = not self._italic
+            pos = end
+
+        self._emit_segment(text[pos:])
+        return len(text)
+
+    def _emit_segment(self, segment):
+        """Inserts plain text with the current line and inline tags. None of them spans a newline."""
+        while segment:
+            nl = segment.find('\n')
+            part = segment if nl == -1 else segment[:nl + 1]
+            tags = (self.bubble_tag,)
+            if self._line_tag:
+                tags += (self._line_tag,)
+            if self._code_span:
+                tags += ('inline_code',)
+            else:
+                if self._bold:
+                    tags += ('bold',)
+                if self._italic:
+                    tags += ('italic',)
+            self.sink.insert_text(part, tags)
+            self._last_char = part[-1]
+            if nl == -1:
+                break
+            self._bold = self._italic = self._code_span = False
+            self._line_tag = None
+            self._at_line_start = True
+            segment = segment[nl + 1:]
+
+
+class DisplayListSink:
+    """Records renderer operations as a display list (merging adjacent runs) for later replay."""
+    def __init__(self):
+        self.ops = []
+
+    def insert_text(self, text, tags):
+        if self.ops and self.ops[-1][0] == 'text' and self.ops[-1][2] == tags:
+            self.ops[-1] = ('text', self.ops[-1][1] + text, tags)
+        else:
+            self.ops.append(('text', text, tags))
+
+    def open_code(self, language):
+        self.ops.append(('open_code', language))
+
+    def append_code(self, text):
+        if self.ops and self.ops[-1][0] == 'code':
+            self.ops[-1] = ('code', self.ops[-1][1] + text)
+        else:
+            self.ops.append(('code', text))
+
+    def close_code(self):
+        self.ops.append(('close_code',))
+
+
+def replay_display_list(ops, sink):
+    """Applies a recorded display list to a sink."""
+    for op in ops:
+        kind = op[0]
+        if kind == 'text':
+            sink.insert_text(op[1], op[2])
+        elif kind == 'code':
+            sink.append_code(op[1])
+        elif kind == 'open_code':
+            sink.open_code(op[1])
+        else:
+            sink.close_code()
+
+
+class MarkdownCache:
+    """
+    LRU cache of parsed messages: (bubble tag, content) -> display list. Keys are the content
+    strings themselves; Python caches a string's hash, so lookups do not rehash the message.
+    Bounded by entry count and by total characters, so it cannot pin a long history in RAM.
+    """
+    def __init__(self, max_entries=MARKDOWN_CACHE_SIZE, max_chars=MARKDOWN_CACHE_MAX_CHARS):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.chars = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, text, bubble_tag):
+        key = (bubble_tag, text)
+        ops = self._entries.get(key)
+        if ops is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return ops
+        self.misses += 1
+        sink = DisplayListSink()
+        renderer = StreamingMarkdownRenderer(sink, bubble_tag)
+        renderer.feed(text)
+        renderer.close()
+        self._entries[key] = sink.ops
+        self.chars += len(text)
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.chars > self.max_chars):
+            (_, evicted), _ = self._entries.popitem(last=False)
+            self.chars -= len(evicted)
+        return sink.ops
+
+
+class CodeBlockWidget:
+    """
+    The embedded frame for one fenced code block: language label, copy button and a
+    scrollable code view. Code can be appended while the block is still streaming.
+    """
+    MAX_VISIBLE_LINES = 10
+
+    def __init__(self, parent, language, colors, on_copy):
+        self.language = language
+        self._line_count = 1
+        self._width = None
+        self.highlight_key = None  # Key of the highlighting requested for the current content
+        self.slot = None
+
+        # Outer wrapper frame (for alignment and stretch)
+        self.wrapper = tk.Frame(parent, padx=10, pady=5)
+
+        # Inner frame containing header, code, and button
+        self.frame = tk.Frame(self.wrapper, bg=colors["code_bg"], relief=tk.RAISED, borderwidth=1)
+        self.frame.pack(fill=tk.X, expand=True)
+
+        # Header for Language and Copy Button
+        self.header_frame = tk.Frame(self.frame, bg=colors["code_bg"])
+        self.header_frame.pack(fill=tk.X, pady=(0, 2))
+
+        self.language_label = tk.Label(
+            self.header_frame,
+            text=language,
+            font='Arial 8 italic',
+            fg=colors["code_fg"],
+            bg=colors["code_bg"],
+            anchor='w'
+        )
+        self.language_label.pack(side=tk.LEFT, padx=5, pady=2)
+
+        self.copy_button = tk.Button(
+            self.header_frame,
+            text="Copy",
+            command=lambda: on_copy(self.get_code()),
+            bg=colors["code_btn_bg"], fg=colors["code_btn_fg"], activebackground=colors["code_btn_bg"],
+            padx=5, pady=0, font='Arial 8'
+        )
+        self.copy_button.pack(side=tk.RIGHT, padx=5, pady=2)
+
+        # ScrolledText widget for code content (handles horizontal scrolling)
+        self.code_display = scrolledtext.ScrolledText(
+            self.frame,
+            wrap=tk.NONE, # Important: disables word wrap
+            height=2,
+            font='Courier 9',
+            fg=colors["code_fg"],
+            bg=colors["code_bg"],
+            borderwidth=0,
+            relief='flat',
+            insertbackground=colors["code_fg"],
+            padx=5, pady=5
+        )
+        self.code_display.config(state='disabled')
+        self.code_display.pack(fill=tk.BOTH, expand=True)
+
+    def set_width(self, chars):
+        """Sizes the code area (in characters) so the block spans the transcript width."""
+        if chars and chars != self._width:
+            self._width = chars
+            self.code_display.config(width=chars)
+
+    def apply_colors(self, colors):
+        self.frame.config(bg=colors["code_bg"])
+        self.header_frame.config(bg=colors["code_bg"])
+        self.language_label.config(bg=colors["code_bg"], fg=colors["code_fg"])
+        self.copy_button.config(bg=colors["code_btn_bg"], fg=colors["code_btn_fg"], activebackground=colors["code_btn_bg"])
+        self.code_display.config(bg=colors["code_bg"], fg=colors["code_fg"], insertbackground=colors["code_fg"])
+        for tag in SyntaxHighlighter.TAGS:
+            self.code_display.tag_configure(tag, foreground=colors[tag])
+
+    def attach(self, text_widget, index):
+        """
+        Embeds the block at `index`. The text widget destroys embedded windows when their range
+        is deleted, so a throwaway slot frame is embedded and the block is packed into it;
+        the block itself survives and can be pooled.
+        """
+        slot = tk.Frame(text_widget)
+        text_widget.window_create(index, window=slot, stretch=tk.YES)
+        self.fill(slot)
+
+    def fill(self, slot):
+        """Shows the block inside an already embedded slot frame (e.g. a placeholder's)."""
+        self.slot = slot
+        self.wrapper.pack(in_=slot, fill=tk.X, expand=True)
+        self.wrapper.lift(slot)
+
+    def highlight(self, spans):
+        """Applies (tag, start, end) character spans from the SyntaxHighlighter, one tag call per tag."""
+        ranges = {tag: [] for tag in SyntaxHighlighter.TAGS}
+        for tag, start, end in spans:
+            ranges[tag].extend((f'1.0+{start}c', f'1.0+{end}c'))
+        for tag, indices in ranges.items():
+            self.code_display.tag_remove(tag, '1.0', tk.END)
+            for i in range(0, len(indices), 1000):
+                self.code_display.tag_add(tag, *indices[i:i + 1000])
+
+    def detach(self):
+        if self.slot is not None and self.slot.winfo_exists():
+            self.slot.destroy()
+        self.slot = None
+
+    def reset(self, language, colors):
+        """Empties the block so it can be reused for another fence."""
+        self.language = language
+        self._line_count = 1
+        self.highlight_key = None
+        self.language_label.config(text=language)
+        self.code_display.config(state='normal', height=2)
+        self.code_display.delete('1.0', tk.END)
+        self.code_display.config(state='disabled')
+        self.code_display.xview_moveto(0)
+        self.code_display.yview_moveto(0)
+        self.apply_colors(colors)
+
+    def append(self, text):
+        """Appends streamed code and grows the view up to MAX_VISIBLE_LINES."""
+        self.code_display.config(state='normal')
+        self.code_display.insert(tk.END, text)
+        self.code_display.config(state='disabled')
+        new_lines = text.count('\n')
+        if new_lines:
+            self._line_count += new_lines
+            self.code_display.config(height=min(self.MAX_VISIBLE_LINES, self._line_count + 1))
+
+    def finish(self):
+        """Trims trailing whitespace once the closing fence has arrived."""
+        code = self.get_code()
+        trailing = len(code) - len(code.rstrip())
+        if trailing:
+            self.code_display.config(state='normal')
+            self.code_display.delete(f'end-{trailing + 1}c', 'end-1c')
+            self.code_display.config(state='disabled')
+
+    def get_code(self):
+        return self.code_display.get('1.0', 'end-1c')
+
+
+class CodeBlockPlaceholder:
+    """
+    Stand-in for a code block rendered from history: a single empty frame sized like the
+    finished block. The pool swaps a real CodeBlockWidget into it once it scrolls into view.
+    """
+    def __init__(self, pool, language, colors):
+        self.pool = pool
+        self.language = language
+        self.colors = colors
+        self.block = None
+        self.slot = None
+        self._parts = []
+
+    def attach(self, text_widget, index):
+        self.slot = tk.Frame(text_widget, bg=self.colors["code_bg"], height=60, width=self.pool.block_width_px())
+        text_widget.window_create(index, window=self.slot, stretch=tk.YES)
+
+    def append(self, text):
+        self._parts.append(text)
+
+    def finish(self):
+        code = ''.join(self._parts)
+        lines = min(CodeBlockWidget.MAX_VISIBLE_LINES, code.count('\n') + 2)
+        self._parts = [code.rstrip()]
+        # Header, padding and `lines` rows of code, like the widget it stands in for
+        self.slot.config(height=30 + 20 + lines * self.pool.code_font.metrics('linespace'))
+
+    def get_code(self):
+        return self.block.get_code() if self.block is not None else ''.join(self._parts)
+
+
+class CodeBlockPool:
+    """
+    Recycles CodeBlockWidgets whose messages scrolled out of the materialized transcript.
+    Also the registry of blocks currently in use, so they can be restyled directly, and of
+    placeholders still waiting to be materialized. Finished blocks are highlighted off the UI thread.
+    """
+    CHROME_PX = 40  # Wrapper padding, border and scrollbar around a block's code area
+
+    def __init__(self, parent, on_copy, max_idle=CODE_BLOCK_POOL_SIZE, highlighter=None):
+        self.parent = parent
+        self.on_copy = on_copy
+        self.max_idle = max_idle
+        self.highlighter = highlighter
+        self._idle = []
+        self.active = set()
+        self.pending = set()
+        self.width_chars = None
+        self.code_font = tkfont.Font(font='Courier 9')
+        self._poll_job = None
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, language, colors):
+        if self._idle:
+            block = self._idle.pop()
+            block.reset(language, colors)
+            self.reused += 1
+        else:
+            self.created += 1
+            block = CodeBlockWidget(self.parent, language, colors, self.on_copy)
+        block.set_width(self.width_chars)
+        self.active.add(block)
+        return block
+
+    def fit_width(self, chars):
+        """Resizes the blocks in use; new and reused blocks are created at this width."""
+        self.width_chars = chars
+        for block in self.active:
+            block.set_width(chars)
+        for placeholder in self.pending:
+            placeholder.slot.config(width=self.block_width_px())
+
+    def defer(self, language, colors):
+        """Returns a placeholder that becomes a real block when materialize_visible() finds it on screen."""
+        placeholder = CodeBlockPlaceholder(self, language, colors)
+        self.pending.add(placeholder)
+        return placeholder
+
+    def materialize_visible(self, text_widget, colors):
+        """Swaps pooled widgets into the placeholders that are currently displayed."""
+        for placeholder in list(self.pending):
+            if not placeholder.slot.winfo_exists():
+                self.pending.discard(placeholder)
+                continue
+            if text_widget.dlineinfo(str(placeholder.slot)) is None:
+                continue
+            self.pending.discard(placeholder)
+            block = self.acquire(placeholder.language, colors)
+            block.append(placeholder.get_code())
+            placeholder.slot.config(width=0, height=0)
+            block.fill(placeholder.slot)
+            placeholder.block = block
+            self.highlight(block)
+
+    def block_width_px(self):
+        chars = self.width_chars or 80
+        return chars * (self.code_font.measure('0') or 7) + self.CHROME_PX
+
+    def restyle(self, colors):
+        """Recolors the blocks in use; idle ones pick up the colors when they are reused."""
+        for block in self.active:
+            block.apply_colors(colors)
+        for placeholder in self.pending:
+            placeholder.colors = colors
+            placeholder.slot.config(bg=colors["code_bg"])
+
+    def release(self, block):
+        if isinstance(block, CodeBlockPlaceholder):
+            self.pending.discard(block)
+            if block.block is not None:
+                self.release(block.block)
+            elif block.slot is not None and block.slot.winfo_exists():
+                block.slot.destroy()
+            return
+        self.active.discard(block)
+        block.detach()
+        if len(self._idle) < self.max_idle:
+            self._idle.append(block)
+        else:
+            block.wrapper.destroy()
+
+    # --- Highlighting ---
+    def highlight(self, block):
+        """Requests highlighting for a finished block; applied when the worker delivers it."""
+        if self.highlighter is None or isinstance(block, CodeBlockPlaceholder):
+            return
+        code = block.get_code()
+        key = SyntaxHighlighter.key(block.language, code)
+        block.highlight_key = key
+
+        def apply(spans):
+            if block.highlight_key == key:  # The block may have been reused meanwhile
+                block.highlight(spans)
+
+        spans = self.highlighter.submit(block.language, code, apply)
+        if spans is not None:
+            block.highlight(spans)
+        elif self._poll_job is None:
+            self._poll_job = self.parent.after(BACKGROUND_POLL_MS, self._poll_highlights)
+
+    def _poll_highlights(self):
+        self._poll_job = None
+        if self.highlighter.deliver():
+            self._poll_job = self.parent.after(BACKGROUND_POLL_MS, self._poll_highlights)
+
+
+class ChatRenderSink:
+    """
+    Applies StreamingMarkdownRenderer operations to a Tk Text widget at `index`
+    (the end of the widget, or a mark with right gravity when prepending older messages).
+    """
+    def __init__(self, app, widget, bubble_tag, index=tk.END, pool=None, lazy=False):
+        self.app = app
+        self.widget = widget
+        self.bubble_tag = bubble_tag
+        self.index = index
+        self.pool = pool
+        self.lazy = lazy  # Complete messages get placeholders; see CodeBlockPool.defer
+        self.code_block = None
+        self.blocks = []
+
+    def insert_text(self, text, tags):
+        self.widget.insert(self.index, text, tags)
+
+    def open_code(self, language):
+        position = 'end-1c' if self.index == tk.END else self.index
+        if self.widget.get(f'{position}-1c') != '\n':
+            self.widget.insert(self.index, '\n', self.bubble_tag)
+        colors = COLOR_SCHEMES[self.app.current_theme.get()]
+        if self.pool is not None and self.lazy:
+            self.code_block = self.pool.defer(language, colors)
+        elif self.pool is not None:
+            self.code_block = self.pool.acquire(language, colors)
+        else:
+            self.code_block = CodeBlockWidget(self.widget, language, colors, self.app.copy_to_clipboard)
+        self.blocks.append(self.code_block)
+        self.code_block.attach(self.widget, self.index)
+        self.widget.insert(self.index, '\n', self.bubble_tag) # Insert spacing after code block
+
+    def append_code(self, text):
+        self.code_block.append(text)
+
+    def close_code(self):
+        self.code_block.finish()
+        if self.pool is not None:
+            self.pool.highlight(self.code_block)
+        self.code_block = None
+# --- End Incremental Markdown Rendering ---
+
+# --- Syntax Highlighting ---
+try:
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    from pygments import token as pygments_token
+except ImportError:
+    get_lexer_by_name = None  # Falls back to the built-in regex tokenizer
+
+
+_C_FAMILY_KEYWORDS = (
+    'auto break case catch char class const continue default delete do double else enum explicit extern '
+    'false final float for fn func go goto if impl import int interface let long loop match mod mut namespace '
+    'new nullptr override package private protected public register return self short signed sizeof static '
+    'struct super switch template this throw trait true try type typedef typename union unsigned use using '
+    'var virtual void volatile where while bool string include define null boolean extends implements'
+)
+_LANGUAGE_RULES = {
+    # name: (comment pattern, keywords, case-insensitive keywords)
+    'python': (r'#[^\n]*', 'and as assert async await break class continue def del elif else except False '
+               'finally for from global if import in is lambda None nonlocal not or pass raise return self True '
+               'try while with yield', False),
+    'javascript': (r'//[^\n]*|/\*[\s\S]*?\*/', 'async await break case catch class const continue debugger '
+                   'default delete do else export extends false finally for from function if import in '
+                   'instanceof interface let new null of return super switch this throw true try type typeof '
+                   'undefined var void while with yield', False),
+    'c': (r'//[^\n]*|/\*[\s\S]*?\*/', _C_FAMILY_KEYWORDS, False),
+    'shell': (r'#[^\n]*', 'case do done echo elif else esac exit export fi for function if in local read '
+              'return set then until while', False),
+    'sql': (r'--[^\n]*|/\*[\s\S]*?\*/', 'add all alter and as asc between by case create delete desc distinct '
+            'drop else end exists from group having in index inner insert into is join key left like limit not '
+            'null on or order outer primary references right select set table then union update values when '
+            'where with', True),
+    'pascal': (r'//[^\n]*|\{[^}]*\}|\(\*[\s\S]*?\*\)', 'and array begin case const div do downto else end for '
+               'function if in mod not of or procedure program record repeat return then to type until var '
+               'while', True),
+}
+_LANGUAGE_ALIASES = {
+    'py': 'python', 'python3': 'python', 'js': 'javascript', 'jsx': 'javascript', 'ts': 'javascript',
+    'tsx': 'javascript', 'typescript': 'javascript', 'json': 'javascript', 'cpp': 'c', 'c++': 'c', 'h': 'c',
+    'hpp': 'c', 'cs': 'c', 'csharp': 'c', 'java': 'c', 'kotlin': 'c', 'swift': 'c', 'go': 'c', 'rust': 'c',
+    'rs': 'c', 'php': 'c', 'bash': 'shell', 'sh': 'shell', 'zsh': 'shell', 'console': 'shell',
+    'powershell': 'shell', 'ruby': 'python', 'rb': 'python', 'yaml': 'shell', 'toml': 'shell',
+    'pseudocode': 'pascal', 'delphi': 'pascal',
+}
+
+
+class SyntaxHighlighter:
+    """
+    Tokenizes code blocks on a worker thread: with pygments when it is installed, otherwise with a
+    small regex tokenizer. Results are lists of (tag, start, end) character spans, cached per
+    (language, content hash). Callbacks run on the Tk thread from deliver().
+    """
+    TAGS = ('syn_keyword', 'syn_string', 'syn_comment', 'syn_number', 'syn_function')
+    _STRING = r'"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|`(?:\\.|[^`\\])*`'
+    _NUMBER = r'\b0[xX][0-9a-fA-F]+\b|\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b'
+    _compiled = {}
+
+    def __init__(self, cache_size=HIGHLIGHT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._outstanding = 0
+        self._thread = threading.Thread(target=self._work, name='highlighter', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def key(language, code):
+        return (language.lower(), hashlib.sha1(code.encode('utf-8')).hexdigest())
+
+    def submit(self, language, code, callback):
+        """Returns the spans right away if cached; otherwise queues the job and returns None."""
+        if len(code) > HIGHLIGHT_MAX_CHARS:
+            return []
+        key = self.key(language, code)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self._outstanding += 1
+        self._jobs.put((key, language, code, callback))
+        return None
+
+    def deliver(self):
+        """Tk thread: runs the callbacks of finished jobs. Returns True while jobs are outstanding."""
+        while True:
+            try:
+                callback, spans = self._results.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._outstanding -= 1
+            callback(spans)
+        with self._lock:
+            return self._outstanding > 0
+
+    def _work(self):
+        while True:
+            key, language, code, callback = self._jobs.get()
+            try:
+                spans = self.tokenize(language, code)
+            except Exception as e:
+                print(f"Warning: Could not highlight {language} code. {e}")
+                spans = []
+            with self._lock:
+                self._cache[key] = spans
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            self._results.put((callback, spans))
+
+    @classmethod
+    def tokenize(cls, language, code):
+        language = language.lower()
+        if get_lexer_by_name is not None:
+            try:
+                return cls._tokenize_pygments(get_lexer_by_name(language), code)
+            except ClassNotFound:
+                pass
+        return cls._tokenize_regex(language, code)
+
+    @staticmethod
+    def _tokenize_pygments(lexer, code):
+        T = pygments_token
+        spans = []
+        for start, ttype, value in lexer.get_tokens_unprocessed(code):
+            if ttype in T.Comment:
+                tag = 'syn_comment'
+            elif ttype in T.String:
+                tag = 'syn_string'
+            elif ttype in T.Number:
+                tag = 'syn_number'
+            elif ttype in T.Keyword:
+                tag = 'syn_keyword'
+            elif ttype in T.Name.Function or ttype in T.Name.Class or ttype in T.Name.Builtin:
+                tag = 'syn_function'
+            else:
+                continue
+            spans.append((tag, start, start + len(value)))
+        return spans
+
+    @classmethod
+    def _tokenize_regex(cls, language, code):
+        name = _LANGUAGE_ALIASES.get(language, language)
+        if name not in cls._compiled:
+            comment, keywords, nocase = _LANGUAGE_RULES.get(name, (None, '', False))
+            pattern = (f'(?P<syn_comment>{comment})|' if comment else '') + (
+                f'(?P<syn_string>{cls._STRING})|(?P<syn_number>{cls._NUMBER})|'
+                r'(?P<syn_function>[A-Za-z_]\w*(?=\s*\())|(?P<word>[A-Za-z_]\w*)'
+            )
+            words = set(keywords.lower().split() if nocase else keywords.split())
+            cls._compiled[name] = (re.compile(pattern), words, nocase)
+        regex, keywords, nocase = cls._compiled[name]
+
+        spans = []
+        for match in regex.finditer(code):
+            tag = match.lastgroup
+            if tag in ('syn_function', 'word'):
+                word = match.group().lower() if nocase else match.group()
+                if word in keywords:
+                    tag = 'syn_keyword'
+                elif tag == 'word':
+                    continue
+            spans.append((tag, match.start(), match.end()))
+        return spans
+# --- End Syntax Highlighting ---
+
+# --- Conversation Journal ---
+class ConversationJournal:
+    """
+    Append-only JSONL store for one conversation. Every change is a single line:
+
+        {"op": "reset", "messages": [...]}   start over with these messages
+        {"op": "append", "message": {...}}   one new message
+        {"op": "meta", "model": ..., "theme": ...}
+
+    Lines are flushed immediately and fsynced in batches. Once enough records pile up,
+    a background thread rewrites the journal as a snapshot and swaps it in atomically.
+    A torn last line (crash mid-write) is truncated away on load.
+    """
+    def __init__(self, path=JOURNAL_FILE, legacy_path=HISTORY_FILE):
+        self.path = path
+        self.legacy_path = legacy_path
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._sync_timer = None
+        self._records = 0
+        self._compacting = False
+
+    # --- Loading & Recovery ---
+    def load(self):
+        """
+        Replays the journal and returns (messages, meta). Migrates the legacy JSON history
+        file the first time. Raises IOError if the journal cannot be read.
+        """
+        if not os.path.exists(self.path) and os.path.exists(self.legacy_path):
+            self._migrate_legacy()
+
+        messages, meta = [], {}
+        if os.path.exists(self.path):
+            messages, meta, self._records = self._replay(self.path, repair=True)
+
+        self._file = open(self.path, 'a', encoding='utf-8')
+        return messages, meta
+
+    def _migrate_legacy(self):
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("not a chat history object")
+        except (ValueError, IOError) as e:  # Includes JSON and UTF-8 decoding errors
+            # Set the file aside so it is not retried (and re-reported) on every launch
+            print(f"Warning: Could not migrate legacy chat history, keeping it as {self.legacy_path}.corrupt. {e}")
+            try:
+                os.replace(self.legacy_path, self.legacy_path + '.corrupt')
+            except OSError:
+                pass
+            return
+
+        meta = {k: data[k] for k in ('model', 'theme') if k in data}
+        self._write_snapshot(self.path, data.get('messages', []), meta)
+        os.replace(self.legacy_path, self.legacy_path + '.migrated')
+
+    @staticmethod
+    def _replay(path, repair=False, limit=None):
+        """Applies journal records in order. Returns (messages, meta, record_count)."""
+        messages, meta, count = [], {}, 0
+        with open(path, 'rb') as f:
+            while limit is None or f.tell() < limit:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    record = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    if repair and not line.endswith(b'\n'):
+                        # Torn write from a crash: drop the partial record
+                        print("Warning: Truncating incomplete record at the end of the chat journal.")
+                        f.close()
+                        with open(path, 'r+b') as rf:
+                            rf.truncate(offset)
+                        break
+                    print(f"Warning: Skipping corrupt record at byte {offset} of the chat journal.")
+                    continue
+
+                count += 1
+                op = record.get('op')
+                if op == 'append':
+                    messages.append(record['message'])
+                elif op == 'reset':
+                    messages = list(record.get('messages', []))
+                elif op == 'meta':
+                    meta.update({k: v for k, v in record.items() if k != 'op'})
+        return messages, meta, count
+
+    # --- Writing ---
+    def append_message(self, message):
+        self._write({'op': 'append', 'message': message})
+
+    def reset(self, messages):
+        self._write({'op': 'reset', 'messages': messages})
+
+    def set_meta(self, **meta):
+        self._write(dict(meta, op='meta'))
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+            self._records += 1
+            self._unsynced += 1
+            if self._unsynced >= JOURNAL_FSYNC_BATCH or time.monotonic() - self._last_sync >= JOURNAL_FSYNC_INTERVAL:
+                self._sync_locked()
+            elif self._sync_timer is None:
+                self._sync_timer = threading.Timer(JOURNAL_FSYNC_INTERVAL, self.sync)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+            should_compact = self._records >= JOURNAL_COMPACT_THRESHOLD and not self._compacting
+            if should_compact:
+                self._compacting = True
+                self._file.flush()
+                snapshot_end = self._file.tell()
+
+        if should_compact:
+            threading.Thread(target=self._compact, args=(snapshot_end,), daemon=True).start()
+
+    def sync(self):
+        """fsyncs any records written since the last sync."""
+        with self._lock:
+            self._sync_locked()
+
+    def _sync_locked(self):
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._sync_locked()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # --- Compaction ---
+    @staticmethod
+    def _write_snapshot(path, messages, meta, tail=b''):
+        """Writes a snapshot (plus any records appended meanwhile) to a temp file, then renames it over `path`."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write((json.dumps({'op': 'reset', 'messages': messages}, ensure_ascii=False) + '\n').encode('utf-8'))
+            if meta:
+                f.write((json.dumps(dict(meta, op='meta'), ensure_ascii=False) + '\n').encode('utf-8'))
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _compact(self, snapshot_end):
+        """Background thread: folds everything up to `snapshot_end` into one snapshot."""
+        try:
+            messages, meta, _ = self._replay(self.path, limit=snapshot_end)
+            with self._lock:
+                if self._file is None:
+                    return  # Closed meanwhile; the journal is compacted on a later run instead
+                # Carry over records appended while the snapshot was being built
+                self._file.flush()
+                with open(self.path, 'rb') as f:
+                    f.seek(snapshot_end)
+                    tail = f.read()
+                self._file.close()
+                self._file = None
+                self._write_snapshot(self.path, messages, meta, tail)
+                self._file = open(self.path, 'a', encoding='utf-8')
+                self._records = (2 if meta else 1) + tail.count(b'\n')
+                self._unsynced = 0
+        except (IOError, OSError) as e:
+            print(f"Warning: Could not compact chat journal. {e}")
+        finally:
+            self._compacting = False
+# --- End Conversation Journal ---
+
+# --- Full-Text Search ---
+class SearchIndex:
+    """
+    SQLite FTS5 inverted index over all saved messages. Rows are added from the same
+    code path that appends messages to a conversation, and the index catches up with
+    journals it has not seen (migration, crashes) in a background thread.
+    Search is disabled with a warning if this SQLite build lacks FTS5.
+    """
+    HIGHLIGHT_START = '\x02'
+    HIGHLIGHT_END = '\x03'
+    _WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, path):
+        self.path = path
+        self.available = False
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self):
+        try:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+                "content, session_id UNINDEXED, seq UNINDEXED, role UNINDEXED, model UNINDEXED, "
+                "tokenize='unicode61')"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS indexed_sessions (session_id TEXT PRIMARY KEY, turns INTEGER)"
+            )
+            self._conn.commit()
+            self.available = True
+        except sqlite3.Error as e:
+            print(f"Warning: Full-text search is unavailable. {e}")
+            self.available = False
+
+    def add(self, session_id, seq, role, model, content):
+        """Indexes one message. `seq` is its position in the conversation (the system prompt is 0)."""
+        if not self.available:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO messages (content, session_id, seq, role, model) VALUES (?, ?, ?, ?, ?)",
+                (content, session_id, seq, role, model)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO indexed_sessions (session_id, turns) VALUES (?, ?)", (session_id, seq)
+            )
+            self._conn.commit()
+
+    def remove_session(self, session_id):
+        if not self.available:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM indexed_sessions WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def catch_up(self, library_sessions, journal_path_for):
+        """Re-indexes sessions whose indexed turn count differs from the library index."""
+        if not self.available:
+            return
+        with self._lock:
+            indexed = dict(self._conn.execute("SELECT session_id, turns FROM indexed_sessions"))
+        for session_id in set(indexed) - set(library_sessions):
+            self.remove_session(session_id)
+        for session_id, entry in list(library_sessions.items()):
+            if indexed.get(session_id) == entry['turns']:
+                continue
+            # Held across the replay so a concurrent add() cannot slip between replay and rewrite
+            with self._lock:
+                try:
+                    messages, meta, _ = ConversationJournal._replay(journal_path_for(session_id))
+                except IOError:
+                    continue
+                model = meta.get('model', entry['model'])
+                rows = [
+                    (m['content'], session_id, seq, m['role'], model)
+                    for seq, m in enumerate(messages) if m['role'] != 'system'
+                ]
+                self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                self._conn.executemany(
+                    "INSERT INTO messages (content, session_id, seq, role, model) VALUES (?, ?, ?, ?, ?)", rows
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO indexed_sessions (session_id, turns) VALUES (?, ?)",
+                    (session_id, len(rows))
+                )
+                self._conn.commit()
+
+    def _match_expression(self, query):
+        """Turns free text into a safe FTS5 query: every word must match as a prefix."""
+        words = self._WORD_RE.findall(query)
+        if not words:
+            return None
+        return ' '.join('"' + w.replace('"', '""') + '"*' for w in words)
+
+    def search(self, query, model=None, role=None, limit=50):
+        """
+        Ranked (bm25) search. Returns dicts with session_id, seq, role, model and a snippet in which
+        matches are wrapped in HIGHLIGHT_START / HIGHLIGHT_END.
+        """
+        expression = self._match_expression(query)
+        if not self.available or expression is None:
+            return []
+        sql = (
+            "SELECT session_id, seq, role, model, "
+            "snippet(messages, 0, ?, ?, ' ... ', 16) FROM messages WHERE messages MATCH ?"
+        )
+        params = [self.HIGHLIGHT_START, self.HIGHLIGHT_END, expression]
+        if model:
+            sql += " AND model = ?"
+            params.append(model)
+        if role:
+            sql += " AND role = ?"
+            params.append(role)
+        sql += " ORDER BY bm25(messages) LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            try:
+                rows = self._conn.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                print(f"Warning: Search failed. {e}")
+                return []
+        return [
+            {'session_id': r[0], 'seq': r[1], 'role': r[2], 'model': r[3], 'snippet': r[4]}
+            for r in rows
+        ]
+
+    def models(self):
+        if not self.available:
+            return []
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT DISTINCT model FROM messages ORDER BY model")]
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
+            self.available = False
+# --- End Full-Text Search ---
+
+# --- Conversation Library ---
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text and code)."""
+    return max(1, len(text) // 4) if text else 0
+
+
+class ConversationLibrary:
+    """
+    Keeps many conversations, each in its own ConversationJournal under LIBRARY_DIR.
+    A small JSON index holds per-session metadata (title, model, turns, tokens, modified time)
+    so the session list never has to open the journals. Message bodies load only when a
+    session is opened.
+
+    With autosave_index off (a PersistenceWriter owns the library), changes only mark the
+    index dirty and the writer rewrites it once per burst of writes.
+    """
+    def __init__(self, directory=LIBRARY_DIR):
+        self.directory = directory
+        self.index_path = os.path.join(directory, LIBRARY_INDEX_FILE)
+        self.lock = threading.RLock()  # Guards adding/removing sessions against readers on other threads
+        self.autosave_index = True
+        self.index_dirty = False
+        self.sessions = {}
+        self.last_session = None
+        self.current_id = None
+        self.journal = None
+        self.search = SearchIndex(os.path.join(directory, SEARCH_DB_FILE))
+
+    # --- Index ---
+    def load(self):
+        """Reads the index, migrating the single-conversation history files the first time."""
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.sessions = data.get('sessions', {})
+            self.last_session = data.get('last_session')
+        except FileNotFoundError:
+            self._rebuild_index()
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Warning: Chat library index is unreadable, rebuilding it. {e}")
+            self._rebuild_index()
+
+        if os.path.exists(JOURNAL_FILE) or os.path.exists(HISTORY_FILE):
+            self._migrate_single_history()
+
+        self.search.open()
+        threading.Thread(
+            target=self.search.catch_up, args=(dict(self.sessions), self._journal_path), daemon=True
+        ).start()
+
+    def _rebuild_index(self):
+        """Recreates index entries by replaying every journal in the library directory."""
+        self.sessions = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.jsonl'):
+                session_id = name[:-len('.jsonl')]
+                messages, meta, _ = ConversationJournal._replay(self._journal_path(session_id))
+                entry = self._new_entry(session_id, meta.get('model', DEFAULT_MODEL))
+                entry['modified'] = os.path.getmtime(self._journal_path(session_id))
+                for message in messages:
+                    self._account(entry, message)
+                self.sessions[session_id] = entry
+        self.save_index()
+
+    def _migrate_single_history(self):
+        """Moves the pre-library history (journal or legacy JSON) into the library as one session."""
+        session_id = self._new_id()
+        path = self._journal_path(session_id)
+        if os.path.exists(JOURNAL_FILE):
+            os.replace(JOURNAL_FILE, path)
+        journal = ConversationJournal(path, legacy_path=HISTORY_FILE)
+        messages, meta = journal.load()
+        journal.close()
+        if not messages:
+            # Nothing was migrated (e.g. an unreadable legacy file); do not add an empty session
+            os.remove(path)
+            return
+
+        entry = self._new_entry(session_id, meta.get('model', DEFAULT_MODEL))
+        for message in messages:
+            self._account(entry, message)
+        self.sessions[session_id] = entry
+        self.last_session = session_id
+        self.save_index()
+
+    def _index_changed(self):
+        self.index_dirty = True
+        if self.autosave_index:
+            self.save_index()
+
+    def save_index(self):
+        """Atomically rewrites the (small) index file."""
+        with self.lock:
+            sessions = {session_id: dict(entry) for session_id, entry in self.sessions.items()}
+            self.index_dirty = False
+        data = {'version': 1, 'last_session': self.last_session, 'sessions': sessions}
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except IOError as e:
+            print(f"Warning: Could not save chat library index. {e}")
+
+    def list_sessions(self):
+        """Index entries, most recently modified first."""
+        with self.lock:
+            return sorted(self.sessions.values(), key=lambda e: e['modified'], reverse=True)
+
+    # --- Sessions ---
+    def _journal_path(self, session_id):
+        return os.path.join(self.directory, f'{session_id}.jsonl')
+
+    def _new_id(self):
+        base = time.strftime('%Y%m%d-%H%M%S')
+        session_id, n = base, 1
+        while session_id in self.sessions or os.path.exists(self._journal_path(session_id)):
+            n += 1
+            session_id = f'{base}-{n}'
+        return session_id
+
+    @staticmethod
+    def _new_entry(session_id, model):
+        now = time.time()
+        return {
+            'id': session_id, 'title': '', 'model': model,
+            'turns': 0, 'tokens': 0, 'created': now, 'modified': now,
+        }
+
+    @staticmethod
+    def _account(entry, message):
+        """Updates an index entry for one appended message."""
+        if message['role'] != 'system':
+            entry['turns'] += 1
+        entry['tokens'] += estimate_tokens(message['content'])
+        if not entry['title'] and message['role'] == 'user':
+            title = message['content'].replace('\n', ' ').strip()
+            entry['title'] = title[:77] + '...' if len(title) > 80 else title
+
+    def _switch_journal(self, session_id):
+        if self.journal is not None:
+            self.journal.close()
+        self.current_id = session_id
+        self.last_session = session_id
+        self.journal = ConversationJournal(self._journal_path(session_id), legacy_path='')
+
+    def create_session(self, model, messages):
+        """Starts a new conversation seeded with `messages` (normally just the system prompt)."""
+        session_id = self._new_id()
+        self._switch_journal(session_id)
+        self.journal.load()
+        entry = self._new_entry(session_id, model)
+        for message in messages:
+            self._account(entry, message)
+        with self.lock:
+            self.sessions[session_id] = entry
+        self.journal.reset(messages)
+        self.journal.set_meta(model=model)
+        self._index_changed()
+        return session_id
+
+    def import_session(self, messages, meta):
+        """Adds an imported conversation (e.g. from an archive) and makes it the open one."""
+        model = meta.get('model', DEFAULT_MODEL)
+        session_id = self.create_session(model, messages)
+        if 'theme' in meta:
+            self.journal.set_meta(theme=meta['theme'])
+        turn = 0
+        for message in messages:
+            if message['role'] != 'system':
+                turn += 1
+                self.search.add(session_id, turn, message['role'], model, message['content'])
+        return session_id
+
+    def read_session(self, session_id):
+        """Replays a conversation without opening it. Returns (messages, meta)."""
+        messages, meta, _ = ConversationJournal._replay(self._journal_path(session_id))
+        return messages, meta
+
+    def open_session(self, session_id):
+        """Loads the message bodies of one conversation. Returns (messages, meta)."""
+        self._switch_journal(session_id)
+        messages, meta = self.journal.load()
+        self._index_changed()
+        return messages, meta
+
+    def record_message(self, message):
+        """Appends a message to the open conversation and refreshes its index entry."""
+        self.journal.append_message(message)
+        entry = self.sessions[self.current_id]
+        self._account(entry, message)
+        entry['modified'] = time.time()
+        self._index_changed()
+        if message['role'] != 'system':
+            self.search.add(self.current_id, entry['turns'], message['role'], entry['model'], message['content'])
+
+    def reset_session(self, messages):
+        """Replaces the open conversation's messages (used to reuse an untouched session)."""
+        self.journal.reset(messages)
+        self.search.remove_session(self.current_id)
+        entry = self.sessions[self.current_id]
+        entry.update(title='', turns=0, tokens=0, modified=time.time())
+        for message in messages:
+            self._account(entry, message)
+        self._index_changed()
+
+    def set_meta(self, **meta):
+        self.journal.set_meta(**meta)
+        entry = self.sessions[self.current_id]
+        if 'model' in meta:
+            entry['model'] = meta['model']
+        self._index_changed()
+
+    def delete_session(self, session_id):
+        if session_id == self.current_id and self.journal is not None:
+            self.journal.close()
+            self.journal = None
+            self.current_id = None
+        with self.lock:
+            self.sessions.pop(session_id, None)
+        self.search.remove_session(session_id)
+        if self.last_session == session_id:
+            self.last_session = None
+        try:
+            os.remove(self._journal_path(session_id))
+        except FileNotFoundError:
+            pass
+        self._index_changed()
+
+    def clear(self):
+        """Deletes every conversation in the library."""
+        with self.lock:
+            session_ids = list(self.sessions)
+        for session_id in session_ids:
+            self.delete_session(session_id)
+
+    def sync(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.save_index()
+        self.search.close()
+# --- End Conversation Library ---
+
+# --- History Archives ---
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # Archives are written with zlib frames instead
+_ARCHIVE_ERRORS = (struct.error, ValueError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class ConversationArchive:
+    """
+    Compressed, read-only file for one saved conversation. Messages are split into content
+    blocks (fenced code blocks and the text between them); every distinct block is stored
+    once as its own compressed frame, so a code block repeated across replies costs one frame.
+
+        header   MAGIC, version, codec
+        frames   one zstd/zlib frame per unique block
+        index    compressed JSON: meta, frame offsets, and per message its role and block list
+        footer   index offset and length, MAGIC
+
+    Reading a message decompresses the (small) index once and then only that message's frames.
+    """
+    MAGIC = b'OCZ1'
+    VERSION = 1
+    CODECS = {'zlib': 0, 'zstd': 1}
+    _HEADER = struct.Struct('<4sBB')
+    _FOOTER = struct.Struct('<QI4s')
+    _BLOCK_PATTERN = re.compile(r'(```.*?```)', re.DOTALL)
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()  # Frames are read with seek + read on one shared handle
+        self._file = open(path, 'rb')
+        try:
+            magic, version, codec_id = self._HEADER.unpack(self._file.read(self._HEADER.size))
+            if magic != self.MAGIC or version != self.VERSION:
+                raise IOError(f"{path} is not a chat history archive.")
+            self.codec = {v: k for k, v in self.CODECS.items()}.get(codec_id)
+            if self.codec is None or (self.codec == 'zstd' and zstandard is None):
+                raise IOError(f"{path} needs the zstandard package to be read.")
+            if os.fstat(self._file.fileno()).st_size < self._HEADER.size + self._FOOTER.size:
+                raise IOError(f"{path} is truncated (no archive index).")
+            self._file.seek(-self._FOOTER.size, os.SEEK_END)
+            index_offset, index_length, magic = self._FOOTER.unpack(self._file.read(self._FOOTER.size))
+            if magic != self.MAGIC:
+                raise IOError(f"{path} is truncated (no archive index).")
+            index = json.loads(self._read_frame(index_offset, index_length))
+        except _ARCHIVE_ERRORS as e:
+            self._file.close()
+            raise IOError(f"{path} is not a readable chat history archive. {e}")
+        except IOError:
+            self._file.close()
+            raise
+        self.meta = index['meta']
+        self._frames = index['frames']
+        self._messages = index['messages']
+
+    # --- Writing ---
+    @classmethod
+    def split_blocks(cls, content):
+        """Splits message text into fenced code blocks and the text around them."""
+        return [part for part in cls._BLOCK_PATTERN.split(content) if part]
+
+    @classmethod
+    def write(cls, path, messages, meta=None, codec=ARCHIVE_CODEC):
+        """Atomically writes `messages` (role/content mappings) to `path`. Returns size statistics."""
+        if codec == 'zstd' and zstandard is None:
+            codec = 'zlib'
+        frames, frame_ids, entries = [], {}, []
+        stats = {'messages': 0, 'blocks': 0, 'unique_blocks': 0, 'raw_bytes': 0, 'archive_bytes': 0}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(cls._HEADER.pack(cls.MAGIC, cls.VERSION, cls.CODECS[codec]))
+            for message in messages:
+                content = message['content']
+                stats['messages'] += 1
+                stats['raw_bytes'] += len(content.encode('utf-8'))
+                blocks = []
+                for part in cls.split_blocks(content):
+                    if len(part) < ARCHIVE_INLINE_CHARS:
+                        blocks.append(part)
+                        continue
+                    stats['blocks'] += 1
+                    digest = content_digest(part)
+                    if digest not in frame_ids:
+                        data = cls._compress(codec, part.encode('utf-8'))
+                        frame_ids[digest] = len(frames)
+                        frames.append((f.tell(), len(data)))
+                        f.write(data)
+                    blocks.append(frame_ids[digest])
+                extra = {k: message[k] for k in message.keys() if k not in ('role', 'content')}
+                entries.append([message['role'], blocks, extra] if extra else [message['role'], blocks])
+            index = cls._compress(codec, json.dumps(
+                {'meta': meta or {}, 'frames': frames, 'messages': entries}, ensure_ascii=False
+            ).encode('utf-8'))
+            index_offset = f.tell()
+            f.write(index)
+            f.write(cls._FOOTER.pack(index_offset, len(index), cls.MAGIC))
+            stats['archive_bytes'] = f.tell()
+        os.replace(tmp_path, path)
+        stats['unique_blocks'] = len(frames)
+        return stats
+
+    @staticmethod
+    def _compress(codec, data):
+        if codec == 'zstd':
+            return zstandard.ZstdCompressor(level=9).compress(data)
+        return zlib.compress(data, 9)
+
+    # --- Reading ---
+    def _read_frame(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+        if self.codec == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def message(self, n):
+        """Decompresses one message. Only the frames it references are read."""
+        entry = self._messages[n]
+        parts = [
+            block if isinstance(block, str) else self._read_frame(*self._frames[block]).decode('utf-8')
+            for block in entry[1]
+        ]
+        message = {'role': entry[0], 'content': ''.join(parts)}
+        if len(entry) > 2:
+            message.update(entry[2])
+        return message
+
+    def messages(self):
+        """Every message in order; a block shared by several messages is decompressed once."""
+        decoded = {}
+        result = []
+        for entry in self._messages:
+            parts = []
+            for block in entry[1]:
+                if not isinstance(block, str):
+                    if block not in decoded:
+                        decoded[block] = self._read_frame(*self._frames[block]).decode('utf-8')
+                    block = decoded[block]
+                parts.append(block)
+            message = {'role': entry[0], 'content': ''.join(parts)}
+            if len(entry) > 2:
+                message.update(entry[2])
+            result.append(message)
+        return result
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_history_file(path):
+    """Reads an archive or a HISTORY_FILE-style JSON file. Returns (messages, meta); raises IOError."""
+    with open(path, 'rb') as f:
+        is_archive = f.read(len(ConversationArchive.MAGIC)) == ConversationArchive.MAGIC
+    if is_archive:
+        with ConversationArchive(path) as archive:
+            return archive.messages(), archive.meta
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        messages = data['messages']
+    except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError) as e:
+        raise IOError(f"{path} is not a chat history file. {e}")
+    return messages, {k: data[k] for k in ('model', 'theme') if k in data}
+
+
+def archive_history_json(json_path=HISTORY_FILE, archive_path=None):
+    """Converts a HISTORY_FILE-style JSON history into a compressed archive. Returns the archive stats."""
+    messages, meta = load_history_file(json_path)
+    archive_path = archive_path or os.path.splitext(json_path)[0] + ARCHIVE_EXTENSION
+    return ConversationArchive.write(archive_path, messages, meta)
+
+
+def restore_history_json(archive_path, json_path=HISTORY_FILE):
+    """Writes an archive back out in the HISTORY_FILE JSON layout. Returns the message count."""
+    messages, meta = load_history_file(archive_path)
+    data = dict(meta, messages=messages)
+    tmp_path = json_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, json_path)
+    return len(messages)
+
+
+def run_archive(args):
+    """--archive / --unarchive: converts between HISTORY_FILE JSON and archives, then exits."""
+    try:
+        if args.archive:
+            source, target = args.archive
+            stats = archive_history_json(source, target)
+            ratio = stats['archive_bytes'] / max(1, stats['raw_bytes'])
+            print(
+                f"Archived {stats['messages']} messages to {target}: {stats['raw_bytes'] / 1024:.1f} KB of text"
+                f" in {stats['archive_bytes'] / 1024:.1f} KB ({ratio:.0%}), {stats['blocks']} content blocks"
+                f" stored as {stats['unique_blocks']} frames."
+            )
+        else:
+            source, target = args.unarchive
+            print(f"Restored {restore_history_json(source, target)} messages to {target}.")
+    except IOError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+# --- End History Archives ---
+
+# --- Background Persistence ---
+class PersistJob:
+    __slots__ = ('work', 'key', 'on_done', 'submitted', 'started')
+
+    def __init__(self, work, key, on_done):
+        self.work = work
+        self.key = key
+        self.on_done = on_done
+        self.submitted = time.perf_counter()
+        self.started = False
+
+
+class PersistenceWriter:
+    """
+    Runs conversation-library writes (journal appends, index rewrites, search inserts) on one
+    dedicated thread so the Tk main loop never waits on the disk. Jobs run strictly in
+    submission order from a bounded queue; when it is full, submit() waits for room rather
+    than letting memory grow.
+
+    Coalescing: a job submitted with a key replaces the last queued job if that one has the
+    same key and has not started, and the library index (which every write marks dirty) is
+    rewritten atomically once the queue drains rather than after every message.
+    """
+    def __init__(self, library, max_queue=PERSIST_QUEUE_SIZE):
+        self.library = library
+        library.autosave_index = False
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._tail = None  # Last submitted job, while it is still waiting
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        # Metrics
+        self.latency_ms = deque(maxlen=TELEMETRY_MAX_TURNS)  # Submitted -> written
+        self.write_ms = deque(maxlen=TELEMETRY_MAX_TURNS)  # Time spent in the job itself
+        self.jobs = 0
+        self.coalesced = 0
+        self.index_writes = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def submit(self, work, key=None, on_done=None):
+        """
+        Queues work() for the writer thread. on_done(result, error), if given, is called on
+        the writer thread afterwards; without one, errors are printed as warnings.
+        """
+        with self._lock:
+            tail = self._tail
+            if key is not None and tail is not None and tail.key == key and not tail.started:
+                tail.work, tail.on_done = work, on_done
+                self.coalesced += 1
+                return
+            job = PersistJob(work, key, on_done)
+            self._tail = job
+        self._queue.put(job)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                # Queue drained: commit the index once for the whole burst
+                self._save_index()
+                job = self._queue.get()
+            if job is None:
+                self._save_index()
+                return
+            with self._lock:
+                job.started = True
+                if self._tail is job:
+                    self._tail = None
+            started = time.perf_counter()
+            result = error = None
+            try:
+                result = job.work()
+            except Exception as e:
+                error = e
+                self.errors += 1
+            finished = time.perf_counter()
+            self.jobs += 1
+            self.write_ms.append((finished - started) * 1000)
+            self.latency_ms.append((finished - job.submitted) * 1000)
+            if job.on_done is not None:
+                job.on_done(result, error)
+            elif error is not None:
+                print(f"Warning: Could not save chat history to file. {error}")
+
+    def _save_index(self):
+        if self.library.index_dirty:
+            self.library.save_index()
+            self.index_writes += 1
+
+    def flush(self, timeout=None):
+        """Blocks until everything submitted so far (and the index) is on disk. Returns False on timeout."""
+        done = threading.Event()
+
+        def commit():
+            self._save_index()
+            done.set()
+
+        self.submit(commit)
+        return done.wait(timeout)
+
+    def close(self, timeout=PERSIST_FLUSH_TIMEOUT):
+        """Flushes pending writes and stops the thread. Returns False if the disk did not keep up."""
+        if not self._thread.is_alive():
+            return True
+        if not self.flush(timeout):
+            print(f"Warning: {self.depth} chat history writes were still pending at exit.")
+            return False
+        self._queue.put(None)
+        self._thread.join(timeout)
+        return True
+
+    def stats(self):
+        latency, write = list(self.latency_ms), list(self.write_ms)
+        return {
+            'jobs': self.jobs, 'coalesced': self.coalesced, 'index_writes': self.index_writes,
+            'errors': self.errors, 'depth': self.depth, 'max_depth': self.max_depth,
+            'latency_p50_ms': percentile(latency, 50), 'latency_p99_ms': percentile(latency, 99),
+            'write_p50_ms': percentile(write, 50), 'write_p99_ms': percentile(write, 99),
+        }
+# --- End Background Persistence ---
+
+# --- Message Store ---
+def content_digest(text):
+    """SHA-256 of a message's whitespace-trimmed content."""
+    return hashlib.sha256(text.strip().encode('utf-8')).digest()
+
+
+class MessageRecord:
+    """
+    One chat message in a compact form. Reads like the message dicts used elsewhere
+    (m['role'], m.get('content'), dict(m)); the content may be paged out to the owning
+    store's page file and is read back on access. The token estimate and content digest are
+    kept, so context sizing and cache keys never need paged-out text.
+    """
+    __slots__ = ('role', '_content', '_store', 'offset', 'length', 'tokens', 'digest')
+    KEYS = ('role', 'content')
+
+    def __init__(self, role, content, store=None):
+        self.role = sys.intern(role)
+        self._content = content
+        self._store = store
+        self.offset = None  # Position in the page file once written there
+        self.length = 0
+        self.tokens = estimate_tokens(content)
+        self.digest = content_digest(content)
+
+    @property
+    def content(self):
+        # Read once: the Tk thread may page the record out between a check and a second read.
+        # The store sets offset/length before clearing _content, so the fallback always finds the text.
+        content = self._content
+        if content is None:
+            return self._store._read(self)
+        return content
+
+    @property
+    def resident(self):
+        return self._content is not None
+
+    def __getitem__(self, key):
+        if key == 'role':
+            return self.role
+        if key == 'content':
+            return self.content
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.KEYS
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def to_dict(self):
+        return {'role': self.role, 'content': self.content}
+
+
+class MessageStore:
+    """
+    The open conversation's messages as MessageRecords. Stands in for the list of message
+    dicts (len, iteration, indexing, slicing, append). Roles are interned and identical
+    contents share one string. Once the resident text passes memory_cap bytes, the oldest
+    messages (never the system prompt or the newest keep_recent) are paged out to a scratch
+    file and read back when the transcript scrolls to them or the context needs them.
+    """
+    def __init__(self, messages=(), memory_cap=HISTORY_MEMORY_CAP_BYTES, keep_recent=HISTORY_RESIDENT_MESSAGES):
+        self.memory_cap = memory_cap
+        self.keep_recent = keep_recent
+        self._records = []
+        self._shared = {}  # content -> [content, references]
+        self._page_file = None
+        self._lock = threading.Lock()  # Page-ins also happen on worker threads (context building)
+        self._next_candidate = 1  # Oldest message that may still be resident
+        self.resident_bytes = 0
+        self.paged_out = 0
+        self.page_ins = 0
+        for message in messages:
+            self.append(message)
+
+    def append(self, message):
+        if isinstance(message, MessageRecord) and message._store is self:
+            record = message
+        else:
+            record = MessageRecord(message['role'], self._share(message['content']), self)
+        self._records.append(record)
+        if self.resident_bytes > self.memory_cap:
+            self._page_out_oldest()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __getitem__(self, index):
+        return self._records[index]  # A slice gives a plain list of records
+
+    def to_dicts(self):
+        return [record.to_dict() for record in self._records]
+
+    def _share(self, content):
+        """Returns the stored copy of `content`; only the first copy counts against the cap."""
+        entry = self._shared.get(content)
+        if entry is None:
+            entry = self._shared[content] = [content, 0]
+            self.resident_bytes += sys.getsizeof(content)
+        entry[1] += 1
+        return entry[0]
+
+    def _unshare(self, content):
+        entry = self._shared.get(content)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._shared[content]
+                self.resident_bytes -= sys.getsizeof(content)
+
+    def _page_out_oldest(self):
+        limit = len(self._records) - self.keep_recent
+        index = self._next_candidate
+        while self.resident_bytes > self.memory_cap and index < limit:
+            record = self._records[index]
+            if record.resident:
+                self._page_out(record)
+            index += 1
+        self._next_candidate = index
+
+    def _page_out(self, record):
+        content = record._content
+        with self._lock:
+            if self._page_file is None:
+                self._page_file = tempfile.TemporaryFile(prefix='ollama_chat_pages_')
+            data = content.encode('utf-8')
+            self._page_file.seek(0, os.SEEK_END)
+            record.offset = self._page_file.tell()
+            record.length = len(data)
+            self._page_file.write(data)
+            record._content = None
+        self._unshare(content)
+        self.paged_out += 1
+
+    def _read(self, record):
+        with self._lock:
+            self._page_file.seek(record.offset)
+            data = self._page_file.read(record.length)
+            self.page_ins += 1
+        return data.decode('utf-8')
+
+    def stats(self):
+        return {
+            'messages': len(self._records), 'resident': sum(1 for r in self._records if r.resident),
+            'resident_bytes': self.resident_bytes, 'paged_out': self.paged_out, 'page_ins': self.page_ins,
+        }
+# --- End Message Store ---
+
+# --- Context Window Management ---
+class ContextWindowManager:
+    """
+    Decides which messages are sent to the model. Token counts are estimated once per
+    message content (the content string is the cache key, and Python caches string hashes).
+
+    Strategies:
+        full             every message (the original behavior)
+        sliding_window   system prompt + as many recent messages as fit in the budget
+        head_tail        system prompt + first N + last M messages
+        rolling_summary  sliding window, with evicted turns folded into a model-written summary
+    """
+    STRATEGIES = {
+        'full': "Full history",
+        'sliding_window': "Sliding window",
+        'head_tail': f"First {CONTEXT_HEAD_MESSAGES} + last {CONTEXT_TAIL_MESSAGES}",
+        'rolling_summary': "Rolling summary",
+    }
+    MESSAGE_OVERHEAD = 4  # role/formatting tokens per message
+
+    def __init__(self, strategy=DEFAULT_CONTEXT_STRATEGY, budget=CONTEXT_TOKEN_BUDGET):
+        self.strategy = strategy
+        self.budget = budget
+        self._token_cache = {}
+        self.reset()
+
+    def reset(self):
+        """Forgets the rolling summary (call when the conversation changes)."""
+        self._summary = ''
+        self._summarized_upto = 1
+
+    def count(self, message):
+        tokens = getattr(message, 'tokens', None)  # MessageRecords carry their estimate (content may be paged out)
+        if tokens is not None:
+            return tokens + self.MESSAGE_OVERHEAD
+        content = message['content']
+        tokens = self._token_cache.get(content)
+        if tokens is None:
+            tokens = estimate_tokens(content) + self.MESSAGE_OVERHEAD
+            self._token_cache[content] = tokens
+        return tokens
+
+    def total_tokens(self, messages):
+        return sum(self.count(m) for m in messages)
+
+    def build(self, messages, model, summarize=None):
+        """
+        Returns (messages_to_send, info). `summarize(model, previous_summary, evicted)` is only
+        called by the rolling_summary strategy and may block, so build() runs on the worker thread.
+        """
+        has_system = bool(messages) and messages[0]['role'] == 'system'
+        head = messages[:1] if has_system else []
+        body = messages[1:] if has_system else messages
+
+        if self.strategy == 'head_tail':
+            if len(body) > CONTEXT_HEAD_MESSAGES + CONTEXT_TAIL_MESSAGES:
+                body = body[:CONTEXT_HEAD_MESSAGES] + body[-CONTEXT_TAIL_MESSAGES:]
+            selected = head + body
+        elif self.strategy == 'sliding_window':
+            selected = head + self._fit_tail(body, self.budget - self.total_tokens(head))
+        elif self.strategy == 'rolling_summary':
+            selected = self._build_with_summary(messages, head, body, model, summarize)
+        else:
+            selected = head + body
+
+        info = {
+            'strategy': self.strategy,
+            'tokens': self.total_tokens(selected),
+            'sent': len(selected),
+            'total': len(messages),
+        }
+        return selected, info
+
+    def _fit_tail(self, body, budget):
+        """The longest suffix of `body` within `budget` (always at least the last message)."""
+        used, start = 0, len(body)
+        while start > 0:
+            tokens = self.count(body[start - 1])
+            if used + tokens > budget and start < len(body):
+                break
+            used += tokens
+            start -= 1
+        return body[start:]
+
+    def _build_with_summary(self, messages, head, body, model, summarize):
+        reserve = int(self.budget * CONTEXT_SUMMARY_SHARE)
+        tail = self._fit_tail(body, self.budget - self.total_tokens(head) - reserve)
+        cut = len(messages) - len(tail)  # messages[1:cut] are evicted
+
+        if summarize is not None and cut > self._summarized_upto:
+            evicted = messages[self._summarized_upto:cut]
+            try:
+                self._summary = summarize(model, self._summary, evicted)
+                self._summarized_upto = cut
+            except Exception as e:
+                print(f"Warning: Could not summarize evicted turns, sending a plain sliding window. {e}")
+
+        if not self._summary:
+            return head + tail
+        # Keep an overlong summary inside its share of the budget (~4 characters per token)
+        summary = self._summary[:reserve * 4]
+        summary_message = {
+            'role': 'system',
+            'content': f"Summary of the earlier conversation:\n{summary}",
+        }
+        return head + [summary_message] + tail
+
+
+def summarize_turns(model, previous_summary, evicted, chat=None):
+    """Asks the model for a rolling summary of evicted turns (blocking, non-streaming)."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in evicted)
+    previous = f"Summary so far:\n{previous_summary}\n\nNew turns:\n" if previous_summary else ""
+    chat = chat or ollama.chat
+    response = chat(
+        model=model,
+        messages=[{'role': 'user', 'content': SUMMARY_PROMPT_TEMPLATE.format(previous=previous, transcript=transcript)}],
+        stream=False
+    )
+    return response['message']['content'].strip()
+# --- End Context Window Management ---
+
+# --- Async Ollama Client ---
+def _chunk_content(chunk):
+    """Text of one streamed chat chunk (dicts from MockOllama, response objects from ollama)."""
+    try:
+        return chunk['message']['content'] or ''
+    except (KeyError, TypeError):
+        return ''
+
+
+class ChatRequest:
+    """
+    Handle for one in-flight request. cancel() aborts it immediately, closing the HTTP stream.
+    on_done is reported exactly once, even if the request is cancelled before it started.
+    """
+    def __init__(self, on_done):
+        self._on_done = on_done
+        self._lock = threading.Lock()
+        self._reported = False
+        self._future = None
+
+    def report(self, error):
+        with self._lock:
+            if self._reported:
+                return
+            self._reported = True
+        self._on_done(error)
+
+    def cancel(self):
+        self._future.cancel()
+
+    def done(self):
+        return self._future.done()
+
+
+class AsyncOllamaClient:
+    """
+    Runs all model I/O on one dedicated asyncio event-loop thread. Real servers are reached
+    through a single ollama.AsyncClient (one pooled HTTP connection set); backends without an
+    async client (MockOllama) are iterated chunk by chunk in the loop's executor.
+    Results reach Tk only through thread-safe callbacks (e.g. StreamBuffer.push / close).
+    """
+    def __init__(self, host=OLLAMA_HOST, max_concurrent=OLLAMA_MAX_CONCURRENT_REQUESTS):
+        self.host = host
+        self._loop = asyncio.new_event_loop()
+        self._async_client = None
+        self._semaphore = None
+        self._max_concurrent = max_concurrent
+        self._thread = threading.Thread(target=self._run_loop, name='ollama-client', daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self._max_concurrent)
+        self._loop.run_forever()
+
+    def _uses_async_backend(self):
+        return not isinstance(ollama, MockOllama) and hasattr(ollama, 'AsyncClient')
+
+    def _get_async_client(self):
+        if self._async_client is None:
+            self._async_client = ollama.AsyncClient(host=self.host)
+        return self._async_client
+
+    # --- Public API (callable from any thread) ---
+    def stream_chat(self, model, messages, on_chunk, on_done, prepare=None, **kwargs):
+        """
+        Starts a streaming chat. on_chunk(text) is called per chunk and on_done(error) once at
+        the end (error is None on success or cancellation). `prepare(messages)` runs in the
+        executor first and may block (e.g. context summarization). Returns a ChatRequest.
+        """
+        return self._submit(self._stream_chat(model, messages, on_chunk, prepare, kwargs), on_done)
+
+    def replay(self, text, on_chunk, on_done):
+        """Streams an already known reply (e.g. a cache hit) through the same callbacks as stream_chat."""
+        return self._submit(self._replay(re.findall(r'\s*\S+|\s+', text), on_chunk), on_done)
+
+    def chat(self, model, messages, timeout=None, **kwargs):
+        """Blocking, non-streaming chat for helper calls (summaries, warm-ups). Do not call from Tk."""
+        kwargs.pop('stream', None)
+        future = asyncio.run_coroutine_threadsafe(self._chat(model, messages, kwargs), self._loop)
+        return future.result(timeout)
+
+    def close(self, timeout=2.0):
+        """Cancels everything in flight, closes the HTTP pool and stops the loop thread."""
+        async def shutdown():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            http_client = getattr(self._async_client, '_client', None)
+            if http_client is not None and hasattr(http_client, 'aclose'):
+                await http_client.aclose()
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout)
+        except Exception as e:
+            print(f"Warning: Ollama client did not shut down cleanly. {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _submit(self, coro, on_done):
+        request = ChatRequest(on_done)
+        request._future = asyncio.run_coroutine_threadsafe(self._run(coro, request.report), self._loop)
+        # A request cancelled before its task started never runs _run; report it here instead
+        request._future.add_done_callback(lambda future: request.report(None))
+        return request
+
+    # --- Coroutines (event-loop thread) ---
+    @staticmethod
+    async def _run(coro, on_done):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            on_done(None)
+            raise
+        except Exception as e:
+            on_done(e)
+        else:
+            on_done(None)
+
+    async def _stream_chat(self, model, messages, on_chunk, prepare, kwargs):
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            if prepare is not None:
+                messages = await loop.run_in_executor(None, prepare, messages)
+
+            if self._uses_async_backend():
+                stream = await self._get_async_client().chat(model=model, messages=messages, stream=True, **kwargs)
+                async for chunk in stream:
+                    content = _chunk_content(chunk)
+                    if content:
+                        on_chunk(content)
+                return
+
+            # Synchronous backend: pull one chunk at a time so cancellation lands between chunks
+            backend = ollama
+            iterator = await loop.run_in_executor(
+                None, lambda: iter(backend.chat(model=model, messages=messages, stream=True, **kwargs))
+            )
+            done = object()
+            while True:
+                chunk = await loop.run_in_executor(None, next, iterator, done)
+                if chunk is done:
+                    break
+                content = _chunk_content(chunk)
+                if content:
+                    on_chunk(content)
+
+    @staticmethod
+    async def _replay(chunks, on_chunk):
+        for chunk in chunks:
+            on_chunk(chunk)
+            await asyncio.sleep(0)  # Lets cancellation land between chunks
+
+    async def _chat(self, model, messages, kwargs):
+        if self._uses_async_backend():
+            return await self._get_async_client().chat(model=model, messages=messages, stream=False, **kwargs)
+        backend = ollama
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: backend.chat(model=model, messages=messages, stream=False, **kwargs)
+        )
+# --- End Async Ollama Client ---
+
+# --- Response Cache ---
+class ResponseCache:
+    """
+    Disk-backed LRU cache of complete replies, keyed by a hash of everything that determines
+    the request. Bounded by entry count and total bytes; each reply is stored in its own file.
+    """
+    def __init__(self, directory=RESPONSE_CACHE_DIR, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+
+    @staticmethod
+    def make_key(model, system_prompt, messages, options=None):
+        """Stable hash of the request. Only role and (whitespace-trimmed) content of each message count."""
+        normalized = [[m['role'], (getattr(m, 'digest', None) or content_digest(m['content'])).hex()] for m in messages]
+        payload = json.dumps(
+            [model, system_prompt.strip(), normalized, options or {}],
+            ensure_ascii=False, sort_keys=True, separators=(',', ':')
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f).get('entries', [])
+        except (FileNotFoundError, json.JSONDecodeError, IOError):
+            entries = []
+        with self._lock:
+            for key, size in entries:
+                if os.path.exists(self._entry_path(key)):
+                    self._entries[key] = size
+                    self.total_bytes += size
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Returns the cached reply text, or None."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._dirty = True
+        try:
+            with open(self._entry_path(key), 'r', encoding='utf-8') as f:
+                content = json.load(f)['content']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, IOError):
+            self._discard(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def put(self, key, model, content):
+        data = json.dumps({'model': model, 'content': content, 'created': time.time()}, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        path = self._entry_path(key)
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+        except IOError as e:
+            print(f"Warning: Could not write to the response cache. {e}")
+            return
+        with self._lock:
+            self.total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            evicted = []
+            while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                old_key, old_size = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_key)
+            self._dirty = True
+        for old_key in evicted:
+            self._remove_file(old_key)
+        self.sync()
+
+    def _discard(self, key):
+        with self._lock:
+            self.total_bytes -= self._entries.pop(key, 0)
+            self._dirty = True
+        self._remove_file(key)
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries)
+            self._entries.clear()
+            self.total_bytes = 0
+            self._dirty = True
+        for key in keys:
+            self._remove_file(key)
+        self.sync()
+
+    def sync(self):
+        """Writes the LRU order to the index file if it changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = list(self._entries.items())
+            self._dirty = False
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'entries': entries}, f)
+            os.replace(tmp_path, self.index_path)
+        except IOError as e:
+            print(f"Warning: Could not save the response cache index. {e}")
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses}
+# --- End Response Cache ---
+
+# --- Model Warm-up ---
+class WarmupScheduler:
+    """
+    Tracks which models are loaded on the server and preloads them with empty chat requests,
+    so the first real request does not pay the model-load time. Also collects
+    time-to-first-token samples split by whether the model was warm when the request was sent.
+    warm() blocks; call it from a background thread.
+    """
+    def __init__(self, chat, keep_alive=MODEL_KEEP_ALIVE_SECONDS, samples=50):
+        self._chat = chat
+        self.keep_alive = keep_alive
+        self._lock = threading.Lock()
+        self._warm_until = {}  # model -> monotonic time its keep-alive expires
+        self._warming = {}  # model -> [Event set when its warm-up ends, error it raised]
+        self.load_ms = {}  # model -> duration of its last warm-up request
+        self.ttft_ms = {'warm': deque(maxlen=samples), 'cold': deque(maxlen=samples)}
+        self.last_activity = time.monotonic()
+
+    def warm(self, model, keep_alive=None, wait=False):
+        """
+        Loads the model (or refreshes its keep-alive). Returns the request time in ms, or None
+        if a warm-up of the model was already in progress. With `wait`, that warm-up is waited
+        for first and its error, if any, is raised here too.
+        """
+        keep_alive = self.keep_alive if keep_alive is None else keep_alive
+        with self._lock:
+            running = self._warming.get(model)
+            if running is None:
+                self._warming[model] = entry = [threading.Event(), None]
+        if running is not None:
+            if wait:
+                running[0].wait()
+                if running[1] is not None:
+                    raise running[1]
+            return None
+        try:
+            started = time.perf_counter()
+            # An empty message list loads the model without generating anything
+            self._chat(model, [], keep_alive=keep_alive)
+            elapsed = (time.perf_counter() - started) * 1000
+            self.load_ms[model] = elapsed
+            self.mark_used(model, keep_alive)
+            return elapsed
+        except Exception as e:
+            entry[1] = e
+            raise
+        finally:
+            with self._lock:
+                del self._warming[model]
+            entry[0].set()
+
+    def mark_used(self, model, keep_alive=None):
+        """Any request to the model restarts its keep-alive window on the server."""
+        if not isinstance(keep_alive, (int, float)):
+            keep_alive = self.keep_alive  # Durations like '5m' are passed through but not tracked
+        with self._lock:
+            self._warm_until[model] = time.monotonic() + keep_alive
+
+    def is_warm(self, model):
+        with self._lock:
+            return self._warm_until.get(model, 0) > time.monotonic()
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def is_active(self):
+        return time.monotonic() - self.last_activity < WARMUP_IDLE_TIMEOUT
+
+    def record_ttft(self, was_warm, ms):
+        self.ttft_ms['warm' if was_warm else 'cold'].append(ms)
+
+    def average_ttft(self, kind):
+        samples = self.ttft_ms[kind]
+        return sum(samples) / len(samples) if samples else None
+
+    @staticmethod
+    def most_used(entries, count, available=None):
+        """Models ranked by conversation turns across library index entries."""
+        usage = Counter()
+        for entry in entries:
+            if available is None or entry['model'] in available:
+                usage[entry['model']] += entry['turns']
+        return [model for model, _ in usage.most_common(count)]
+# --- End Model Warm-up ---
+
+# --- Compare Mode ---
+class ComparePane:
+    """One model's column in the compare window: its own stream buffer, renderer and stop control."""
+    def __init__(self, window, parent, model):
+        self.window = window
+        self.app = window.app
+        self.model = model
+        self.buffer = None
+        self.renderer = None
+        self.request = None
+        self.job = None  # Scheduler job holding (or waiting for) a generation slot
+        self.state = 'waiting'
+        self.finished_at = None
+        colors = COLOR_SCHEMES[self.app.current_theme.get()]
+
+        self.frame = tk.Frame(parent, bg=colors["bg_main"])
+        tk.Label(
+            self.frame, text=model, font='Arial 10 bold', bg=colors["bg_control"], fg=colors["fg_text"]
+        ).pack(side=tk.TOP, fill=tk.X)
+        footer = tk.Frame(self.frame, bg=colors["bg_control"])
+        footer.pack(side=tk.BOTTOM, fill=tk.X)
+        self.stop_button = tk.Button(
+            footer, text="Stop", command=self.stop, relief=tk.FLAT, padx=5,
+            bg=colors["btn_stop_bg"], fg="#000000", activebackground=colors["btn_stop_bg"]
+        )
+        self.stop_button.pack(side=tk.RIGHT)
+        self.stats_label = tk.Label(
+            footer, text="Waiting for a free slot...", anchor=tk.W, bg=colors["bg_control"], fg=colors["fg_text"]
+        )
+        self.stats_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.text = scrolledtext.ScrolledText(
+            self.frame, wrap=tk.WORD, state='disabled', width=40, padx=8, pady=8, borderwidth=0,
+            bg=colors["chat_bg"], fg=colors["fg_text"]
+        )
+        self.text.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+        self.app._configure_tags(self.text)
+
+    def start(self, messages):
+        self.state = 'streaming'
+        self.stats_label.config(text="Sending...")
+        self.renderer = StreamingMarkdownRenderer(ChatRenderSink(self.app, self.text, 'model_bubble'), 'model_bubble')
+        self.buffer = buffer = StreamBuffer()
+        self.request = self.app.client.stream_chat(
+            self.model, messages,
+            on_chunk=buffer.push,
+            on_done=lambda error: buffer.close(error=error),
+            keep_alive=self.app.warmup.keep_alive
+        )
+
+    def stop(self):
+        if self.state == 'waiting':
+            self.app.scheduler.cancel(self.job.id)
+            self.skip()
+        elif self.state == 'streaming':
+            self.state = 'stopping'
+            self.request.cancel()
+
+    def skip(self):
+        """Marks a pane whose job was cancelled before it got a slot."""
+        self.state = 'stopped'
+        self.stats_label.config(text="Skipped.")
+        self.stop_button.config(state='disabled')
+
+    def pump(self):
+        """Renders whatever arrived since the last frame. Returns True while the stream is open."""
+        content = self.buffer.drain()
+        if content:
+            self.text.config(state='normal')
+            self.renderer.feed(content)
+            self.text.config(state='disabled')
+            self.text.see(tk.END)
+        if not self.buffer.is_finished():
+            self.stats_label.config(text=self._stats_text())
+            return True
+
+        self.text.config(state='normal')
+        self.renderer.close()
+        if self.buffer.error is not None:
+            self.text.insert(tk.END, f"\nAPI Error: {self.buffer.error}", 'system')
+        self.text.config(state='disabled')
+        self.finished_at = time.monotonic()
+        stopped = self.state == 'stopping'
+        self.state = 'error' if self.buffer.error is not None else 'stopped' if stopped else 'done'
+        self.stop_button.config(state='disabled')
+        self.stats_label.config(text=self._stats_text())
+        if self.state == 'done':
+            self.app.warmup.mark_used(self.model)
+        return False
+
+    def results(self):
+        """Per-model latency figures for this run."""
+        buffer = self.buffer
+        if buffer is None:
+            return {'model': self.model, 'state': self.state}
+        ttft = (buffer.first_token_at - buffer.started_at) * 1000 if buffer.first_token_at else None
+        end = self.finished_at or time.monotonic()
+        return {
+            'model': self.model, 'state': self.state, 'first_token_ms': ttft,
+            'total_ms': (end - buffer.started_at) * 1000,
+            'tokens': buffer.tokens_received, 'tokens_per_sec': buffer.tokens_per_second(),
+        }
+
+    def _stats_text(self):
+        result = self.results()
+        parts = [] if self.state == 'streaming' else [self.state.capitalize()]
+        if result['first_token_ms'] is not None:
+            parts.append(f"first token {result['first_token_ms']:.0f} ms")
+        parts.append(f"{result['tokens']} tokens, {result['tokens_per_sec']:.1f} tok/s, {result['total_ms'] / 1000:.1f} s")
+        return ', '.join(parts)
+
+
+class CompareWindow:
+    """
+    Sends one prompt to several models and streams every answer into its own column.
+    Every column is a job on the app's JobScheduler, so compare runs share the
+    GENERATION_MAX_CONCURRENT slots with prompts and appear in the queue panel while
+    they wait. The main conversation and its context are not touched.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.panes = []
+        self._pump_job = None
+        colors = COLOR_SCHEMES[app.current_theme.get()]
+
+        self.window = tk.Toplevel(app.master)
+        self.window.title("Compare Models")
+        self.window.geometry("1100x650")
+        self.window.option_add('*Font', 'Arial 10')
+        self.window.config(bg=colors["bg_main"])
+        self.window.grid_rowconfigure(1, weight=1)
+        self.window.grid_columnconfigure(0, weight=1)
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        # Model selection
+        model_frame = tk.Frame(self.window, bg=colors["bg_control"], padx=10, pady=5)
+        model_frame.grid(row=0, column=0, sticky="ew")
+        tk.Label(model_frame, text="Models:", bg=colors["bg_control"], fg=colors["fg_text"]).pack(side=tk.LEFT)
+        self.selected = {}
+        for model in app.model_combo['values']:
+            var = tk.BooleanVar(self.window, value=model in FALLBACK_MODELS)
+            tk.Checkbutton(
+                model_frame, text=model, variable=var, bg=colors["bg_control"], fg=colors["fg_text"],
+                selectcolor=colors["entry_bg"], activebackground=colors["bg_control"]
+            ).pack(side=tk.LEFT, padx=(5, 0))
+            self.selected[model] = var
+
+        # One column per model, created on send
+        self.columns_frame = tk.Frame(self.window, bg=colors["bg_main"])
+        self.columns_frame.grid(row=1, column=0, sticky="nsew", padx=10, pady=(10, 0))
+
+        # Prompt
+        input_frame = tk.Frame(self.window, bg=colors["bg_main"], padx=10, pady=10)
+        input_frame.grid(row=2, column=0, sticky="ew")
+        self.prompt = scrolledtext.ScrolledText(
+            input_frame, height=3, wrap=tk.WORD, padx=5, pady=5, borderwidth=1, relief=tk.RIDGE,
+            bg=colors["entry_bg"], fg=colors["entry_fg"], insertbackground=colors["fg_text"]
+        )
+        self.prompt.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        self.send_button = tk.Button(
+            input_frame, text="Send to All", command=self.send, relief=tk.FLAT, padx=10,
+            bg=colors["btn_send_bg"], fg=colors["btn_send_fg"], activebackground=colors["btn_send_bg"]
+        )
+        self.send_button.pack(side=tk.LEFT, padx=(5, 0), anchor=tk.S)
+        self.status = tk.Label(self.window, text="Select models and enter a prompt.", anchor=tk.W,
+                               bg=colors["bg_control"], fg=colors["fg_text"], bd=1, relief=tk.SUNKEN)
+        self.status.grid(row=3, column=0, sticky="ew")
+        self.prompt.focus_set()
+
+    def send(self):
+        prompt = self.prompt.get('1.0', tk.END).strip()
+        models = [model for model, var in self.selected.items() if var.get()]
+        if not prompt or not models:
+            self.status.config(text="Enter a prompt and select at least one model.")
+            return
+
+        self._cancel_all()
+        for pane in self.panes:
+            pane.frame.destroy()
+        self.panes = []
+        self._prompt = prompt
+        for column, model in enumerate(models):
+            pane = ComparePane(self, self.columns_frame, model)
+            pane.frame.grid(row=0, column=column, sticky="nsew", padx=(0 if column == 0 else 5, 0))
+            self.columns_frame.grid_columnconfigure(column, weight=1, uniform='compare')
+            self.panes.append(pane)
+        self.columns_frame.grid_rowconfigure(0, weight=1)
+
+        self.send_button.config(state='disabled')
+        self.status.config(text=f"Comparing {len(models)} models, {GENERATION_MAX_CONCURRENT} generations at a time...")
+        for pane in self.panes:
+            # One conversation key per column: columns run in parallel, limited only by free slots
+            pane.job = self.app.scheduler.submit(
+                lambda job, pane=pane: self._start_pane(pane, job), priority=JobScheduler.INTERACTIVE,
+                conversation=f'compare-{id(pane)}', kind='compare', label=f"{pane.model}: {prompt}"
+            )
+        self._pump()
+
+    def _start_pane(self, pane, job):
+        """Scheduler callback: the pane's job got a generation slot."""
+        if pane.state != 'waiting' or not self.window.winfo_exists():
+            self.app.scheduler.finish(job, measure=False)
+            return
+        messages = [
+            {'role': 'system', 'content': self.app._get_system_prompt(pane.model)},
+            {'role': 'user', 'content': self._prompt},
+        ]
+        pane.start(messages)
+
+    def _pump(self):
+        """One render pass over every streaming column per frame."""
+        self._pump_job = None
+        for pane in self.panes:
+            if pane.state == 'waiting' and pane.job.state == 'cancelled':
+                pane.skip()  # Cancelled from the main window's queue panel
+            elif pane.state in ('streaming', 'stopping') and not pane.pump():
+                self.app.scheduler.finish(
+                    pane.job, tokens=pane.buffer.tokens_received, measure=pane.state == 'done'
+                )
+        if any(pane.state in ('waiting', 'streaming', 'stopping') for pane in self.panes):
+            self._pump_job = self.window.after(self.app.frame_interval_ms, self._pump)
+            return
+
+        self.send_button.config(state='normal')
+        summary = []
+        for result in (pane.results() for pane in self.panes):
+            if result.get('first_token_ms') is not None:
+                summary.append(f"{result['model']}: {result['first_token_ms']:.0f} ms to first token, "
+                               f"{result['tokens_per_sec']:.1f} tok/s")
+            else:
+                summary.append(f"{result['model']}: {result['state']}")
+        self.status.config(text=" | ".join(summary))
+
+    def _cancel_all(self):
+        """Cancels every column and gives back its slot; the columns are not pumped afterwards."""
+        for pane in self.panes:
+            if pane.state == 'waiting':
+                self.app.scheduler.cancel(pane.job.id)
+                pane.state = 'stopped'
+            elif pane.state in ('streaming', 'stopping'):
+                pane.request.cancel()
+                pane.state = 'stopped'
+                self.app.scheduler.finish(pane.job, measure=False)
+
+    def close(self):
+        self._cancel_all()
+        if self._pump_job is not None:
+            self.window.after_cancel(self._pump_job)
+        self.window.destroy()
+# --- End Compare Mode ---
+
+# --- Telemetry ---
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None if empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = -(-pct * len(ordered) // 100)  # ceil
+    return ordered[min(len(ordered), max(1, int(rank))) - 1]
+
+
+class TelemetryStore:
+    """Rolling store of per-turn latency and throughput records, with percentile summaries and export."""
+    FIELDS = (
+        'timestamp', 'model', 'outcome', 'cached', 'warm', 'first_token_ms', 'total_ms', 'tokens',
+        'tokens_per_sec', 'itl_p50_ms', 'itl_p90_ms', 'itl_p99_ms', 'itl_max_ms', 'render_ms',
+        'render_max_ms', 'frames', 'frames_dropped', 'save_ms', 'context_tokens',
+    )
+    SUMMARY_FIELDS = ('first_token_ms', 'tokens_per_sec', 'itl_p50_ms', 'itl_p99_ms', 'render_max_ms', 'save_ms')
+
+    def __init__(self, max_turns=TELEMETRY_MAX_TURNS):
+        self.turns = deque(maxlen=max_turns)
+
+    def add_turn(self, model, buffer, outcome='complete', save_ms=None):
+        """Builds a record from a finished StreamBuffer and stores it."""
+        ended = buffer.last_token_at or time.monotonic()
+        gaps = buffer.token_gaps_ms
+        record = {
+            'timestamp': time.time(),
+            'model': model,
+            'outcome': outcome,
+            'cached': buffer.from_cache,
+            'warm': buffer.model_warm,
+            'first_token_ms': (buffer.first_token_at - buffer.started_at) * 1000 if buffer.first_token_at else None,
+            'total_ms': (ended - buffer.started_at) * 1000,
+            'tokens': buffer.tokens_received,
+            'tokens_per_sec': buffer.tokens_per_second(),
+            'itl_p50_ms': percentile(gaps, 50),
+            'itl_p90_ms': percentile(gaps, 90),
+            'itl_p99_ms': percentile(gaps, 99),
+            'itl_max_ms': max(gaps) if gaps else None,
+            'render_ms': buffer.render_ms,
+            'render_max_ms': buffer.render_max_ms,
+            'frames': buffer.frames_rendered,
+            'frames_dropped': buffer.frames_dropped,
+            'save_ms': save_ms,
+            'context_tokens': buffer.context_info.get('tokens', 0),
+        }
+        self.turns.append(record)
+        return record
+
+    def summary(self):
+        """Per-model percentiles: {model: {'turns': n, field: (p50, p90, p99), ...}}."""
+        by_model = {}
+        for record in self.turns:
+            by_model.setdefault(record['model'], []).append(record)
+        summary = {}
+        for model, records in by_model.items():
+            row = {'turns': len(records)}
+            for field in self.SUMMARY_FIELDS:
+                values = [r[field] for r in records if r[field] is not None and not r['cached']]
+                row[field] = tuple(percentile(values, pct) for pct in (50, 90, 99))
+            summary[model] = row
+        return summary
+
+    def export_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'turns': list(self.turns), 'summary': self.summary()}, f, indent=2)
+
+    def export_csv(self, path):
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            writer.writeheader()
+            writer.writerows(self.turns)
+# --- End Telemetry ---
+
+# --- Chat Engine ---
+class ChatEngine:
+    """
+    The conversation logic shared by every front end, with no Tk dependency: personas,
+    context trimming, the response cache, model warm-up and the async client. Replies are
+    streamed into a StreamBuffer (from the client's event-loop thread); the GUI renders it,
+    batch mode writes it out.
+    """
+    def __init__(self, client=None, response_cache=None, context=None):
+        self.client = client or AsyncOllamaClient()
+        self.response_cache = response_cache  # None disables caching
+        self.warmup = WarmupScheduler(self.client.chat)
+        self.context = context or ContextWindowManager()
+
+    @staticmethod
+    def system_prompt(model_name):
+        """Returns the persona system prompt for a model."""
+        if model_name == 'llama3':
+            return LLAMA3_SYSTEM_PROMPT
+        return GENERAL_SYSTEM_PROMPT_TEMPLATE.format(model_name=model_name)
+
+    def new_conversation(self, model_name):
+        return [{'role': 'system', 'content': self.system_prompt(model_name)}]
+
+    def start_reply(self, model, messages, buffer, use_cache=True, context=None, options=None, keep_alive=None):
+        """
+        Streams the reply to `messages` into `buffer` and returns the ChatRequest. Cache hits
+        are replayed through the same buffer. `context` defaults to the engine's own window
+        manager; conversations running side by side need one each (it keeps summary state).
+        `options` (sampling parameters) and `keep_alive` are passed to the server as given.
+        """
+        context = context or self.context
+        keep_alive = self.warmup.keep_alive if keep_alive is None else keep_alive
+        if use_cache and self.response_cache is not None:
+            # The context strategy decides what is actually sent, so it is part of the key
+            cache_options = {'context_strategy': context.strategy, 'context_budget': context.budget}
+            if options:
+                cache_options['model_options'] = options
+            buffer.cache_key = ResponseCache.make_key(model, self.system_prompt(model), messages, cache_options)
+            cached = self.response_cache.get(buffer.cache_key)
+            if cached is not None:
+                buffer.from_cache = True
+                return self.client.replay(cached, on_chunk=buffer.push, on_done=lambda error: buffer.close(error=error))
+
+        buffer.model_warm = self.warmup.is_warm(model)
+
+        def prepare(messages):
+            # Runs in the client's executor: trimming may ask the model for a summary
+            selected, buffer.context_info = context.build(
+                messages, model, lambda m, p, e: summarize_turns(m, p, e, chat=self.client.chat)
+            )
+            return [dict(m) for m in selected]  # Plain dicts for the client library
+
+        extra = {'options': options} if options else {}
+        return self.client.stream_chat(
+            model, messages,
+            on_chunk=buffer.push,
+            on_done=lambda error: buffer.close(error=error),
+            prepare=prepare,
+            keep_alive=keep_alive,
+            **extra
+        )
 
-try:
-    import ollama
-    # Attempt a quick list to check connection status
-    ollama.list()
-except ImportError:
-    print("Warning: The 'ollama' library is not installed. Using MockOllama.")
-    ollama = MockOllama()
-except Exception as e:
-    # Handles ConnectionRefusedError or similar issues
-    print(f"Warning: Could not connect to the Ollama server. Using MockOllama. Error: {e}")
-    ollama = MockOllama()
-# --- End Global Stub ---
+    def finish_reply(self, model, buffer, text=None):
+        """
+        Books a finished reply: warm-up statistics, and the response cache when `text` (the
+        complete reply) is given. Returns the time to first token in ms (None for cache hits).
+        """
+        if buffer.from_cache:
+            return None
+        self.warmup.mark_used(model)
+        ttft_ms = None
+        if buffer.first_token_at is not None:
+            ttft_ms = (buffer.first_token_at - buffer.started_at) * 1000
+            self.warmup.record_ttft(buffer.model_warm, ttft_ms)
+        if text is not None and buffer.cache_key is not None and self.response_cache is not None:
+            self.response_cache.put(buffer.cache_key, model, text)
+        return ttft_ms
+
+    def close(self):
+        if self.response_cache is not None:
+            self.response_cache.sync()
+        self.client.close()
+# --- End Chat Engine ---
+
+# --- Job Scheduling ---
+class Job:
+    """One unit of model work, queued or holding a generation slot."""
+    __slots__ = ('id', 'priority', 'conversation', 'kind', 'label', 'start', 'state', 'submitted', 'started')
+
+    def __init__(self, job_id, priority, conversation, kind, label, start):
+        self.id = job_id
+        self.priority = priority
+        self.conversation = conversation
+        self.kind = kind
+        self.label = label
+        self.start = start
+        self.state = 'queued'
+        self.submitted = time.monotonic()
+        self.started = None
+
+
+class JobScheduler:
+    """
+    Priority queue of model work. Lower priorities run first (interactive prompts, then
+    background summaries, then warm-ups); equal priorities run in submission order. At most
+    max_concurrent jobs run at once, and jobs of one conversation run one at a time so every
+    prompt sees the reply to the one before it.
+
+    start(job) launches a job and its owner calls finish(job) when the work is over. Wait
+    estimates come from measured job lengths and token throughput. Not thread-safe: the app
+    drives it from the Tk thread.
+    """
+    INTERACTIVE, BACKGROUND, WARMUP = 0, 1, 2
+    SMOOTHING = 0.3  # Weight of the newest sample in the running averages
+
+    def __init__(self, max_concurrent=GENERATION_MAX_CONCURRENT, on_change=None):
+        self.max_concurrent = max_concurrent
+        self.on_change = on_change  # Called whenever the queue or the running set changes
+        self._queue = []
+        self._running = {}
+        self._next_id = 1
+        self._seconds = {}  # kind -> average job length
+        self._tokens = {}  # kind -> average tokens generated per job
+        self.tokens_per_sec = None  # Average effective throughput of generating jobs
+
+    def submit(self, start, priority=INTERACTIVE, conversation=None, kind='prompt', label=''):
+        """Queues a job and starts it right away if a slot is free. Returns the Job."""
+        job = Job(self._next_id, priority, conversation, kind, label, start)
+        self._next_id += 1
+        self._queue.append(job)
+        self._changed()
+        self.dispatch()
+        return job
+
+    def cancel(self, job_id):
+        """Drops a job that has not started yet. Returns False if it is running or unknown."""
+        for job in self._queue:
+            if job.id == job_id:
+                self._queue.remove(job)
+                job.state = 'cancelled'
+                self._changed()
+                return True
+        return False
+
+    def finish(self, job, tokens=0, measure=True):
+        """Frees the job's slot, records how long it took and starts whatever may run next."""
+        if self._running.pop(job.id, None) is None:
+            return
+        job.state = 'done'
+        if measure:
+            elapsed = time.monotonic() - job.started
+            self._seconds[job.kind] = self._average(self._seconds.get(job.kind), elapsed)
+            if tokens:
+                self._tokens[job.kind] = self._average(self._tokens.get(job.kind), tokens)
+                if elapsed > 0:
+                    self.tokens_per_sec = self._average(self.tokens_per_sec, tokens / elapsed)
+        self._changed()
+        self.dispatch()
+
+    def dispatch(self):
+        """Starts queued jobs, best first, while slots are free."""
+        while len(self._running) < self.max_concurrent:
+            job = self._next_runnable()
+            if job is None:
+                return
+            self._queue.remove(job)
+            job.state = 'running'
+            job.started = time.monotonic()
+            self._running[job.id] = job
+            self._changed()
+            try:
+                job.start(job)
+            except Exception as e:
+                print(f"Warning: Could not start {job.kind} job. {e}")
+                self.finish(job, measure=False)
+
+    def _next_runnable(self):
+        busy = {job.conversation for job in self._running.values() if job.conversation is not None}
+        for job in self.queued():
+            if job.conversation is None or job.conversation not in busy:
+                return job
+        return None
+
+    def queued(self):
+        """Waiting jobs in the order they will run."""
+        return sorted(self._queue, key=lambda job: (job.priority, job.id))
+
+    def running(self):
+        return list(self._running.values())
+
+    def expected_seconds(self, kind):
+        """How long a job of this kind is expected to take, from measured throughput where possible."""
+        if self._tokens.get(kind) and self.tokens_per_sec:
+            return self._tokens[kind] / self.tokens_per_sec
+        return self._seconds.get(kind, JOB_DEFAULT_SECONDS)
+
+    def estimate_waits(self):
+        """Seconds until each queued job is expected to start, keyed by job id."""
+        now = time.monotonic()
+        slots = []
+        conversation_free = {}
+        for job in self._running.values():
+            end = max(0.0, self.expected_seconds(job.kind) - (now - job.started))
+            slots.append(end)
+            if job.conversation is not None:
+                conversation_free[job.conversation] = end
+        slots.extend([0.0] * (self.max_concurrent - len(slots)))
+        heapq.heapify(slots)
+        waits = {}
+        for job in self.queued():
+            start = max(heapq.heappop(slots), conversation_free.get(job.conversation, 0.0))
+            waits[job.id] = start
+            end = start + self.expected_seconds(job.kind)
+            heapq.heappush(slots, end)
+            if job.conversation is not None:
+                conversation_free[job.conversation] = end
+        return waits
+
+    def _average(self, previous, sample):
+        return sample if previous is None else previous + self.SMOOTHING * (sample - previous)
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+# --- End Job Scheduling ---
 
 class OllamaChatApp:
     def __init__(self, master):
@@ -136,24 +3431,126 @@ class OllamaChatApp:
         self.current_model = tk.StringVar(master, value=DEFAULT_MODEL)
         self.current_model.trace_add("write", self._on_model_change)
         self.current_model_response = ""
-        self.streaming_start_index = None 
-        self.messages = [] 
+        self.stream_renderer = None
+        self.messages = MessageStore()
         self.current_theme = tk.StringVar(master, value="dark") 
         self.last_user_prompt = "" 
         
         # New: Stop Generation Event
         self.stop_event = threading.Event()
 
+        # Model catalog cache and server health
+        self.catalog = ModelCatalog()
+        self.health = HealthMonitor(_ollama_module)
+        self._health_job = None
+        self._server_probed = False
+
+        # Per-turn performance records for the metrics panel
+        self.telemetry = TelemetryStore()
+
+        # Model I/O, personas, context trimming and the response cache live in the engine
+        self.engine = ChatEngine(response_cache=ResponseCache())
+
+        # Replies to identical requests are replayed from disk
+        self.response_cache = self.engine.response_cache
+        self.response_cache.load()
+        self.use_response_cache = tk.BooleanVar(master, value=RESPONSE_CACHE_ENABLED)
+
+        # Model I/O runs on the async client's event-loop thread
+        self.client = self.engine.client
+        self.active_request = None
+
+        # Preloads models and keeps the selected one resident on the server
+        self.warmup = self.engine.warmup
+        self._warmup_job = None
+
+        # Context sent to the model
+        self.context = self.engine.context
+        self.context_strategy = tk.StringVar(master, value=ContextWindowManager.STRATEGIES[self.context.strategy])
+        self.context_strategy.trace_add("write", self._on_context_strategy_change)
+
+        # Persistence: library writes run in order on the writer thread
+        self.library = ConversationLibrary()
+        self.persistence = PersistenceWriter(self.library)
+        self._saved_meta = {}
+        self._restoring_history = False
+
+        # Virtualized transcript: messages[_rendered_start:_rendered_end] are materialized in the view
+        self._rendered_start = 1
+        self._rendered_end = 1
+        self._display_floor = 1
+        self._message_blocks = {}
+        self._loading_page = False
+
+        # Prompts, background summaries and warm-ups wait here for a generation slot
+        self.scheduler = JobScheduler(on_change=self._schedule_queue_refresh)
+        self._prompt_job = None  # Job of the reply currently streaming into the transcript
+        self._queue_refresh_job = None
+        self._queue_job_ids = []
+        self._queue_shown = False
+
+        # Streaming render pipeline state
+        self.stream_buffer = None
+        self.stream_stats = {}
+        self._last_stream = None  # Buffer of the most recently finished stream
+        self.frame_interval_ms = max(1, int(1000 / STREAM_FRAME_RATE))
+        self._last_frame_time = None
+        self._status_clear_job = None
+
         # --- UI Setup ---
-        self._setup_ui(master)
+        # Staged startup: only cheap local work happens before the window paints
+        self.profiler = StartupProfiler()
+        self.profiler.expect('window painted', 'server probed', 'history hydrated')
+        with self.profiler.phase('ui'):
+            self._setup_ui(master)
         
         # Initialize
-        self._configure_tags()
-        self.load_models()
-        self.load_history()
-        self.apply_theme(self.current_theme.get()) 
+        with self.profiler.phase('theme'):
+            self._configure_tags()
+            self.apply_theme(self.current_theme.get()) 
+        with self.profiler.phase('cached models'):
+            self.load_models()
+        with self.profiler.phase('library index'):
+            self.load_history()
+        self.master.after_idle(lambda: self._startup_milestone('window painted'))
         # Schedule the first resize adjustment
-        self.master.after(100, lambda: self._on_chat_resize(None))
+        self.master.after(100, self._apply_chat_width)
+
+    def _startup_milestone(self, name):
+        if self.profiler.mark(name):
+            report = self.profiler.report()
+            print(report)
+            self.update_status(report, clear_after=8000)
+
+    def _run_in_background(self, work, on_done):
+        """Runs work() on a daemon thread and calls on_done(result, error) back on the Tk thread."""
+        results = queue.Queue(maxsize=1)
+
+        def runner():
+            try:
+                results.put((work(), None))
+            except Exception as e:
+                results.put((None, e))
+
+        threading.Thread(target=runner, daemon=True).start()
+        self._poll_result(results, on_done)
+
+    def _run_on_writer(self, work, on_done):
+        """Runs work() on the persistence writer after every queued write; on_done runs on the Tk thread."""
+        results = queue.Queue(maxsize=1)
+        self.persistence.submit(work, on_done=lambda result, error: results.put((result, error)))
+        self._poll_result(results, on_done)
+
+    def _poll_result(self, results, on_done):
+        def poll():
+            try:
+                result, error = results.get_nowait()
+            except queue.Empty:
+                self.master.after(BACKGROUND_POLL_MS, poll)
+                return
+            on_done(result, error)
+
+        self.master.after(BACKGROUND_POLL_MS, poll)
 
     def _setup_ui(self, master):
         # Top Control Frame (Row 0)
@@ -164,6 +3561,20 @@ class OllamaChatApp:
         tk.Label(self.control_frame, text="Model:").pack(side=tk.LEFT, padx=(0, 5)) 
         self.model_combo = ttk.Combobox(self.control_frame, textvariable=self.current_model, state='readonly', width=15)
         self.model_combo.pack(side=tk.LEFT, padx=(0, 15))
+
+        # Context strategy Dropdown
+        tk.Label(self.control_frame, text="Context:").pack(side=tk.LEFT, padx=(0, 5))
+        self.context_combo = ttk.Combobox(
+            self.control_frame, textvariable=self.context_strategy, state='readonly', width=18,
+            values=list(ContextWindowManager.STRATEGIES.values())
+        )
+        self.context_combo.pack(side=tk.LEFT, padx=(0, 15))
+
+        # Response cache toggle
+        self.cache_check = tk.Checkbutton(
+            self.control_frame, text="Cache replies", variable=self.use_response_cache, relief=tk.FLAT
+        )
+        self.cache_check.pack(side=tk.LEFT, padx=(0, 15))
         
         # 2. New Chat Button
         self.new_chat_button = tk.Button(
@@ -192,6 +3603,24 @@ class OllamaChatApp:
         )
         self.history_button.pack(side=tk.LEFT, padx=(0, 10))
 
+        # Compare Mode Button
+        self.compare_button = tk.Button(
+            self.control_frame,
+            text="Compare Models",
+            command=lambda: CompareWindow(self),
+            relief=tk.FLAT, padx=5
+        )
+        self.compare_button.pack(side=tk.LEFT, padx=(0, 10))
+
+        # Metrics Panel Button
+        self.metrics_button = tk.Button(
+            self.control_frame,
+            text="Metrics",
+            command=self.show_metrics_window,
+            relief=tk.FLAT, padx=5
+        )
+        self.metrics_button.pack(side=tk.LEFT, padx=(0, 10))
+
         # Theme Toggle Button
         self.toggle_theme_button = tk.Button(
             self.control_frame,
@@ -214,10 +3643,26 @@ class OllamaChatApp:
         )
         self.chat_history.grid(row=1, column=0, padx=10, pady=(10, 0), sticky="nsew")
         self.chat_history.bind('<Configure>', self._on_chat_resize)
+        self.chat_history.config(yscrollcommand=self._on_chat_scroll)
+        self.markdown_cache = MarkdownCache()
+        self.highlighter = SyntaxHighlighter()
+        self.code_block_pool = CodeBlockPool(self.chat_history, self.copy_to_clipboard, highlighter=self.highlighter)
+        self._materialize_job = None
+        self._chat_width = None
+        self._resize_job = None
 
         # 6. Input Frame (Row 2)
         self.input_frame = tk.Frame(master, padx=10, pady=10) 
         self.input_frame.grid(row=2, column=0, sticky="ew")
+
+        # Queued jobs with their estimated wait (packed above the input only while something waits)
+        self.queue_frame = tk.Frame(self.input_frame)
+        self.queue_list = tk.Listbox(self.queue_frame, height=1, activestyle='none', borderwidth=0, exportselection=False)
+        self.queue_list.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.queue_cancel_button = tk.Button(
+            self.queue_frame, text="Cancel Queued", command=self._cancel_queued_job, relief=tk.FLAT, padx=5
+        )
+        self.queue_cancel_button.pack(side=tk.LEFT, padx=(5, 0), anchor=tk.N)
         
         # Multi-line Input Field
         self.user_input = scrolledtext.ScrolledText(
@@ -234,6 +3679,7 @@ class OllamaChatApp:
         # Bindings for multiline input: Enter to send, Shift-Enter for newline
         self.user_input.bind("<Key-Return>", self.send_message_event)
         self.user_input.bind("<Shift-Return>", self.insert_newline_event)
+        self.user_input.bind("<Key>", self._on_user_activity, add='+')
         
         # Send Button
         self.send_button = tk.Button(self.input_frame, text="Send", command=self.send_message, relief=tk.FLAT, padx=10) 
@@ -251,20 +3697,23 @@ class OllamaChatApp:
 
         self.input_frame.grid_columnconfigure(0, weight=1)
         
-        # 7. Status Bar (Row 3)
-        self.status_bar = tk.Label(master, text="Ready", bd=1, relief=tk.SUNKEN, anchor=tk.W)
-        self.status_bar.grid(row=3, column=0, sticky="ew")
+        # 7. Status Bar (Row 3) with the server connection state on the right
+        self.status_frame = tk.Frame(master)
+        self.status_frame.grid(row=3, column=0, sticky="ew")
+        self.status_bar = tk.Label(self.status_frame, text="Ready", bd=1, relief=tk.SUNKEN, anchor=tk.W)
+        self.status_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.connection_label = tk.Label(self.status_frame, text=self.health.state_label(), bd=1, relief=tk.SUNKEN, padx=5)
+        self.connection_label.pack(side=tk.RIGHT)
 
 
     # --- Theme Management ---
     def toggle_theme(self):
-        """Switches between light and dark themes."""
+        """Switches between light and dark themes. Tags and registered code blocks are restyled in place."""
         if self.current_theme.get() == "light":
             self.current_theme.set("dark")
         else:
             self.current_theme.set("light")
         self.apply_theme(self.current_theme.get())
-        self.redraw_history() 
 
     def apply_theme(self, theme_name):
         """Applies the specified theme to all UI elements."""
@@ -281,6 +3730,11 @@ class OllamaChatApp:
             if isinstance(widget, tk.Button):
                  widget.config(activebackground=widget['bg'])
         
+        self.cache_check.config(
+            bg=colors["bg_control"], fg=colors["fg_text"], selectcolor=colors["entry_bg"],
+            activebackground=colors["bg_control"], activeforeground=colors["fg_text"]
+        )
+        
         # Chat History area
         self.chat_history.config(
             bg=colors["chat_bg"],
@@ -292,11 +3746,16 @@ class OllamaChatApp:
         # Input frame and its children
         self.input_frame.config(bg=colors["bg_main"])
         self.user_input.config(bg=colors["entry_bg"], fg=colors["entry_fg"], insertbackground=colors["fg_text"]) 
+        self.queue_frame.config(bg=colors["bg_main"])
+        self.queue_list.config(bg=colors["bg_control"], fg=colors["fg_text"], highlightthickness=0)
+        self.queue_cancel_button.config(bg=colors["btn_clear_bg"], fg=colors["btn_clear_fg"], activebackground=colors["btn_clear_bg"])
         
         # Buttons
         self.new_chat_button.config(bg=colors["btn_new_bg"], fg=colors["btn_new_fg"], activebackground=colors["btn_new_bg"])
         self.clear_history_button.config(bg=colors["btn_clear_bg"], fg=colors["btn_clear_fg"], activebackground=colors["btn_clear_bg"])
         self.history_button.config(bg=colors["btn_history_bg"], fg=colors["btn_history_fg"], activebackground=colors["btn_history_bg"])
+        self.compare_button.config(bg=colors["btn_toggle_bg"], fg=colors["btn_toggle_fg"], activebackground=colors["btn_toggle_bg"])
+        self.metrics_button.config(bg=colors["btn_toggle_bg"], fg=colors["btn_toggle_fg"], activebackground=colors["btn_toggle_bg"])
         self.send_button.config(bg=colors["btn_send_bg"], fg=colors["btn_send_fg"], activebackground=colors["btn_send_bg"])
         self.toggle_theme_button.config(bg=colors["btn_toggle_bg"], fg=colors["btn_toggle_fg"], activebackground=colors["btn_toggle_bg"])
         
@@ -305,6 +3764,7 @@ class OllamaChatApp:
         
         # Status Bar
         self.status_bar.config(bg=colors["bg_control"], fg=colors["fg_text"])
+        self.connection_label.config(bg=colors["bg_control"], fg=colors["fg_text"])
         
         # Update tags for chat bubbles (requires re-configuring)
         self._configure_tags()
@@ -313,151 +3773,265 @@ class OllamaChatApp:
 
 
     def _update_embedded_code_block_themes(self):
-        """Iterates through embedded code block widgets and updates their colors."""
-        colors = COLOR_SCHEMES[self.current_theme.get()]
-        for mark in self.chat_history.dump('1.0', tk.END, window=True):
-            if mark[2] == 'window':
-                window_widget = self.master.nametowidget(mark[1]) 
-                
-                # Check for the code wrapper frame
-                for child_frame in window_widget.winfo_children():
-                    if isinstance(child_frame, tk.Frame): 
-                        # This is the inner frame containing the scrolledtext and button
-                        code_frame = next((f for f in child_frame.winfo_children() if isinstance(f, tk.Frame)), None)
-                        if code_frame:
-                            code_frame.config(bg=colors["code_bg"])
-                            
-                            # Update ScrolledText widget
-                            code_widget = next((w for w in code_frame.winfo_children() if isinstance(w, scrolledtext.ScrolledText)), None)
-                            if code_widget:
-                                code_widget.config(bg=colors["code_bg"], fg=colors["code_fg"], insertbackground=colors["code_fg"])
-                                # Also update scrollbar colors if needed (Tkinter standard scrollbar styling is complex)
-                            
-                            # Update Button frame
-                            btn_frame = next((f for f in code_frame.winfo_children() if isinstance(f, tk.Frame)), None)
-                            if btn_frame:
-                                btn_frame.config(bg=colors["code_bg"])
-                                for btn in btn_frame.winfo_children():
-                                    if isinstance(btn, tk.Button):
-                                        btn.config(bg=colors["code_btn_bg"], fg=colors["code_btn_fg"], activebackground=colors["code_btn_bg"])
+        """Restyles the code blocks in the transcript through the pool's registry (no widget traversal)."""
+        self.code_block_pool.restyle(COLOR_SCHEMES[self.current_theme.get()])
 
 
     # --- History Management Methods (Unchanged) ---
 
     def _get_system_prompt(self, model_name):
         """Returns the appropriate system prompt based on the selected model."""
-        if model_name == 'llama3':
-            return LLAMA3_SYSTEM_PROMPT
-        else:
-            return GENERAL_SYSTEM_PROMPT_TEMPLATE.format(model_name=model_name)
+        return self.engine.system_prompt(model_name)
 
     def load_history(self):
-        """Loads conversation history from the local JSON file."""
-        self.messages = [{'role': 'system', 'content': self._get_system_prompt(self.current_model.get())}]
+        """
+        Reads the library index and hydrates the most recent conversation in the background
+        (migrating older history files once). Input stays disabled until it is loaded.
+        """
+        self.messages = MessageStore([{'role': 'system', 'content': self._get_system_prompt(self.current_model.get())}])
         
-        if os.path.exists(HISTORY_FILE):
-            try:
-                with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    
-                self.messages = data.get('messages', [])
-                loaded_model = data.get('model', DEFAULT_MODEL)
-                loaded_theme = data.get('theme', 'dark') 
-                
-                if not self.messages or self.messages[0]['role'] != 'system':
-                    self.start_fresh_history(show_message=False)
-                else:
-                    if loaded_model in self.model_combo['values']:
-                        self.current_model.set(loaded_model) 
-                    self.current_theme.set(loaded_theme) 
-                    self.apply_theme(loaded_theme) 
-                    self.redraw_history()
-                    self.update_status(
-                        f"Chat history loaded using model: {self.current_model.get()}. Ready to continue."
-                    )
-                    
-            except (json.JSONDecodeError, IOError):
-                self.update_status(f"Error loading chat history. Starting a new chat.")
-                self.start_fresh_history(show_message=False)
-        else:
+        try:
+            self.library.load()
+        except IOError:
+            self.update_status(f"Error loading chat history. Starting a new chat.")
+            self.start_fresh_history(show_message=False)
+            self._startup_milestone('history hydrated')
+            return
+
+        session_id = self.library.last_session
+        if session_id not in self.library.sessions:
+            recent = self.library.list_sessions()
+            session_id = recent[0]['id'] if recent else None
+        if session_id is None:
             self.start_fresh_history(show_message=True)
+            self._startup_milestone('history hydrated')
+            return
+
+        title = self.library.sessions[session_id]['title'] or "last conversation"
+        self.update_status(f"Loading \"{title}\"...", clear_after=0)
+        self._set_controls_state(enabled=False, show_stop=False)
+        self._run_on_writer(lambda: self.library.open_session(session_id), self._on_history_hydrated)
+
+    def _on_history_hydrated(self, result, error):
+        self._set_controls_state(enabled=True)
+        if error is not None:
+            self.update_status(f"Error loading chat history. Starting a new chat.")
+            self.start_fresh_history(show_message=False)
+        else:
+            self._restore_session(*result)
+            self._prewarm_frequent_models()
+        self._startup_milestone('history hydrated')
+
+    def _restore_session(self, messages, meta):
+        """Makes a loaded conversation the active one and redraws it."""
+        if not messages or messages[0]['role'] != 'system':
+            self.start_fresh_history(show_message=False)
+            return
+
+        self.messages = MessageStore(messages)
+        self.context.reset()
+        loaded_model = meta.get('model', DEFAULT_MODEL)
+        loaded_theme = meta.get('theme', self.current_theme.get()) 
+        self._saved_meta = {'model': loaded_model, 'theme': loaded_theme}
+
+        if loaded_model in self.model_combo['values']:
+            # Restoring the saved model must not start a new context
+            self._restoring_history = True
+            try:
+                self.current_model.set(loaded_model) 
+            finally:
+                self._restoring_history = False
+        self.current_theme.set(loaded_theme) 
+        self.apply_theme(loaded_theme) 
+        self.redraw_history()
+        self.update_status(
+            f"Chat history loaded using model: {self.current_model.get()}. Ready to continue."
+        )
+
+    def _record_message(self, message):
+        """Queues one message for the active conversation (only the new message is written)."""
+        self.persistence.submit(lambda: self.library.record_message(message))
 
     def save_history(self):
-        """Saves current conversation history, model, and theme to the local JSON file."""
-        data = {
-            'model': self.current_model.get(),
-            'messages': self.messages,
-            'theme': self.current_theme.get() 
-        }
-        try:
-            with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-        except IOError as e:
-            print(f"Warning: Could not save chat history to file. {e}")
+        """Queues recording model and theme changes in the active conversation and fsyncing pending records."""
+        meta = {'model': self.current_model.get(), 'theme': self.current_theme.get()}
+        # Back-to-back saves collapse into the latest one
+        self.persistence.submit(lambda: self._commit_history(meta), key='save')
+
+    def _commit_history(self, meta):
+        """Runs on the writer thread."""
+        if meta != self._saved_meta:
+            self.library.set_meta(**meta)
+            self._saved_meta = meta
+        self.library.sync()
 
     def load_models(self):
-        """Fetches available Ollama models and updates the dropdown."""
-        models = []
-        try:
-            ollama_response = ollama.list()
-            if 'models' in ollama_response and isinstance(ollama_response['models'], list):
-                # Filter out codellama explicitly (or any model not wanted)
-                models.extend([m.get('name') for m in ollama_response['models'] if m.get('name') and m.get('name') != 'codellama'])
-            
-            # Use filtered fallback models
-            for fm in FALLBACK_MODELS:
-                if fm not in models:
-                    models.append(fm)
+        """Shows the cached model catalog immediately and starts background health checks."""
+        self.catalog.load()
+        if _ollama_module is None:
+            # Nothing to probe; offer the mock's models
+            self._apply_model_list(self.catalog.names() + [e['name'] for e in ModelCatalog.parse(ollama.list())])
+            self.connection_label.config(text=self.health.state_label())
+            self._startup_milestone('server probed')
+            return
+        self._apply_model_list(self.catalog.names() or FALLBACK_MODELS)
+        self._health_check()
 
-            self.model_combo['values'] = sorted(list(set(models)))
-            self.master.title(f"Ollama Local Chat - Model: {self.current_model.get()}")
+    def _health_check(self):
+        """Probes the server off the UI thread; reschedules itself every HEALTH_CHECK_INTERVAL_MS."""
+        self._health_job = None
+        self._run_in_background(self.health.check, self._on_health_checked)
 
-        except Exception as e:
-            self.model_combo['values'] = sorted(list(set(FALLBACK_MODELS)))
+    def _apply_model_list(self, models):
+        # Use filtered fallback models
+        models = list(models)
+        for fm in FALLBACK_MODELS:
+            if fm not in models:
+                models.append(fm)
+        self.model_combo['values'] = sorted(list(set(models)))
+        self.master.title(f"Ollama Local Chat - Model: {self.current_model.get()}")
+
+    def _on_health_checked(self, entries, error):
+        """Applies a health check result: refresh the catalog and switch backends if needed."""
+        global ollama
+        if entries is not None:
+            if self.catalog.update(entries):
+                self._apply_model_list(self.catalog.names())
+            self.catalog.save()
+            if isinstance(ollama, MockOllama):
+                ollama = _ollama_module
+                self.update_status("Connected to the Ollama server. Using live models.")
+        elif not isinstance(ollama, MockOllama):
+            # Handles ConnectionRefusedError or similar issues
+            print(f"Warning: Could not connect to the Ollama server. Using MockOllama. Error: {self.health.last_error}")
+            ollama = MockOllama()
             self.update_status(
                 f"Could not connect to Ollama server to list models. Using fallback models: {', '.join(FALLBACK_MODELS)}."
             )
-            if self.current_model.get() not in FALLBACK_MODELS:
+            if self.current_model.get() not in self.model_combo['values']:
                 self.current_model.set(DEFAULT_MODEL)
 
+        self.connection_label.config(text=self.health.state_label())
+        if not self._server_probed:
+            self._server_probed = True
+            self._startup_milestone('server probed')
+            self._keep_alive_tick()
+        self._health_job = self.master.after(HEALTH_CHECK_INTERVAL_MS, self._health_check)
+
+    # --- Model Warm-up ---
+    def _warm_model(self, model, announce=False):
+        """Preloads a model on the server in the background. Nothing to do for MockOllama."""
+        if isinstance(ollama, MockOllama):
+            return
+
+        jobs = self.scheduler.queued() + self.scheduler.running()
+        if any(job.kind == 'warm-up' and job.label == model for job in jobs):
+            return
+
+        def on_done(elapsed, error):
+            if error is not None:
+                print(f"Warning: Could not preload model {model}. {error}")
+            elif announce and elapsed is not None and model == self.current_model.get():
+                self.update_status(f"Model {model} ready (preloaded in {elapsed / 1000:.1f} s).", clear_after=5000)
+
+        def start(job):
+            def done(elapsed, error):
+                self.scheduler.finish(job)
+                on_done(elapsed, error)
+            self._run_in_background(lambda: self.warmup.warm(model), done)
+
+        # Warm-ups only get a slot nothing more urgent is waiting for
+        self.scheduler.submit(start, priority=JobScheduler.WARMUP, kind='warm-up', label=model)
+
+    def _keep_alive_tick(self):
+        """Pings the selected model while the user is active so the server keeps it loaded."""
+        if self.warmup.is_active() and self.stream_buffer is None:
+            self._warm_model(self.current_model.get())
+        self._warmup_job = self.master.after(WARMUP_PING_INTERVAL_MS, self._keep_alive_tick)
+
+    def _on_user_activity(self, event=None):
+        # Returning after an idle period: the model may have been unloaded, so start loading it now
+        was_active = self.warmup.is_active()
+        self.warmup.touch()
+        if not was_active:
+            self._warm_model(self.current_model.get())
+
+    def _prewarm_frequent_models(self):
+        """Preloads the models used most in saved conversations (WARMUP_PREWARM_COUNT of them)."""
+        if not WARMUP_PREWARM_COUNT:
+            return
+        available = set(self.model_combo['values'])
+        for model in WarmupScheduler.most_used(self.library.list_sessions(), WARMUP_PREWARM_COUNT, available):
+            if model != self.current_model.get():
+                self._warm_model(model)
+
+    def _ttft_summary(self):
+        averages = []
+        for kind in ('warm', 'cold'):
+            average = self.warmup.average_ttft(kind)
+            if average is not None:
+                averages.append(f"{kind} avg {average:.0f} ms")
+        return ', '.join(averages)
+
+    def _on_context_strategy_change(self, *args):
+        label = self.context_strategy.get()
+        strategy = next((k for k, v in ContextWindowManager.STRATEGIES.items() if v == label), DEFAULT_CONTEXT_STRATEGY)
+        self.context.strategy = strategy
+        self.context.reset()
+        self.update_status(f"Context strategy: {label} (budget ~{self.context.budget} tokens).")
 
     def _on_model_change(self, *args):
         new_model = self.current_model.get()
         self.master.title(f"Ollama Local Chat - Model: {new_model}")
+        self._warm_model(new_model, announce=not self._restoring_history)
+        if self._restoring_history:
+            return
         self.start_fresh_history(
             system_message=f"Model switched to **{new_model}**. Starting a new conversation context.",
             show_message=True
         )
-        self.update_status(f"Model switched to {new_model}. New context started.")
+        details = self.catalog.describe(new_model)
+        self.update_status(f"Model switched to {new_model}{f' ({details})' if details else ''}. New context started.")
 
     def confirm_clear_history(self):
         if messagebox.askyesno(
             "Confirm Clear History",
             "Are you sure you want to clear ALL conversation history? This cannot be undone."
         ):
+            self.persistence.submit(self.library.clear)
             self.start_fresh_history(show_message=True)
 
     def start_fresh_history(self, show_message=True, system_message=None):
-        self.chat_history.config(state='normal')
-        self.chat_history.delete('1.0', tk.END)
-        self.chat_history.config(state='disabled')
-        
         model_name = self.current_model.get()
         
-        self.messages = [
+        self.messages = MessageStore([
             {'role': 'system', 'content': self._get_system_prompt(model_name)}
-        ]
+        ])
+        self.context.reset()
+        self._clear_transcript()
         
         if show_message:
             display_message = system_message if system_message else f"Full history cleared. New conversation context started with model: {model_name}."
             self.insert_system_message(display_message)
         
+        # The previous conversation stays in the library; an untouched one is simply reused.
+        # Decided on the writer thread, where the library state is current.
+        messages = self.messages.to_dicts()
+
+        def start_session():
+            current = self.library.sessions.get(self.library.current_id)
+            if current is not None and current['turns'] == 0:
+                self.library.reset_session(messages)
+            else:
+                self.library.create_session(model_name, messages)
+                self._saved_meta = {'model': model_name}
+
+        self.persistence.submit(start_session)
         self.save_history()
 
     def start_new_display(self):
-        self.chat_history.config(state='normal')
-        self.chat_history.delete('1.0', tk.END)
-        self.chat_history.config(state='disabled')
+        # Older messages stay in context but are no longer paged back into the view
+        self._clear_transcript(floor=len(self.messages))
 
         self.insert_system_message(
             f"Display cleared. Conversation context ({len(self.messages)-1} messages) is still active in the background. Ask your next question now."
@@ -465,112 +4039,559 @@ class OllamaChatApp:
         self.update_status(f"Display cleared. Context preserved.")
 
 
-    def redraw_history(self):
-        """Redraws the chat history, applying current theme colors."""
+    # --- Virtualized Transcript ---
+    def _clear_transcript(self, floor=1):
+        """Empties the chat view and returns its code blocks to the pool."""
         self.chat_history.config(state='normal')
         self.chat_history.delete('1.0', tk.END)
-        
-        for message in self.messages[1:]:
-            role = message['role']
-            content = message['content']
-            
-            if role == 'user':
-                self.insert_formatted_response(content, 'user', redraw=True, is_final_insert=True)
-            elif role == 'assistant':
-                self.insert_formatted_response(content, 'model', redraw=True, is_final_insert=True)
-                
+        self.chat_history.config(state='disabled')
+        for blocks in self._message_blocks.values():
+            for block in blocks:
+                self.code_block_pool.release(block)
+        self._message_blocks = {}
+        self._display_floor = floor
+        self._rendered_start = self._rendered_end = len(self.messages)
+
+    def redraw_history(self):
+        """
+        Redraws the chat view, applying current theme colors. Only the most recent page of
+        messages is materialized; older ones are rendered when the user scrolls up.
+        """
+        self._clear_transcript()
+        self.chat_history.config(state='normal')
+        self._rendered_start = max(self._display_floor, len(self.messages) - TRANSCRIPT_PAGE_SIZE)
+        for i in range(self._rendered_start, len(self.messages)):
+            self._render_message(i, tk.END)
+        self._rendered_end = len(self.messages)
+        self._update_page_markers()
         self.chat_history.config(state='disabled')
         self.chat_history.see(tk.END)
 
+    def _render_message(self, i, index):
+        """Renders messages[i] at `index`, marking where it starts so it can be released later."""
+        message = self.messages[i]
+        mark = f'msg_{i}'
+        self.chat_history.mark_set(mark, 'end-1c' if index == tk.END else index)
+        self.chat_history.mark_gravity(mark, tk.LEFT)
+        if message['role'] in ('user', 'assistant'):
+            role = 'user' if message['role'] == 'user' else 'model'
+            self._message_blocks[i] = self.insert_formatted_response(message['content'], role, redraw=True, index=index)
+
+    def _release_messages(self, start, end):
+        """Deletes messages[start:end] from the view (they must be at one end of it)."""
+        first = f'msg_{start}' if start > self._rendered_start else '1.0'
+        last = f'msg_{end}' if end < self._rendered_end else tk.END
+        self.chat_history.delete(first, last)
+        for i in range(start, end):
+            for block in self._message_blocks.pop(i, ()):
+                self.code_block_pool.release(block)
+            self.chat_history.mark_unset(f'msg_{i}')
+
+    def _update_page_markers(self):
+        """Shows or removes the 'earlier messages' / 'newer messages' hints at either end of the view."""
+        for tag in ('older_marker', 'newer_marker'):
+            ranges = self.chat_history.tag_ranges(tag)
+            if ranges:
+                self.chat_history.delete(ranges[0], ranges[-1])
+
+        older = self._rendered_start - self._display_floor
+        if older > 0:
+            # The first message's mark sits at 1.0; let it move past the hint
+            first_mark = f'msg_{self._rendered_start}' if self._rendered_start < self._rendered_end else None
+            if first_mark:
+                self.chat_history.mark_gravity(first_mark, tk.RIGHT)
+            self.chat_history.insert(
+                '1.0', f"--- {older} earlier messages. Scroll up to load them. ---\n", ('system', 'older_marker')
+            )
+            if first_mark:
+                self.chat_history.mark_gravity(first_mark, tk.LEFT)
+
+        newer = len(self.messages) - self._rendered_end
+        if newer > 0:
+            self.chat_history.insert(
+                tk.END, f"\n--- {newer} newer messages. Scroll down to load them. ---\n", ('system', 'newer_marker')
+            )
+
+    def _on_chat_scroll(self, first, last):
+        """yscrollcommand hook: pages older/newer messages in when the view hits either end."""
+        self.chat_history.vbar.set(first, last)
+        if self.code_block_pool.pending and self._materialize_job is None:
+            self._materialize_job = self.master.after_idle(self._materialize_code_blocks)
+        if self._loading_page or self.stream_buffer is not None:
+            return
+        if float(first) <= 0.0 and self._rendered_start > self._display_floor:
+            self._loading_page = True
+            self.master.after_idle(self._load_older_messages)
+        elif float(last) >= 1.0 and self._rendered_end < len(self.messages):
+            self._loading_page = True
+            self.master.after_idle(self._load_newer_messages)
+
+    def _materialize_code_blocks(self):
+        """Turns code block placeholders that scrolled into view into real (pooled) widgets."""
+        self._materialize_job = None
+        self.code_block_pool.materialize_visible(self.chat_history, COLOR_SCHEMES[self.current_theme.get()])
+
+    def _load_older_messages(self):
+        """Materializes the previous page above the view, releasing the newest page if over the cap."""
+        try:
+            old_start = self._rendered_start
+            new_start = max(self._display_floor, old_start - TRANSCRIPT_PAGE_SIZE)
+            if new_start >= old_start:
+                return
+
+            self.chat_history.config(state='normal')
+            for tag in ('older_marker',):
+                ranges = self.chat_history.tag_ranges(tag)
+                if ranges:
+                    self.chat_history.delete(ranges[0], ranges[-1])
+
+            # Insert in order at a right-gravity mark in front of the current first message
+            anchor = f'msg_{old_start}' if old_start < self._rendered_end else tk.END
+            self.chat_history.mark_set('prepend_point', '1.0' if anchor == tk.END else anchor)
+            self.chat_history.mark_gravity('prepend_point', tk.RIGHT)
+            if anchor != tk.END:
+                self.chat_history.mark_gravity(anchor, tk.RIGHT)
+            for i in range(new_start, old_start):
+                self._render_message(i, 'prepend_point')
+            if anchor != tk.END:
+                self.chat_history.mark_gravity(anchor, tk.LEFT)
+            self.chat_history.mark_unset('prepend_point')
+            self._rendered_start = new_start
+
+            if self._rendered_end - self._rendered_start > TRANSCRIPT_MAX_RENDERED:
+                new_end = self._rendered_start + TRANSCRIPT_MAX_RENDERED
+                self._release_messages(new_end, self._rendered_end)
+                self._rendered_end = new_end
+
+            self._update_page_markers()
+            self.chat_history.config(state='disabled')
+            if anchor != tk.END:
+                self.chat_history.yview(anchor)
+        finally:
+            self._loading_page = False
+
+    def _load_newer_messages(self):
+        """Materializes the next page below the view, releasing the oldest page if over the cap."""
+        try:
+            old_end = self._rendered_end
+            new_end = min(len(self.messages), old_end + TRANSCRIPT_PAGE_SIZE)
+            if new_end <= old_end:
+                return
+
+            self.chat_history.config(state='normal')
+            ranges = self.chat_history.tag_ranges('newer_marker')
+            if ranges:
+                self.chat_history.delete(ranges[0], ranges[-1])
+            for i in range(old_end, new_end):
+                self._render_message(i, tk.END)
+            self._rendered_end = new_end
+            self._trim_oldest()
+            self._update_page_markers()
+            self.chat_history.config(state='disabled')
+            self.chat_history.yview(f'msg_{old_end}')
+        finally:
+            self._loading_page = False
+
+    def _trim_oldest(self):
+        """Releases the oldest materialized messages once more than TRANSCRIPT_MAX_RENDERED are shown."""
+        if self._rendered_end - self._rendered_start > TRANSCRIPT_MAX_RENDERED:
+            new_start = self._rendered_end - TRANSCRIPT_MAX_RENDERED
+            ranges = self.chat_history.tag_ranges('older_marker')
+            if ranges:
+                self.chat_history.delete(ranges[0], ranges[-1])
+            self._release_messages(self._rendered_start, new_start)
+            self._rendered_start = new_start
+
     def show_history_window(self):
-        """Opens a new Toplevel window to display past chat history summaries."""
+        """Opens a Toplevel window listing saved conversations. Only the library index is read."""
         
         history_window = tk.Toplevel(self.master)
         history_window.title("Past Chat History")
-        history_window.geometry("600x400")
+        history_window.geometry("700x450")
         history_window.option_add('*Font', 'Arial 10')
-        history_window.grid_rowconfigure(0, weight=1)
+        history_window.grid_rowconfigure(1, weight=1)
         history_window.grid_columnconfigure(0, weight=1)
+        current_theme_colors = COLOR_SCHEMES[self.current_theme.get()] 
+        history_window.config(bg=current_theme_colors["bg_main"])
 
-        try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        except (json.JSONDecodeError, IOError):
-            messagebox.showerror("Error", "Could not load chat history file.")
+        # Search bar: free text plus model and role filters
+        search_frame = tk.Frame(history_window, bg=current_theme_colors["bg_main"])
+        search_frame.grid(row=0, column=0, sticky="ew", padx=10, pady=(10, 0))
+        tk.Label(
+            search_frame, text="Search:", bg=current_theme_colors["bg_main"], fg=current_theme_colors["fg_text"]
+        ).pack(side=tk.LEFT, padx=(0, 5))
+        query_var = tk.StringVar(history_window)
+        search_entry = tk.Entry(
+            search_frame, textvariable=query_var, bg=current_theme_colors["entry_bg"],
+            fg=current_theme_colors["entry_fg"], insertbackground=current_theme_colors["fg_text"]
+        )
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 10))
+        model_filter = tk.StringVar(history_window, value="All models")
+        ttk.Combobox(
+            search_frame, textvariable=model_filter, state='readonly', width=14,
+            values=["All models"] + self.library.search.models()
+        ).pack(side=tk.LEFT, padx=(0, 5))
+        role_filter = tk.StringVar(history_window, value="All roles")
+        ttk.Combobox(
+            search_frame, textvariable=role_filter, state='readonly', width=10,
+            values=["All roles", "user", "assistant"]
+        ).pack(side=tk.LEFT)
+        search_status = tk.Label(
+            history_window, anchor=tk.W, bg=current_theme_colors["bg_main"], fg=current_theme_colors["fg_text"],
+            text="" if self.library.search.available else "Full-text search is unavailable (SQLite without FTS5)."
+        )
+        search_status.grid(row=3, column=0, sticky="ew", padx=10, pady=(0, 5))
+
+        # Search results replace the conversation list while a query is active
+        results_text = scrolledtext.ScrolledText(
+            history_window, wrap=tk.WORD, state='disabled', padx=10, pady=10,
+            bg=current_theme_colors["chat_bg"], fg=current_theme_colors["fg_text"]
+        )
+        results_text.grid(row=1, column=0, sticky="nsew", padx=10, pady=(10, 0))
+        results_text.grid_remove()
+        results_text.tag_configure('result_header', font='Arial 9 bold', foreground=current_theme_colors["btn_history_bg"])
+        results_text.tag_configure('match', font='Arial 10 bold', background=current_theme_colors["btn_stop_bg"], foreground="#000000")
+
+        columns = ('title', 'model', 'turns', 'tokens', 'modified')
+        session_list = ttk.Treeview(history_window, columns=columns, show='headings', selectmode='browse')
+        for column, heading, width in (
+            ('title', "First Request", 260), ('model', "Model", 90), ('turns', "Turns", 50),
+            ('tokens', "Tokens", 60), ('modified', "Last Modified", 120),
+        ):
+            session_list.heading(column, text=heading)
+            session_list.column(column, width=width, stretch=(column == 'title'))
+        session_list.grid(row=1, column=0, sticky="nsew", padx=10, pady=(10, 0))
+
+        def populate():
+            session_list.delete(*session_list.get_children())
+            for entry in self.library.list_sessions():
+                title = entry['title'] or "(no user messages)"
+                if entry['id'] == self.library.current_id:
+                    title = f"[Active] {title}"
+                session_list.insert('', tk.END, iid=entry['id'], values=(
+                    title, entry['model'], entry['turns'], entry['tokens'],
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['modified'])),
+                ))
+
+        def selected_id():
+            selection = session_list.selection()
+            return selection[0] if selection else None
+
+        def open_selected(event=None):
+            session_id = selected_id()
+            if session_id:
+                self.open_session(session_id)
+                history_window.destroy()
+
+        def delete_selected():
+            session_id = selected_id()
+            if session_id and messagebox.askyesno(
+                "Confirm Delete", "Delete this conversation? This cannot be undone.", parent=history_window
+            ):
+                def delete():
+                    was_active = session_id == self.library.current_id
+                    self.library.delete_session(session_id)
+                    return was_active
+
+                def deleted(was_active, error):
+                    if error is not None:
+                        print(f"Warning: Could not delete conversation. {error}")
+                    elif was_active:
+                        self.start_fresh_history(show_message=True)
+                    if history_window.winfo_exists():
+                        populate()
+
+                self._run_on_writer(delete, deleted)
+
+        def export_selected():
+            session_id = selected_id()
+            if not session_id:
+                return
+            path = filedialog.asksaveasfilename(
+                parent=history_window, defaultextension=ARCHIVE_EXTENSION, initialfile=f"{session_id}{ARCHIVE_EXTENSION}",
+                filetypes=[("Chat archive", f'*{ARCHIVE_EXTENSION}')]
+            )
+            if not path:
+                return
+
+            def exported(stats, error):
+                if error is not None:
+                    messagebox.showerror("Export Failed", f"Could not write {path}. {error}", parent=history_window)
+                    return
+                self.update_status(
+                    f"Archived {stats['messages']} messages to {path} "
+                    f"({stats['archive_bytes'] / 1024:.0f} KB from {stats['raw_bytes'] / 1024:.0f} KB)."
+                )
+
+            # Runs on the writer so every queued message of the open conversation is on disk first
+            self._run_on_writer(
+                lambda: ConversationArchive.write(path, *self.library.read_session(session_id)), exported
+            )
+
+        def import_file():
+            if self.stream_buffer is not None:
+                self.update_status("Wait for the current response to finish before importing a conversation.")
+                return
+            path = filedialog.askopenfilename(
+                parent=history_window,
+                filetypes=[("Chat archive", f'*{ARCHIVE_EXTENSION}'), ("JSON history", '*.json'), ("All files", '*')]
+            )
+            if not path:
+                return
+
+            def load():
+                messages, meta = load_history_file(path)
+                self.library.import_session(messages, meta)
+                return messages, meta
+
+            def imported(result, error):
+                if error is not None:
+                    messagebox.showerror("Import Failed", f"Could not import {path}. {error}", parent=history_window)
+                    return
+                self._restore_session(*result)
+                if history_window.winfo_exists():
+                    history_window.destroy()
+
+            self.save_history()
+            self._run_on_writer(load, imported)
+
+        session_list.bind('<Double-1>', open_selected)
+
+        def open_result(session_id):
+            self.open_session(session_id)
             history_window.destroy()
+
+        def run_search():
+            query = query_var.get().strip()
+            if not query:
+                results_text.grid_remove()
+                session_list.grid()
+                search_status.config(text="")
+                return
+
+            started = time.perf_counter()
+            results = self.library.search.search(
+                query,
+                model=None if model_filter.get() == "All models" else model_filter.get(),
+                role=None if role_filter.get() == "All roles" else role_filter.get(),
+            )
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            session_list.grid_remove()
+            results_text.grid()
+            results_text.config(state='normal')
+            results_text.delete('1.0', tk.END)
+            for n, result in enumerate(results):
+                entry = self.library.sessions.get(result['session_id'])
+                if entry is None:
+                    continue
+                result_tag = f'result_{n}'
+                results_text.insert(
+                    tk.END, f"{entry['title'] or '(untitled)'}  [{result['model']}, {result['role']}]\n",
+                    ('result_header', result_tag)
+                )
+                # The snippet marks matches with control characters; turn them into the highlight tag
+                highlighted = False
+                for part in re.split('([\x02\x03])', result['snippet'].replace('\n', ' ')):
+                    if part == SearchIndex.HIGHLIGHT_START:
+                        highlighted = True
+                    elif part == SearchIndex.HIGHLIGHT_END:
+                        highlighted = False
+                    elif part:
+                        results_text.insert(tk.END, part, ('match', result_tag) if highlighted else (result_tag,))
+                results_text.insert(tk.END, "\n\n")
+                results_text.tag_bind(result_tag, '<Button-1>', lambda e, sid=result['session_id']: open_result(sid))
+                results_text.tag_bind(result_tag, '<Enter>', lambda e: results_text.config(cursor='hand2'))
+                results_text.tag_bind(result_tag, '<Leave>', lambda e: results_text.config(cursor=''))
+            if not results:
+                results_text.insert(tk.END, "No matching messages.")
+            results_text.config(state='disabled')
+            search_status.config(text=f"{len(results)} results in {elapsed_ms:.1f} ms. Click a result to open it.")
+
+        pending_search = []
+        def schedule_search(*args):
+            # Debounce typing so only the last keystroke runs a query
+            if pending_search:
+                history_window.after_cancel(pending_search.pop())
+            pending_search.append(history_window.after(150, run_search))
+
+        query_var.trace_add('write', schedule_search)
+        model_filter.trace_add('write', schedule_search)
+        role_filter.trace_add('write', schedule_search)
+        search_entry.focus_set()
+
+        button_frame = tk.Frame(history_window, bg=current_theme_colors["bg_main"])
+        button_frame.grid(row=2, column=0, sticky="ew", padx=10, pady=10)
+        tk.Button(
+            button_frame, text="Open", command=open_selected, relief=tk.FLAT, padx=5,
+            bg=current_theme_colors["btn_history_bg"], fg=current_theme_colors["btn_history_fg"],
+            activebackground=current_theme_colors["btn_history_bg"]
+        ).pack(side=tk.LEFT, padx=(0, 10))
+        tk.Button(
+            button_frame, text="Delete", command=delete_selected, relief=tk.FLAT, padx=5,
+            bg=current_theme_colors["btn_clear_bg"], fg=current_theme_colors["btn_clear_fg"],
+            activebackground=current_theme_colors["btn_clear_bg"]
+        ).pack(side=tk.LEFT)
+        for text, command in (("Import...", import_file), ("Export Archive...", export_selected)):
+            tk.Button(
+                button_frame, text=text, command=command, relief=tk.FLAT, padx=5,
+                bg=current_theme_colors["btn_history_bg"], fg=current_theme_colors["btn_history_fg"],
+                activebackground=current_theme_colors["btn_history_bg"]
+            ).pack(side=tk.RIGHT, padx=(10, 0))
+
+        populate()
+        self.update_status(f"Chat history window displayed ({len(self.library.sessions)} conversations).")
+
+    def open_session(self, session_id):
+        """Switches the chat view to a saved conversation, loading its messages on demand."""
+        if self.stream_buffer is not None:
+            self.update_status("Wait for the current response to finish before switching conversations.")
             return
-            
-        messages = data.get('messages', [])
-        model_name = data.get('model', 'Unknown Model')
-        current_theme_colors = COLOR_SCHEMES[self.current_theme.get()] 
+        self.save_history()
+        self._set_controls_state(enabled=False, show_stop=False)
+        self._run_on_writer(lambda: self.library.open_session(session_id), self._on_session_opened)
 
-        history_text = scrolledtext.ScrolledText(
-            history_window, 
-            wrap=tk.WORD, 
-            state='disabled', 
-            padx=10, 
-            pady=10,
-            bg=current_theme_colors["chat_bg"], 
-            fg=current_theme_colors["fg_text"] 
-        )
-        history_text.grid(row=0, column=0, sticky="nsew")
+    def _on_session_opened(self, result, error):
+        self._set_controls_state(enabled=True)
+        if error is not None:
+            messagebox.showerror("Error", f"Could not load conversation. {error}")
+            return
+        self._restore_session(*result)
 
-        history_text.config(state='normal')
-        
-        history_text.insert(tk.END, f"--- Current Active Model: {model_name} ---\n\n", 'header')
-        
-        if len(messages) <= 1:
-            history_text.insert(tk.END, "No user messages found in the current history.", 'normal')
-        else:
-            first_user_message = next((m for m in messages if m['role'] == 'user'), None)
-            
-            if first_user_message:
-                summary = first_user_message['content']
-                # The prompt from the user could be long, only show a snippet
-                summary = summary.replace('\n', ' ')
-                if len(summary) > 100:
-                    summary = summary[:97] + '...'
-
-                history_text.insert(tk.END, "Last Conversation Summary:\n", 'bold')
-                history_text.insert(tk.END, f"Model: {model_name}\n", 'normal')
-                history_text.insert(tk.END, f"First Request: \"{summary}\"\n", 'normal')
-                history_text.insert(tk.END, f"Total Turns: {len(messages) - 1}\n\n", 'normal')
-            else:
-                history_text.insert(tk.END, "History only contains the system prompt.", 'normal')
-            
 
-        history_text.config(state='disabled')
-        
-        # Configure tags for history window
-        history_text.tag_configure('header', font='Arial 12 bold', foreground=current_theme_colors["btn_history_bg"], justify='center')
-        history_text.tag_configure('bold', font='Arial 10 bold', foreground=current_theme_colors["fg_text"])
-        history_text.tag_configure('normal', font='Arial 10', foreground=current_theme_colors["fg_text"])
-        
-        self.update_status(f"Chat history window displayed.")
+    # --- GUI & Formatting Methods ---
+    def show_metrics_window(self):
+        """Opens a Toplevel window with per-model latency percentiles and the most recent turns."""
+        metrics_window = tk.Toplevel(self.master)
+        metrics_window.title("Performance Metrics")
+        metrics_window.geometry("900x500")
+        metrics_window.option_add('*Font', 'Arial 10')
+        metrics_window.grid_rowconfigure(1, weight=1)
+        metrics_window.grid_rowconfigure(3, weight=2)
+        metrics_window.grid_columnconfigure(0, weight=1)
+        current_theme_colors = COLOR_SCHEMES[self.current_theme.get()]
+        metrics_window.config(bg=current_theme_colors["bg_main"])
+
+        def heading(text, row):
+            tk.Label(
+                metrics_window, text=text, anchor=tk.W, font='Arial 10 bold',
+                bg=current_theme_colors["bg_main"], fg=current_theme_colors["fg_text"]
+            ).grid(row=row, column=0, sticky="ew", padx=10, pady=(10, 0))
+
+        def fmt(value, digits=0):
+            return "-" if value is None else f"{value:.{digits}f}"
+
+        # Per-model percentiles (p50 / p90 / p99)
+        heading("Per model (p50 / p90 / p99, cached replies excluded)", 0)
+        summary_columns = ('model', 'turns', 'first_token_ms', 'tokens_per_sec', 'itl_p50_ms', 'itl_p99_ms', 'render_max_ms', 'save_ms')
+        summary_tree = ttk.Treeview(metrics_window, columns=summary_columns, show='headings', height=5)
+        for column, text, width in (
+            ('model', "Model", 120), ('turns', "Turns", 50), ('first_token_ms', "First token ms", 130),
+            ('tokens_per_sec', "Tok/s", 110), ('itl_p50_ms', "Token gap p50 ms", 120),
+            ('itl_p99_ms', "Token gap p99 ms", 120), ('render_max_ms', "Frame render ms", 120), ('save_ms', "Save ms", 110),
+        ):
+            summary_tree.heading(column, text=text)
+            summary_tree.column(column, width=width, anchor=tk.W)
+        summary_tree.grid(row=1, column=0, sticky="nsew", padx=10)
 
+        # Recent turns, newest first
+        heading("Recent turns", 2)
+        turn_columns = ('time', 'model', 'outcome', 'first_token_ms', 'tokens', 'tokens_per_sec', 'itl_p90_ms', 'render_ms', 'save_ms')
+        turn_tree = ttk.Treeview(metrics_window, columns=turn_columns, show='headings')
+        for column, text, width in (
+            ('time', "Time", 80), ('model', "Model", 120), ('outcome', "Outcome", 90),
+            ('first_token_ms', "First token ms", 100), ('tokens', "Tokens", 60), ('tokens_per_sec', "Tok/s", 60),
+            ('itl_p90_ms', "Token gap p90 ms", 110), ('render_ms', "Render ms", 80), ('save_ms', "Save ms", 70),
+        ):
+            turn_tree.heading(column, text=text)
+            turn_tree.column(column, width=width, anchor=tk.W)
+        turn_tree.grid(row=3, column=0, sticky="nsew", padx=10)
+
+        def refresh():
+            summary_tree.delete(*summary_tree.get_children())
+            for model, row in sorted(self.telemetry.summary().items()):
+                summary_tree.insert('', tk.END, values=[model, row['turns']] + [
+                    ' / '.join(fmt(v, 1 if field == 'tokens_per_sec' else 0) for v in row[field])
+                    for field in summary_columns[2:]
+                ])
+            turn_tree.delete(*turn_tree.get_children())
+            for record in reversed(self.telemetry.turns):
+                outcome = 'cached' if record['cached'] else record['outcome']
+                if record['warm'] and not record['cached']:
+                    outcome += ' (warm)'
+                turn_tree.insert('', tk.END, values=(
+                    time.strftime('%H:%M:%S', time.localtime(record['timestamp'])), record['model'], outcome,
+                    fmt(record['first_token_ms']), record['tokens'], fmt(record['tokens_per_sec'], 1),
+                    fmt(record['itl_p90_ms']), fmt(record['render_ms']), fmt(record['save_ms'], 1),
+                ))
+            writer = self.persistence.stats()
+            store = self.messages.stats()
+            writer_label.config(text=(
+                f"History writes: {writer['jobs']} ({writer['coalesced']} coalesced, {writer['index_writes']} index commits)"
+                f" | queue {writer['depth']} (max {writer['max_depth']})"
+                f" | latency p50 / p99 {fmt(writer['latency_p50_ms'], 1)} / {fmt(writer['latency_p99_ms'], 1)} ms"
+                f" | messages in RAM {store['resident']} / {store['messages']} ({store['resident_bytes'] / 1024:.0f} KB)"
+            ))
+
+        def export(kind):
+            path = filedialog.asksaveasfilename(
+                parent=metrics_window, defaultextension=f'.{kind}',
+                initialfile=f"ollama_metrics.{kind}", filetypes=[(kind.upper(), f'*.{kind}')]
+            )
+            if not path:
+                return
+            try:
+                if kind == 'csv':
+                    self.telemetry.export_csv(path)
+                else:
+                    self.telemetry.export_json(path)
+                self.update_status(f"Exported {len(self.telemetry.turns)} turns to {path}.")
+            except IOError as e:
+                messagebox.showerror("Export Failed", f"Could not write {path}. {e}", parent=metrics_window)
+
+        button_frame = tk.Frame(metrics_window, bg=current_theme_colors["bg_main"])
+        button_frame.grid(row=4, column=0, sticky="ew", padx=10, pady=10)
+        writer_label = tk.Label(
+            button_frame, anchor=tk.E, bg=current_theme_colors["bg_main"], fg=current_theme_colors["fg_text"]
+        )
+        writer_label.pack(side=tk.RIGHT)
+        for text, command in (("Refresh", refresh), ("Export CSV", lambda: export('csv')), ("Export JSON", lambda: export('json'))):
+            tk.Button(
+                button_frame, text=text, command=command, relief=tk.FLAT, padx=5,
+                bg=current_theme_colors["btn_history_bg"], fg=current_theme_colors["btn_history_fg"]
+            ).pack(side=tk.LEFT, padx=(0, 10))
+        refresh()
 
-    # --- GUI & Formatting Methods ---
     def update_status(self, message, clear_after=5000):
-        """Updates the status bar with a message."""
-        self.status_bar.config(text=message)
+        """Updates the status bar with a message. Only one pending 'Ready' reset is kept."""
+        if self.status_bar.cget('text') != message:
+            self.status_bar.config(text=message)
+        if self._status_clear_job is not None:
+            self.master.after_cancel(self._status_clear_job)
+            self._status_clear_job = None
         if clear_after > 0:
-            self.master.after(clear_after, lambda: self.status_bar.config(text="Ready"))
+            self._status_clear_job = self.master.after(clear_after, self._clear_status)
+
+    def _clear_status(self):
+        self._status_clear_job = None
+        self.status_bar.config(text="Ready")
 
-    def _configure_tags(self):
+    def _configure_tags(self, widget=None):
         """
         Configures all the display tags for chat bubbles, dynamically pulling colors
-        from the current theme.
+        from the current theme. Defaults to the main transcript.
         """
+        widget = widget or self.chat_history
         colors = COLOR_SCHEMES[self.current_theme.get()]
 
         # User (Right Aligned Bubble)
-        self.chat_history.tag_configure('user_bubble', 
+        widget.tag_configure('user_bubble', 
             background=colors["user_bubble_bg"], 
             foreground=colors["user_bubble_fg"], 
             spacing1=3, spacing3=3,
             rmargin=10 
         )
-        self.chat_history.tag_configure('user_label', 
+        widget.tag_configure('user_label', 
             justify='right',
             font='Arial 9 bold',
             spacing1=10, spacing3=0,
@@ -578,13 +4599,13 @@ class OllamaChatApp:
         )
 
         # Model (Left Aligned Bubble)
-        self.chat_history.tag_configure('model_bubble', 
+        widget.tag_configure('model_bubble', 
             background=colors["model_bubble_bg"], 
             foreground=colors["model_bubble_fg"], 
             spacing1=3, spacing3=3,
             lmargin1=10, lmargin2=10
         )
-        self.chat_history.tag_configure('model_label', 
+        widget.tag_configure('model_label', 
             justify='left',
             font='Arial 9 bold',
             spacing1=10, spacing3=0,
@@ -592,24 +4613,40 @@ class OllamaChatApp:
         )
         
         # System Messages (Center)
-        self.chat_history.tag_configure('system', foreground=colors["system_fg"], font='Arial 10 italic', justify='center')
+        widget.tag_configure('system', foreground=colors["system_fg"], font='Arial 10 italic', justify='center')
+
+        # Inline markdown emphasis
+        widget.tag_configure('bold', font='Arial 10 bold')
+        widget.tag_configure('italic', font='Arial 10 italic')
+        widget.tag_configure('inline_code', font='Courier 10', background=colors["chat_border"])
+        widget.tag_configure('heading1', font='Arial 14 bold', spacing1=6)
+        widget.tag_configure('heading2', font='Arial 12 bold', spacing1=4)
+        widget.tag_configure('heading3', font='Arial 11 bold', spacing1=2)
 
     def _on_chat_resize(self, event):
-        """Dynamically adjusts the margins for the chat bubbles on window resize."""
+        """<Configure> handler: coalesces a burst of resize events into one update."""
+        if self._resize_job is not None:
+            self.master.after_cancel(self._resize_job)
+        self._resize_job = self.master.after(RESIZE_DEBOUNCE_MS, self._apply_chat_width)
+
+    def _apply_chat_width(self):
+        """Adjusts the bubble margins and code block widths, only when the width actually changed."""
+        self._resize_job = None
         width = self.chat_history.winfo_width()
+        if width == self._chat_width:
+            return
+        self._chat_width = width
         margin = int(width * 0.40)
         if margin < 100: margin = 100 
         
         self.chat_history.tag_configure('user_bubble', lmargin1=margin, lmargin2=margin)
         self.chat_history.tag_configure('model_bubble', rmargin=margin)
-        
-        self._update_embedded_windows_stretch()
-            
-    def _update_embedded_windows_stretch(self):
-        """Ensures all embedded widgets (code blocks) stretch to fit the available width."""
-        for mark in self.chat_history.dump('1.0', tk.END, window=True):
-            if mark[2] == 'window':
-                self.master.after(0, self.chat_history.window_configure, mark[1], stretch=tk.YES)
+
+        # Embedded code blocks fill the bubble: the chat's padding on both sides, the wide margin
+        # set above, the bubble's 10 px margin on its other side, then the block's own chrome
+        available = width - 2 * int(self.chat_history.cget('padx')) - margin - 10
+        char_px = self.code_block_pool.code_font.measure('0') or 7
+        self.code_block_pool.fit_width(max(20, (available - CodeBlockPool.CHROME_PX) // char_px))
             
     def insert_system_message(self, message):
         """Inserts a non-bubble system message."""
@@ -618,113 +4655,25 @@ class OllamaChatApp:
         self.chat_history.config(state='disabled')
         self.chat_history.see(tk.END)
 
-    def insert_formatted_response(self, text, role, redraw=False, is_final_insert=False):
+    def insert_formatted_response(self, text, role, redraw=False, index=tk.END):
         """
-        Splits the text into parts, inserts labels, and handles code blocks.
-        This function handles static display (user message, redraw, final AI message).
+        Inserts the speaker label and renders a complete message (user message, redraw)
+        by replaying its cached display list. Returns the code blocks created.
         """
-        tag_bubble = f'{role}_bubble'
         tag_label = f'{role}_label'
         speaker_label = "[You]:" if role == 'user' else "[Model]:"
         
         if not redraw:
             self.chat_history.config(state='normal')
         
-        # Insert speaker label only once 
-        if redraw or role == 'user' or is_final_insert:
-             self.chat_history.insert(tk.END, f"\n{speaker_label}\n", tag_label)
-        
-        if is_final_insert or redraw or role == 'user':
-            # Code block regex: captures language and code content
-            code_block_pattern = r'```(?P<language>[a-zA-Z0-9]+)?\s*\n(?P<code>[\s\S]*?)\n```'
-            parts = re.split(code_block_pattern, text)
-            
-            i = 0
-            while i < len(parts):
-                text_part = parts[i]
-                if text_part is not None and text_part.strip():
-                    processed_text = text_part.strip()
-                    # Remove markdown bold/italic markers for display consistency in Tkinter Text widget
-                    processed_text = re.sub(r'\*\*([^\*]+)\*\*', r'\1', processed_text)
-                    processed_text = re.sub(r'\*([^\*]+)\*', r'\1', processed_text)
-                    
-                    self.chat_history.insert(tk.END, processed_text + '\n', tag_bubble)
-                i += 1
-                
-                if i < len(parts) and parts[i] is not None and i + 1 < len(parts):
-                    # Handle Code Block: parts[i] is language, parts[i+1] is code
-                    language = parts[i] if parts[i] else "Code"
-                    code_content = parts[i+1].strip()
-                    self._insert_code_frame(code_content, language)
-                    i += 2 
-                else:
-                    break 
-        else:
-            # For streaming, insert the raw content
-            self.chat_history.insert(tk.END, text, tag_bubble)
-
+        self.chat_history.insert(index, f"\n{speaker_label}\n", tag_label)
+        sink = ChatRenderSink(self, self.chat_history, f'{role}_bubble', index=index, pool=self.code_block_pool, lazy=True)
+        replay_display_list(self.markdown_cache.render(text, f'{role}_bubble'), sink)
 
         if not redraw:
             self.chat_history.config(state='disabled')
             self.chat_history.see(tk.END)
-
-    def _insert_code_frame(self, code_content, language="Code"):
-        """
-        Inserts a Tkinter Frame widget containing the code (using ScrolledText for scrollable view) 
-        and a copy button.
-        """
-        colors = COLOR_SCHEMES[self.current_theme.get()] 
-
-        self.chat_history.insert(tk.END, '\n')
-        
-        # Outer wrapper frame (for alignment and stretch)
-        code_wrapper_frame = tk.Frame(self.chat_history, padx=10, pady=5)
-        
-        # Inner frame containing header, code, and button
-        frame = tk.Frame(code_wrapper_frame, bg=colors["code_bg"], relief=tk.RAISED, borderwidth=1) 
-        frame.pack(fill=tk.X, expand=True) 
-        
-        # Header for Language and Copy Button
-        header_frame = tk.Frame(frame, bg=colors["code_bg"])
-        header_frame.pack(fill=tk.X, pady=(0, 2))
-        
-        tk.Label(
-            header_frame,
-            text=language,
-            font='Arial 8 italic',
-            fg=colors["code_fg"],
-            bg=colors["code_bg"],
-            anchor='w'
-        ).pack(side=tk.LEFT, padx=5, pady=2)
-        
-        copy_button = tk.Button(
-            header_frame, 
-            text="Copy", 
-            command=lambda c=code_content: self.copy_to_clipboard(c), 
-            bg=colors["code_btn_bg"], fg=colors["code_btn_fg"], activebackground=colors["code_btn_bg"], 
-            padx=5, pady=0, font='Arial 8'
-        )
-        copy_button.pack(side=tk.RIGHT, padx=5, pady=2)
-
-        # ScrolledText widget for code content (handles horizontal scrolling)
-        code_display = scrolledtext.ScrolledText(
-            frame, 
-            wrap=tk.NONE, # Important: disables word wrap
-            height=min(10, len(code_content.split('\n')) + 1), # Max 10 lines, but adapt to content
-            font='Courier 9', 
-            fg=colors["code_fg"], 
-            bg=colors["code_bg"],
-            borderwidth=0,
-            relief='flat',
-            insertbackground=colors["code_fg"],
-            padx=5, pady=5
-        )
-        code_display.insert(tk.END, code_content)
-        code_display.config(state='disabled')
-        code_display.pack(fill=tk.BOTH, expand=True) 
-
-        self.chat_history.window_create(tk.END, window=code_wrapper_frame)
-        self.chat_history.insert(tk.END, '\n', 'model_bubble') # Insert spacing after code block
+        return sink.blocks
 
     def copy_to_clipboard(self, text):
         """Copies the given text (code block content) to the system clipboard."""
@@ -749,12 +4698,15 @@ class OllamaChatApp:
         self.user_input.see(tk.INSERT)
         return "break" # Prevents default behavior
 
-    def _set_controls_state(self, enabled=True):
+    def _set_controls_state(self, enabled=True, show_stop=True):
         """Enables/disables UI controls based on the chat state."""
         state = 'normal' if enabled else 'disabled'
-        self.user_input.config(state=state)
-        self.send_button.config(state=state)
+        # While a reply streams, further prompts can still be typed and are queued
+        input_state = 'normal' if enabled or show_stop else 'disabled'
+        self.user_input.config(state=input_state)
+        self.send_button.config(state=input_state)
         self.model_combo.config(state='readonly' if enabled else 'disabled')
+        self.context_combo.config(state='readonly' if enabled else 'disabled')
         self.new_chat_button.config(state=state)
         self.clear_history_button.config(state=state)
         self.history_button.config(state=state)
@@ -762,94 +4714,147 @@ class OllamaChatApp:
         
         # Toggle Send/Stop buttons
         if enabled:
-            self.send_button.pack(side=tk.LEFT, padx=(5, 0), anchor=tk.S)
             self.stop_button.pack_forget()
-        else:
-            self.send_button.pack_forget()
+        elif show_stop:
             self.stop_button.pack(side=tk.LEFT, padx=(5, 0), anchor=tk.S)
 
     def stop_generation(self):
-        """Sets the stop event to halt the background thread."""
+        """Cancels the in-flight request, which closes the HTTP stream so the server stops generating."""
         self.stop_event.set()
+        if self.active_request is not None:
+            self.active_request.cancel()
         self.update_status("Stopping model generation...")
 
     def send_message(self):
-        """Main function to trigger message processing and API call."""
+        """Queues the typed prompt; it starts right away unless a reply is still streaming."""
         user_prompt = self.user_input.get('1.0', tk.END).strip()
         self.user_input.delete('1.0', tk.END)
 
         if not user_prompt:
             return
 
+        self.warmup.touch()
+        # The transcript is one conversation for the scheduler, so its prompts run in order
+        job = self.scheduler.submit(
+            lambda job: self._start_prompt(job, user_prompt),
+            priority=JobScheduler.INTERACTIVE, conversation='chat', kind='prompt', label=user_prompt
+        )
+        if job.state == 'queued':
+            wait = self.scheduler.estimate_waits().get(job.id, 0.0)
+            self.update_status(f"Prompt queued ({len(self.scheduler.queued())} waiting, ~{wait:.0f} s).")
+
+    def _start_prompt(self, job, user_prompt):
+        """Runs a prompt job: appends the message and starts streaming the reply."""
+        self._prompt_job = job
         self._set_controls_state(enabled=False)
         self.stop_event.clear() # Clear any previous stop signal
         self.last_user_prompt = user_prompt
         self.update_status(f"Sending prompt to {self.current_model.get()}...")
 
+        # Jump back to the latest messages if an older page is being viewed
+        if self._rendered_end < len(self.messages):
+            self.redraw_history()
+
         # Add user message to history and display
         user_message = {'role': 'user', 'content': user_prompt}
         self.messages.append(user_message)
-        self.insert_formatted_response(user_prompt, 'user', is_final_insert=True)
-        self.save_history() # Save history after user message
+        self.chat_history.config(state='normal')
+        self._render_message(len(self.messages) - 1, tk.END)
+        self._rendered_end = len(self.messages)
+        self._record_message(user_message) # Journal the user message
 
-        # Start a new thread for the API call to keep the UI responsive
-        threading.Thread(target=self._get_model_response, daemon=True).start()
+        # Insert the model label; the reply is rendered incrementally below it
+        self.current_model_response = ""
+        reply_mark = f'msg_{len(self.messages)}'
+        self.chat_history.mark_set(reply_mark, 'end-1c')
+        self.chat_history.mark_gravity(reply_mark, tk.LEFT)
+        self.chat_history.insert(tk.END, f"\n[Model]:\n", 'model_label')
+        self.chat_history.config(state='disabled')
+        self.chat_history.see(tk.END)
+        self.stream_renderer = StreamingMarkdownRenderer(
+            ChatRenderSink(self, self.chat_history, 'model_bubble', pool=self.code_block_pool), 'model_bubble'
+        )
 
-    def _get_model_response(self):
+        # The client only fills the buffer; the Tk-side pump renders it at STREAM_FRAME_RATE
+        self.stream_buffer = StreamBuffer()
+        self._get_model_response(self.current_model.get(), self.messages[:], self.stream_buffer)
+        self._last_frame_time = time.monotonic()
+        self.master.after(self.frame_interval_ms, self._pump_stream)
+
+    def _get_model_response(self, model, chat_messages, stream_buffer):
         """
-        Runs in a separate thread. Calls the Ollama API and handles streaming.
+        Submits the chat through the engine. Chunks are pushed into the buffer from the
+        client's event-loop thread; no Tk calls are made from there.
         """
-        model = self.current_model.get()
-        assistant_message = {'role': 'assistant', 'content': ''}
-        self.current_model_response = ""
+        self.active_request = self.engine.start_reply(
+            model, chat_messages, stream_buffer, use_cache=self.use_response_cache.get()
+        )
 
-        # Prepare messages for Ollama API (exclude the final system message display)
-        chat_messages = self.messages[:] 
-        
-        # Insert initial label for streaming
-        self.master.after(0, lambda: self.chat_history.config(state='normal'))
-        self.master.after(0, lambda: self.chat_history.insert(tk.END, f"\n[Model]:\n", 'model_label'))
-        self.master.after(0, lambda: self.chat_history.config(state='disabled'))
-        
-        self.streaming_start_index = self.chat_history.index(tk.END + '-1c') # Set start point for text
+    def _pump_stream(self):
+        """
+        Tk-side render loop. Drains the stream buffer once per frame with a single insert,
+        then reschedules itself until the worker closes the stream.
+        """
+        buffer = self.stream_buffer
+        if buffer is None:
+            return
 
-        try:
-            # Note: The MockOllama implementation simulates stream=True
-            response_stream = ollama.chat(
-                model=model,
-                messages=chat_messages,
-                stream=True 
-            )
+        now = time.monotonic()
+        elapsed_ms = (now - self._last_frame_time) * 1000
+        self._last_frame_time = now
+        missed = int(elapsed_ms / self.frame_interval_ms) - 1
+        if missed > 0:
+            buffer.frames_dropped += missed
 
-            for chunk in response_stream:
-                if self.stop_event.is_set():
-                    break
-                    
-                content = chunk.get('message', {}).get('content', '')
-                if content:
-                    self.current_model_response += content
-                    # Use self.master.after to safely update the GUI from the thread
-                    self.master.after(0, self._stream_update, content)
-            
-            # Final processing after stream is finished or stopped
-            self.master.after(0, self._finalize_response)
+        content = buffer.drain()
+        if content:
+            self.current_model_response += content
+            self._stream_update(content)
+            buffer.frames_rendered += 1
 
-        except Exception as e:
-            error_message = f"API Error: Could not get response from Ollama server. Check server status. ({e})"
-            self.master.after(0, self.insert_system_message, error_message)
-            self.master.after(0, lambda: self.update_status("Error communicating with Ollama server.", clear_after=8000))
-            self.master.after(0, lambda: self._set_controls_state(enabled=True))
+        self.stream_stats = buffer.stats()
+
+        if not buffer.is_finished():
+            self.master.after(self.frame_interval_ms, self._pump_stream)
+            return
+
+        self.stream_buffer = None
+        self.active_request = None
+        self._last_stream = buffer
+        if buffer.error is not None:
+            self.chat_history.config(state='normal')
+            self.stream_renderer.close()
+            # The partial reply is not a message; release its blocks together with the prompt
+            self._message_blocks.setdefault(len(self.messages) - 1, []).extend(self.stream_renderer.sink.blocks)
+            self.stream_renderer = None
+            self.chat_history.config(state='disabled')
+            self.telemetry.add_turn(self.current_model.get(), buffer, outcome='error')
+            error_message = f"API Error: Could not get response from Ollama server. Check server status. ({buffer.error})"
+            self.insert_system_message(error_message)
+            self.update_status("Error communicating with Ollama server.", clear_after=8000)
+            self._set_controls_state(enabled=True)
+            self._finish_prompt_job(buffer)
+        else:
+            self._finalize_response()
             
     def _stream_update(self, content):
-        """Safely updates the ScrolledText widget with new content."""
+        """Safely updates the ScrolledText widget with new content (one call per frame)."""
+        started = time.perf_counter()
         self.chat_history.config(state='normal')
-        self.chat_history.insert(tk.END, content, 'model_bubble')
+        self.stream_renderer.feed(content)
         self.chat_history.config(state='disabled')
         self.chat_history.see(tk.END)
-        self.update_status(f"Streaming response from {self.current_model.get()}...")
+        self.stream_buffer.note_render((time.perf_counter() - started) * 1000)
+        stats = self.stream_buffer.stats()
+        self.update_status(
+            f"Streaming response from {self.current_model.get()}... "
+            f"sent ~{stats['context_tokens']} context tokens, "
+            f"{stats['tokens']} tokens, {stats['tokens_per_sec']:.1f} tok/s, "
+            f"queue {stats['queue_depth']}, dropped frames {stats['frames_dropped']}"
+        )
         
     def _finalize_response(self):
-        """Cleans up the final response and re-applies formatting."""
+        """Closes the incrementally rendered reply and records it. Nothing is redrawn."""
         
         # 1. Update the final assistant message content
         if not self.current_model_response.strip():
@@ -858,37 +4863,1317 @@ class OllamaChatApp:
             final_message = self.current_model_response
 
         # 2. Add the final message to history
-        self.messages.append({'role': 'assistant', 'content': final_message})
-        self.save_history()
+        assistant_message = {'role': 'assistant', 'content': final_message}
+        self.messages.append(assistant_message)
+        started = time.perf_counter()
+        self._record_message(assistant_message)
+        save_ms = (time.perf_counter() - started) * 1000
 
-        # 3. Redraw the final message with proper formatting (code blocks)
+        # 3. Flush held-back markers and close any open code block
+        started = time.perf_counter()
         self.chat_history.config(state='normal')
-        
-        # a. Remove the streamed text (this is faster than finding the block to replace)
-        if self.streaming_start_index:
-             # Find the start of the streamed text after the [Model]: label
-            start_stream = self.chat_history.index(self.streaming_start_index + "+1c") 
-            self.chat_history.delete(start_stream, tk.END)
-            self.streaming_start_index = None # Reset 
-        
-        # b. Re-insert the full, final, formatted message
-        self.insert_formatted_response(final_message, 'model', is_final_insert=True)
+        if final_message is not self.current_model_response:
+            self.stream_renderer.feed(final_message)
+        self.stream_renderer.close()
+        self._message_blocks[len(self.messages) - 1] = self.stream_renderer.sink.blocks
+        self._rendered_end = len(self.messages)
+        self.stream_renderer = None
+        self._trim_oldest()
+        self._update_page_markers()
+        self.chat_history.config(state='disabled')
+        self.chat_history.see(tk.END)
+        buffer = self._last_stream
+        buffer.note_render((time.perf_counter() - started) * 1000)
+        self.telemetry.add_turn(
+            self.current_model.get(), buffer, outcome='stopped' if self.stop_event.is_set() else 'complete', save_ms=save_ms
+        )
         
         # 4. Restore controls and status
         self._set_controls_state(enabled=True)
+        stats = self.stream_stats
+        first_token = ""
+        # Only complete, unstopped replies are cached
+        complete = not self.stop_event.is_set() and final_message is self.current_model_response
+        ttft_ms = self.engine.finish_reply(self.current_model.get(), buffer, final_message if complete else None)
+        if ttft_ms is not None:
+            first_token = (
+                f", first token {ttft_ms:.0f} ms {'warm' if buffer.model_warm else 'cold'} "
+                f"[{self._ttft_summary()}]"
+            )
+        summary = (
+            f"({stats.get('tokens', 0)} tokens, {stats.get('tokens_per_sec', 0.0):.1f} tok/s, "
+            f"sent ~{stats.get('context_tokens', 0)} context tokens in {stats.get('context_messages', 0)} messages"
+            f"{first_token})"
+        )
         if self.stop_event.is_set():
-            self.update_status("Generation stopped and response finalized.", clear_after=5000)
+            self.update_status(f"Generation stopped and response finalized. {summary}", clear_after=5000)
             self.stop_event.clear()
+        elif buffer.from_cache:
+            self.update_status(f"Response replayed from cache. {summary}", clear_after=5000)
+        else:
+            self.update_status(f"Response complete. {summary}", clear_after=5000)
+
+        # Queued prompts go first, then the summary catches up in the background
+        self._finish_prompt_job(buffer)
+        self._schedule_summary()
+
+    # --- Job Queue ---
+    def _finish_prompt_job(self, buffer):
+        job, self._prompt_job = self._prompt_job, None
+        if job is not None:
+            # Cache replays say nothing about the server's throughput
+            self.scheduler.finish(job, tokens=buffer.tokens_received, measure=not buffer.from_cache)
+
+    def _schedule_summary(self):
+        """With the rolling summary strategy, folds turns that no longer fit into the summary ahead of the next prompt."""
+        if self.context.strategy != 'rolling_summary':
+            return
+        messages, model = self.messages[:], self.current_model.get()
+
+        def start(job):
+            self._run_in_background(
+                lambda: self.context.build(messages, model, lambda m, p, e: summarize_turns(m, p, e, chat=self.client.chat)),
+                lambda result, error: self.scheduler.finish(job)
+            )
+
+        self.scheduler.submit(start, priority=JobScheduler.BACKGROUND, conversation='chat', kind='summary', label=model)
+
+    def _schedule_queue_refresh(self):
+        # Scheduler changes come in bursts (a finish starts the next job); redraw once
+        if self._queue_refresh_job is not None:
+            self.master.after_cancel(self._queue_refresh_job)
+        self._queue_refresh_job = self.master.after_idle(self._refresh_queue_panel)
+
+    def _refresh_queue_panel(self):
+        """Lists waiting jobs with their estimated wait. The panel is hidden while nothing waits."""
+        self._queue_refresh_job = None
+        queued = self.scheduler.queued()
+        if not queued:
+            if self._queue_shown:
+                self.queue_frame.pack_forget()
+                self._queue_shown = False
+            return
+
+        selection = self.queue_list.curselection()
+        selected_id = self._queue_job_ids[selection[0]] if selection else None
+        waits = self.scheduler.estimate_waits()
+        self.queue_list.delete(0, tk.END)
+        self._queue_job_ids = [job.id for job in queued]
+        for job in queued:
+            label = job.label.replace('\n', ' ')
+            if len(label) > 70:
+                label = label[:67] + '...'
+            self.queue_list.insert(tk.END, f"[{job.kind}] {label}  (starts in ~{waits[job.id]:.0f} s)")
+            if job.id == selected_id:
+                self.queue_list.selection_set(tk.END)
+        self.queue_list.config(height=min(len(queued), 4))
+        if not self._queue_shown:
+            self.queue_frame.pack(side=tk.TOP, fill=tk.X, pady=(0, 5), before=self.user_input)
+            self._queue_shown = True
+        # Estimates count down while jobs run
+        self._queue_refresh_job = self.master.after(1000, self._refresh_queue_panel)
+
+    def _cancel_queued_job(self):
+        selection = self.queue_list.curselection()
+        if not selection:
+            self.update_status("Select a queued job to cancel.")
+            return
+        if self.scheduler.cancel(self._queue_job_ids[selection[0]]):
+            self.update_status("Queued job cancelled.")
+
+# --- Batch Mode ---
+class BatchStream(StreamBuffer):
+    """StreamBuffer that also hands every chunk to `write` as it arrives and signals when it closes."""
+    def __init__(self, write=None):
+        super().__init__()
+        self._write = write
+        self.done = threading.Event()
+
+    def push(self, chunk):
+        super().push(chunk)
+        if self._write is not None:
+            self._write(chunk)
+
+    def close(self, error=None):
+        super().close(error)
+        self.done.set()
+
+
+class BatchRunner:
+    """
+    Runs a JSONL file of prompts through a ChatEngine without Tk. Each line is an object with a
+    "prompt" and optionally an "id" (defaults to the line number) and a "model". At most
+    `workers` prompts stream at once. Replies stream into `output_dir/<id>.md`, or to stdout
+    (live with one worker, whole replies otherwise so they do not interleave).
+
+    Every finished prompt is appended to the results file as one JSON line; resume skips the
+    ids recorded there without an error, so an interrupted run picks up where it stopped.
+    """
+    def __init__(self, engine, prompts_path, results_path=None, output_dir=None, model=DEFAULT_MODEL,
+                 workers=BATCH_WORKERS, use_cache=True, resume=False, out=None):
+        self.engine = engine
+        self.prompts_path = prompts_path
+        self.results_path = results_path or os.path.splitext(prompts_path)[0] + '.results.jsonl'
+        self.output_dir = output_dir
+        self.model = model
+        self.workers = max(1, workers)
+        self.use_cache = use_cache
+        self.resume = resume
+        self.out = out or sys.stdout
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()  # Serializes output and the results file
+        self._active = set()
+        self._cancelled = threading.Event()
+        self.records = []
+
+    def load_prompts(self):
+        """Parses the prompt file. Malformed lines are reported and skipped."""
+        prompts = []
+        with open(self.prompts_path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    prompt = entry['prompt']
+                except (json.JSONDecodeError, KeyError, TypeError) as e:
+                    print(f"Warning: Skipping line {number} of {self.prompts_path}. {e}", file=sys.stderr)
+                    continue
+                prompts.append({
+                    'id': str(entry.get('id', number)), 'prompt': prompt, 'model': entry.get('model') or self.model,
+                })
+        return prompts
+
+    def completed_ids(self):
+        """Ids already answered in the results file (a torn last line is ignored)."""
+        done = set()
+        try:
+            with open(self.results_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get('error') is None:
+                        done.add(record.get('id'))
+        except FileNotFoundError:
+            pass
+        return done
+
+    def run(self):
+        """Runs every pending prompt and returns the aggregate summary."""
+        prompts = self.load_prompts()
+        skipped = 0
+        if self.resume:
+            done = self.completed_ids()
+            pending = [p for p in prompts if p['id'] not in done]
+            skipped = len(prompts) - len(pending)
+        else:
+            pending = prompts
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+        for job in pending:
+            self._jobs.put(job)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(min(self.workers, len(pending)))]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.2)  # Short joins keep Ctrl+C responsive
+        except KeyboardInterrupt:
+            self.cancel()
+            for thread in threads:
+                thread.join(5.0)
+        return self.summary(time.perf_counter() - started, skipped)
+
+    def cancel(self):
+        """Stops taking new prompts and aborts the ones streaming. Finished results are kept."""
+        self._cancelled.set()
+        with self._lock:
+            requests = list(self._active)
+        for request in requests:
+            request.cancel()
+
+    def _worker(self):
+        while not self._cancelled.is_set():
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                return
+            self._run_prompt(job)
+
+    def _run_prompt(self, job):
+        model = job['model']
+        write, output = self._open_output(job)
+        buffer = BatchStream(write)
+        messages = self.engine.new_conversation(model) + [{'role': 'user', 'content': job['prompt']}]
+        request = self.engine.start_reply(model, messages, buffer, use_cache=self.use_cache, context=ContextWindowManager())
+        with self._lock:
+            self._active.add(request)
+        buffer.done.wait()
+        with self._lock:
+            self._active.discard(request)
+
+        text = buffer.drain()
+        error = buffer.error
+        if error is None and self._cancelled.is_set():
+            error = 'cancelled'
+        ttft_ms = self.engine.finish_reply(model, buffer, text if error is None else None)
+        if output is not None:
+            output.close()
+        elif write is None:
+            with self._lock:
+                self.out.write(f"### {job['id']} ({model})\n{text}\n")
+                self.out.flush()
+        elif error is not None:
+            write(f"\n[error: {error}]\n")
+
+        elapsed = time.monotonic() - buffer.started_at
+        self._record({
+            'id': job['id'], 'model': model, 'reply': text, 'error': None if error is None else str(error),
+            'cached': buffer.from_cache, 'tokens': buffer.tokens_received, 'seconds': round(elapsed, 3),
+            'first_token_ms': None if ttft_ms is None else round(ttft_ms, 1),
+            'tokens_per_sec': round(buffer.tokens_per_second(), 2),
+        })
+
+    def _open_output(self, job):
+        """Returns (write, file) for streaming one reply; write is None when replies are printed whole."""
+        if self.output_dir:
+            safe_id = re.sub(r'[^\w.-]', '_', job['id'])
+            output = open(os.path.join(self.output_dir, f'{safe_id}.md'), 'w', encoding='utf-8')
+            return output.write, output
+        if self.workers == 1:
+            self.out.write(f"### {job['id']} ({job['model']})\n")
+
+            def write(chunk):
+                self.out.write(chunk)
+                self.out.flush()
+
+            return write, None
+        return None, None
+
+    def _record(self, record):
+        with self._lock:
+            self.records.append(record)
+            with open(self.results_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            if self.output_dir is None and self.workers == 1:
+                self.out.write('\n')
+                self.out.flush()
+
+    def summary(self, elapsed, skipped=0):
+        ok = [r for r in self.records if r['error'] is None]
+        tokens = sum(r['tokens'] for r in ok)
+        first_tokens = [r['first_token_ms'] for r in ok if r['first_token_ms'] is not None]
+        return {
+            'prompts': len(self.records), 'failed': len(self.records) - len(ok), 'skipped': skipped,
+            'cached': sum(1 for r in ok if r['cached']), 'tokens': tokens, 'seconds': elapsed,
+            'prompts_per_sec': len(ok) / elapsed if elapsed > 0 else 0.0,
+            'tokens_per_sec': tokens / elapsed if elapsed > 0 else 0.0,
+            'first_token_ms_p50': percentile(first_tokens, 50), 'first_token_ms_p99': percentile(first_tokens, 99),
+        }
+
+    @staticmethod
+    def report(summary):
+        def fmt(value):
+            return "-" if value is None else f"{value:.0f}"
+        return (
+            f"{summary['prompts']} prompts ({summary['failed']} failed, {summary['cached']} cached, "
+            f"{summary['skipped']} already done) in {summary['seconds']:.1f} s: "
+            f"{summary['prompts_per_sec']:.2f} prompts/s, {summary['tokens_per_sec']:.1f} tok/s aggregate, "
+            f"first token p50 / p99 {fmt(summary['first_token_ms_p50'])} / {fmt(summary['first_token_ms_p99'])} ms"
+        )
+
+
+def run_batch(args):
+    """Entry point for --batch. Returns a process exit code (1 if any prompt failed)."""
+    global ollama
+    if args.mock:
+        ollama = MockOllama()
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache()
+        cache.load()
+    engine = ChatEngine(response_cache=cache)
+    runner = BatchRunner(
+        engine, args.batch, results_path=args.results, output_dir=args.output_dir, model=args.model,
+        workers=args.workers, use_cache=not args.no_cache, resume=args.resume
+    )
+    try:
+        summary = runner.run()
+    except IOError as e:
+        print(f"Error: Could not read {args.batch}. {e}", file=sys.stderr)
+        return 2
+    finally:
+        engine.close()
+    print(BatchRunner.report(summary), file=sys.stderr)
+    print(f"Results in {runner.results_path}.", file=sys.stderr)
+    return 1 if summary['failed'] else 0
+# --- End Batch Mode ---
+
+# --- Proxy Server ---
+class FairScheduler:
+    """
+    Admission control for proxy requests. Every client has its own FIFO queue and the queues
+    are served round-robin, so a client sending many prompts cannot starve the others. At
+    most max_concurrent requests run overall and per_client per client.
+    """
+    def __init__(self, max_concurrent=PROXY_MAX_CONCURRENT, per_client=PROXY_PER_CLIENT_CONCURRENT,
+                 max_queued=PROXY_MAX_QUEUED_PER_CLIENT):
+        self.max_concurrent = max_concurrent
+        self.per_client = per_client
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._waiting = {}  # client -> deque of tickets
+        self._rotation = deque()  # Clients with waiting tickets; the leftmost is served next
+        self._running = Counter()
+
+    def acquire(self, client):
+        """Blocks until the client may run a request. Returns the wait in ms, or None if its queue is full."""
+        ticket = {'granted': False}
+        with self._cond:
+            waiting = self._waiting.setdefault(client, deque())
+            if len(waiting) >= self.max_queued:
+                return None
+            started = time.perf_counter()
+            waiting.append(ticket)
+            if client not in self._rotation:
+                self._rotation.append(client)
+            self._dispatch()
+            while not ticket['granted']:
+                self._cond.wait()
+            return (time.perf_counter() - started) * 1000
+
+    def release(self, client):
+        with self._cond:
+            self._running[client] -= 1
+            if self._running[client] <= 0:
+                del self._running[client]
+            self._dispatch()
+
+    def _dispatch(self):
+        granted = False
+        while self._rotation and sum(self._running.values()) < self.max_concurrent:
+            for _ in range(len(self._rotation)):
+                client = self._rotation[0]
+                self._rotation.rotate(-1)  # Served clients go to the back
+                if self._running[client] < self.per_client:
+                    break
+            else:
+                break  # Every waiting client is at its own limit
+            waiting = self._waiting[client]
+            waiting.popleft()['granted'] = True
+            self._running[client] += 1
+            granted = True
+            if not waiting:
+                del self._waiting[client]
+                self._rotation.remove(client)
+        if granted:
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'running': dict(self._running),
+                'queued': {client: len(waiting) for client, waiting in self._waiting.items()},
+            }
+
+
+class ProxyRequestHandler(BaseHTTPRequestHandler):
+    """One HTTP request to the proxy (runs on its own thread)."""
+    server_version = 'OllamaChatProxy/1.0'
+
+    def log_message(self, format, *args):
+        pass  # Request metrics are served on /metrics instead
+
+    def _client_id(self):
+        return self.headers.get('X-Client-Id') or self.client_address[0]
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message, kind='invalid_request_error'):
+        self._send_json(status, {'error': {'message': message, 'type': kind}})
+
+    def _send_event(self, payload):
+        self.wfile.write(f"data: {payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == '/v1/models':
+            try:
+                entries = ModelCatalog.parse(ollama.list())
+            except Exception as e:
+                self._send_error(502, f"Ollama server unreachable. {e}", 'upstream_error')
+                return
+            self._send_json(200, {'object': 'list', 'data': [
+                {'id': entry['name'], 'object': 'model', 'owned_by': 'ollama'} for entry in entries
+            ]})
+        elif self.path == '/metrics':
+            self._send_json(200, self.server.proxy.stats())
+        else:
+            self._send_error(404, f"Unknown path {self.path}.")
+
+    def do_POST(self):
+        if self.path != '/v1/chat/completions':
+            self._send_error(404, f"Unknown path {self.path}.")
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            model = body['model']
+            messages = [{'role': m['role'], 'content': m.get('content') or ''} for m in body.get('messages', [])]
+            # Ollama extensions sent by thin clients; plain OpenAI clients omit them
+            keep_alive = body.get('keep_alive')
+            options = body.get('options')
+            if options is not None and not isinstance(options, dict):
+                raise TypeError("'options' must be an object")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._send_error(400, f"Malformed chat request. {e}")
+            return
+
+        proxy = self.server.proxy
+        if not messages:
+            # An empty chat only loads the model; warm state is shared by every client, and a
+            # client arriving while another warms the same model is answered once it has loaded
+            try:
+                proxy.engine.warmup.warm(model, keep_alive, wait=True)
+            except Exception as e:
+                proxy.fail(self._client_id())
+                self._send_error(502, f"Ollama request failed. {e}", 'upstream_error')
+                return
+            self._send_completion(model, '')
+            return
+
+        client = self._client_id()
+        wait_ms = proxy.scheduler.acquire(client)
+        if wait_ms is None:
+            proxy.reject(client)
+            self._send_error(429, "Too many queued requests from this client.", 'rate_limit_error')
+            return
+        try:
+            self._stream_reply(proxy, client, model, messages, wait_ms, bool(body.get('stream')), options, keep_alive)
+        finally:
+            proxy.scheduler.release(client)
+
+    def _stream_reply(self, proxy, client, model, messages, wait_ms, stream, options=None, keep_alive=None):
+        chunks = queue.Queue()
+        buffer = BatchStream(chunks.put)
+        # Clients trim their own context; the proxy sends what it is given
+        request = proxy.engine.start_reply(
+            model, messages, buffer, use_cache=proxy.use_cache, context=ContextWindowManager(strategy='full'),
+            options=options, keep_alive=keep_alive
+        )
+        completion_id = f"chatcmpl-{os.urandom(12).hex()}"
+        disconnected = False
+        if stream:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                while not (buffer.done.is_set() and chunks.empty()):
+                    try:
+                        chunk = chunks.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    self._send_event(self._chunk(completion_id, model, {'content': chunk}))
+            except OSError:
+                # Client went away: stop generating for it
+                disconnected = True
+                request.cancel()
+                buffer.done.wait()
         else:
-            self.update_status("Response complete.", clear_after=5000)
+            buffer.done.wait()
+
+        text = buffer.drain()
+        error = buffer.error
+        complete = error is None and not disconnected
+        proxy.engine.finish_reply(model, buffer, text if complete else None)
+        proxy.record(client, wait_ms, buffer, error if not disconnected else 'disconnected')
+        if disconnected:
+            return
+        try:
+            if stream:
+                if error is not None:
+                    self._send_event({'error': {'message': str(error), 'type': 'upstream_error'}})
+                else:
+                    self._send_event(self._chunk(completion_id, model, {}, 'stop'))
+                self._send_event('[DONE]')
+            elif error is not None:
+                self._send_error(502, f"Ollama request failed. {error}", 'upstream_error')
+            else:
+                self._send_completion(model, text, completion_id)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _chunk(completion_id, model, delta, finish_reason=None):
+        return {
+            'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+        }
+
+    def _send_completion(self, model, text, completion_id=None):
+        self._send_json(200, {
+            'id': completion_id or f"chatcmpl-{os.urandom(12).hex()}", 'object': 'chat.completion',
+            'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        })
+
+
+class ProxyServer:
+    """
+    Local OpenAI-compatible streaming endpoint in front of one Ollama server:
+    POST /v1/chat/completions (SSE when "stream" is true), GET /v1/models and GET /metrics.
+    Every client shares one ChatEngine, so the response cache and warm-model state are shared,
+    and a FairScheduler decides whose request runs next. Clients identify themselves with an
+    X-Client-Id header (by default, their address).
+    """
+    def __init__(self, engine, host=PROXY_HOST, port=PROXY_PORT, scheduler=None, use_cache=True):
+        self.engine = engine
+        self.scheduler = scheduler or FairScheduler()
+        self.use_cache = use_cache
+        self.httpd = ThreadingHTTPServer((host, port), ProxyRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.proxy = self
+        self._thread = None
+        # Metrics
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = Counter()
+        self.rejected = Counter()
+        self.errors = 0
+        self.cached = 0
+        self.tokens = 0
+        self.wait_ms = deque(maxlen=TELEMETRY_MAX_TURNS)
+        self.first_token_ms = deque(maxlen=TELEMETRY_MAX_TURNS)
+        self.duration_ms = deque(maxlen=TELEMETRY_MAX_TURNS)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serves on a background thread."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='ollama-proxy', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def record(self, client, wait_ms, buffer, error):
+        with self._lock:
+            self.requests[client] += 1
+            self.wait_ms.append(wait_ms)
+            self.duration_ms.append((time.monotonic() - buffer.started_at) * 1000)
+            if error is not None:
+                self.errors += 1
+                return
+            self.tokens += buffer.tokens_received
+            if buffer.from_cache:
+                self.cached += 1
+            elif buffer.first_token_at is not None:
+                self.first_token_ms.append((buffer.first_token_at - buffer.started_at) * 1000)
+
+    def reject(self, client):
+        with self._lock:
+            self.rejected[client] += 1
+
+    def fail(self, client):
+        """Counts a request that failed before any reply was streamed (e.g. a warm-up)."""
+        with self._lock:
+            self.requests[client] += 1
+            self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            wait, first, duration = list(self.wait_ms), list(self.first_token_ms), list(self.duration_ms)
+            stats = {
+                'uptime_s': time.time() - self.started_at, 'requests': sum(self.requests.values()),
+                'errors': self.errors, 'cached': self.cached, 'rejected': sum(self.rejected.values()),
+                'tokens': self.tokens, 'clients': {
+                    client: {'requests': self.requests[client], 'rejected': self.rejected[client]}
+                    for client in set(self.requests) | set(self.rejected)
+                },
+            }
+        stats.update({
+            'queue_wait_ms_p50': percentile(wait, 50), 'queue_wait_ms_p99': percentile(wait, 99),
+            'first_token_ms_p50': percentile(first, 50), 'first_token_ms_p99': percentile(first, 99),
+            'duration_ms_p50': percentile(duration, 50), 'duration_ms_p99': percentile(duration, 99),
+            'scheduler': self.scheduler.snapshot(), 'warm_models': sorted(
+                model for model in self.engine.warmup.load_ms if self.engine.warmup.is_warm(model)
+            ),
+        })
+        return stats
+
+
+class OllamaProxyClient:
+    """
+    Stands in for the ollama module when the GUI is a thin client of a --serve proxy: list()
+    and chat() (streamed or not) go to the proxy's OpenAI-compatible endpoints over HTTP.
+    """
+    def __init__(self, base_url, client_id=None, timeout=PROXY_CLIENT_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.client_id = client_id
+        self.timeout = timeout
+
+    def _open(self, path, payload=None):
+        headers = {'Content-Type': 'application/json'}
+        if self.client_id:
+            headers['X-Client-Id'] = self.client_id
+        data = None if payload is None else json.dumps(payload).encode('utf-8')
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                detail = json.load(e)['error']['message']
+            except (ValueError, KeyError, TypeError):
+                detail = e.reason
+            raise ConnectionError(f"Proxy answered {e.code}: {detail}") from None
+
+    def list(self):
+        with self._open('/v1/models') as response:
+            data = json.load(response)
+        return {'models': [{'name': entry['id']} for entry in data.get('data', [])]}
+
+    def chat(self, model, messages, stream=False, keep_alive=None, options=None, **kwargs):
+        if kwargs:
+            raise TypeError(f"The proxy does not support {', '.join(sorted(kwargs))}.")
+        payload = {'model': model, 'messages': messages, 'stream': bool(stream)}
+        if keep_alive is not None:
+            payload['keep_alive'] = keep_alive
+        if options:
+            payload['options'] = options
+        response = self._open('/v1/chat/completions', payload)
+        if stream:
+            return self._stream(response)
+        with response:
+            data = json.load(response)
+        return {'message': {'role': 'assistant', 'content': data['choices'][0]['message']['content']}}
+
+    @staticmethod
+    def _stream(response):
+        with response:
+            for line in response:
+                line = line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    return
+                event = json.loads(data)
+                if 'error' in event:
+                    raise ConnectionError(event['error'].get('message'))
+                content = event['choices'][0]['delta'].get('content')
+                if content:
+                    yield {'message': {'content': content}}
+
+
+def run_server(args):
+    """Entry point for --serve. Serves until interrupted."""
+    global ollama
+    if args.mock:
+        ollama = MockOllama()
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache()
+        cache.load()
+    engine = ChatEngine(response_cache=cache)
+    try:
+        proxy = ProxyServer(engine, host=args.host, port=args.port, use_cache=not args.no_cache)
+    except OSError as e:
+        print(f"Error: Could not listen on {args.host}:{args.port}. {e}", file=sys.stderr)
+        engine.close()
+        return 2
+    print(f"Proxy listening on {proxy.url} (OpenAI-compatible: {proxy.url}/v1/chat/completions, metrics: {proxy.url}/metrics)", flush=True)
+    try:
+        proxy.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.httpd.server_close()
+        engine.close()
+    return 0
+# --- End Proxy Server ---
+
+# --- Benchmark Harness ---
+class BenchmarkMock(MockOllama):
+    """
+    MockOllama with configurable performance: token rate, reply length, share of the reply
+    inside code blocks, timing jitter and error rate. Seeded, so runs are repeatable.
+    """
+    WORDS = ('the', 'model', 'stream', 'render', 'token', 'latency', 'buffer', 'frame', '**bold**', '*note*', '`code`')
+    CODE = ('for i in range(10):', '    total += values[i] * weight', 'if total > limit:', '    return None', 'print(total)')
+
+    def __init__(self, tokens_per_sec=200, reply_tokens=300, code_density=0.3, jitter=0.2, error_rate=0.0, seed=0,
+                 load_seconds=0.0):
+        self.load_seconds = load_seconds  # How long a warm-up (empty chat) takes to load a model
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.code_density = code_density
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def list(self):
+        return {'models': [{'name': 'bench-fast'}, {'name': 'bench-slow'}]}
+
+    def chat(self, model, messages, stream, **kwargs):
+        if not messages:
+            # Warm-up: load the model, or fail like a server that does not have it
+            time.sleep(self.load_seconds)
+            if model not in (entry['name'] for entry in self.list()['models']):
+                raise ConnectionError(f"model '{model}' not found")
+            return {'message': {'role': 'assistant', 'content': ''}}
+        tokens = self._reply_tokens()
+        fail_at = self.random.randrange(len(tokens)) if self.random.random() < self.error_rate else None
+        if stream:
+            return self._stream(tokens, fail_at)
+        if fail_at is not None:
+            raise ConnectionError("Simulated server error")
+        return {'message': {'role': 'assistant', 'content': ''.join(tokens)}}
+
+    def _reply_tokens(self):
+        tokens = []
+        while len(tokens) < self.reply_tokens:
+            if self.random.random() < self.code_density:
+                tokens.append('\n```python\n')
+                for _ in range(self.random.randint(3, 12)):
+                    tokens.extend(word + ' ' for word in self.random.choice(self.CODE).split(' '))
+                    tokens.append('\n')
+                tokens.append('```\n')
+            else:
+                tokens.extend(self.random.choice(self.WORDS) + ' ' for _ in range(self.random.randint(10, 30)))
+                tokens.append('\n\n')
+        return tokens[:self.reply_tokens]
+
+    def _stream(self, tokens, fail_at):
+        interval = 1.0 / self.tokens_per_sec
+        for i, token in enumerate(tokens):
+            if i == fail_at:
+                raise ConnectionError("Simulated server error mid-stream")
+            time.sleep(max(0.0, interval * (1 + self.random.uniform(-self.jitter, self.jitter))))
+            yield {'message': {'content': token}}
+
+
+class RecordingSink:
+    """Renderer sink without Tk: counts what would have been inserted."""
+    def __init__(self):
+        self.chars = 0
+        self.code_blocks = 0
+
+    def insert_text(self, text, tags):
+        self.chars += len(text)
+
+    def open_code(self, language):
+        self.code_blocks += 1
+
+    def append_code(self, text):
+        self.chars += len(text)
+
+    def close_code(self):
+        pass
+
+
+class BenchmarkSuite:
+    """
+    Scripted performance scenarios. Headless ones exercise the client, stream buffer, markdown
+    renderer, context manager and library directly; UI ones drive a real OllamaChatApp and are
+    skipped when no display is available. Results are compared against a stored baseline.
+    """
+    HIGHER_IS_BETTER = ('tokens_per_sec',)
+
+    def __init__(self, baseline_path=BENCHMARK_BASELINE_FILE):
+        self.baseline_path = os.path.abspath(baseline_path)
+        self.results = {}
+
+    def run(self):
+        global ollama, _ollama_module
+        saved_backend = (ollama, _ollama_module)
+        workdir = tempfile.mkdtemp(prefix='ollama_bench_')
+        cwd = os.getcwd()
+        os.chdir(workdir)  # All app files are relative to the working directory
+        try:
+            for name, scenario in (
+                ('stream_render', self.stream_render), ('huge_code_block', self.huge_code_block),
+                ('long_history', self.long_history), ('rapid_sends', self.rapid_sends),
+                ('proxy_fairness', self.proxy_fairness), ('proxy_warmup', self.proxy_warmup),
+                ('ui', self.ui_scenarios),
+            ):
+                ollama, _ollama_module = BenchmarkMock(), None
+                tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+                try:
+                    metrics = scenario()
+                except _SkipScenario as e:
+                    print(f"{name}: skipped ({e})")
+                    continue
+                finally:
+                    current, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                if isinstance(metrics, dict) and all(isinstance(v, dict) for v in metrics.values()):
+                    self.results.update(metrics)  # Several sub-scenarios
+                    continue
+                metrics['memory_growth_kb'] = (current - before) / 1024
+                metrics['memory_peak_kb'] = (peak - before) / 1024
+                self.results[name] = metrics
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+            ollama, _ollama_module = saved_backend
+        return self.results
+
+    # --- Headless scenarios ---
+    @staticmethod
+    def _stream_one(client, model, messages, renderer=None, frame_s=1.0 / STREAM_FRAME_RATE):
+        """Streams one reply through a StreamBuffer, draining it once per frame like the Tk pump."""
+        buffer = StreamBuffer()
+        client.stream_chat(model, messages, on_chunk=buffer.push, on_done=lambda error: buffer.close(error=error))
+        lags = []
+        while True:
+            content = buffer.drain()
+            if content:
+                lags.append(buffer.drain_lag_ms)
+                if renderer is not None:
+                    started = time.perf_counter()
+                    renderer.feed(content)
+                    buffer.note_render((time.perf_counter() - started) * 1000)
+            elif buffer.is_finished():
+                break
+            time.sleep(frame_s)
+        if renderer is not None:
+            renderer.close()
+        return buffer, lags
+
+    def stream_render(self):
+        """Several medium replies: first-token time, chunk-to-render latency, queue depth, throughput."""
+        client = AsyncOllamaClient()
+        first_tokens, lags, depth, rates, render = [], [], 0, [], []
+        try:
+            for _ in range(5):
+                renderer = StreamingMarkdownRenderer(RecordingSink(), 'model_bubble')
+                buffer, frame_lags = self._stream_one(client, 'bench-fast', [{'role': 'user', 'content': 'hi'}], renderer)
+                first_tokens.append((buffer.first_token_at - buffer.started_at) * 1000)
+                lags.extend(frame_lags)
+                depth = max(depth, buffer.max_queue_depth)
+                rates.append(buffer.tokens_per_second())
+                render.append(buffer.render_max_ms)
+        finally:
+            client.close()
+        return {
+            'first_token_ms_p50': percentile(first_tokens, 50), 'render_latency_ms_p99': percentile(lags, 99),
+            'max_queue_depth': depth, 'tokens_per_sec': sum(rates) / len(rates), 'frame_render_ms_max': max(render),
+        }
+
+    def huge_code_block(self):
+        """One very long reply that is almost entirely code, rendered as fast as it arrives."""
+        global ollama
+        ollama = BenchmarkMock(tokens_per_sec=20000, reply_tokens=20000, code_density=1.0, jitter=0.0)
+        client = AsyncOllamaClient()
+        try:
+            renderer = StreamingMarkdownRenderer(RecordingSink(), 'model_bubble')
+            buffer, lags = self._stream_one(client, 'bench-fast', [{'role': 'user', 'content': 'code'}], renderer)
+        finally:
+            client.close()
+        return {
+            'render_total_ms': buffer.render_ms, 'frame_render_ms_max': buffer.render_max_ms,
+            'render_latency_ms_p99': percentile(lags, 99), 'max_queue_depth': buffer.max_queue_depth,
+        }
+
+    def long_history(self):
+        """A 2,000-message conversation: context building, journal appends, sync and reload."""
+        mock = BenchmarkMock(reply_tokens=120)
+        messages = [{'role': 'system', 'content': "You are a helpful assistant."}]
+        for i in range(1000):
+            messages.append({'role': 'user', 'content': f"Question {i}: " + ''.join(mock._reply_tokens()[:40])})
+            messages.append({'role': 'assistant', 'content': ''.join(mock._reply_tokens())})
+
+        context = ContextWindowManager(strategy='sliding_window')
+        started = time.perf_counter()
+        context.build(messages, 'bench-fast')
+        build_cold = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        context.build(messages, 'bench-fast')
+        build_warm = (time.perf_counter() - started) * 1000
+
+        library = ConversationLibrary()
+        library.load()
+        library.create_session('bench-fast', messages[:1])
+        save_times = []
+        for message in messages[1:]:
+            started = time.perf_counter()
+            library.record_message(message)
+            save_times.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        library.sync()
+        sync_ms = (time.perf_counter() - started) * 1000
+        session_id = library.current_id
+        started = time.perf_counter()
+        library.open_session(session_id)
+        reload_ms = (time.perf_counter() - started) * 1000
+
+        # The same writes through the background writer, as the app does them
+        writer = PersistenceWriter(library)
+        submit_times = []
+        for message in messages[1:]:
+            started = time.perf_counter()
+            writer.submit(lambda message=message: library.record_message(message))
+            submit_times.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        writer.close()
+        drain_ms = (time.perf_counter() - started) * 1000
+        library.close()
+        return {
+            'context_build_ms': build_cold, 'context_rebuild_ms': build_warm, 'save_ms_p50': percentile(save_times, 50),
+            'save_ms_p99': percentile(save_times, 99), 'sync_ms': sync_ms, 'reload_ms': reload_ms,
+            'writer_submit_ms_p50': percentile(submit_times, 50), 'writer_submit_ms_p99': percentile(submit_times, 99),
+            'writer_drain_ms': drain_ms,
+        }
+
+    def rapid_sends(self):
+        """Twenty short requests fired back to back; the client's semaphore queues the excess."""
+        global ollama
+        ollama = BenchmarkMock(reply_tokens=60)
+        client = AsyncOllamaClient()
+        buffers = []
+        started = time.monotonic()
+        try:
+            for i in range(20):
+                buffer = StreamBuffer()
+                client.stream_chat('bench-fast', [{'role': 'user', 'content': str(i)}],
+                                   on_chunk=buffer.push, on_done=lambda error, b=buffer: b.close(error=error))
+                buffers.append(buffer)
+            while not all(b.is_finished() for b in buffers):
+                for b in buffers:
+                    b.drain()
+                time.sleep(0.005)
+        finally:
+            client.close()
+        wall = (time.monotonic() - started) * 1000
+        first_tokens = [(b.first_token_at - started) * 1000 for b in buffers if b.first_token_at]
+        return {
+            'wall_ms': wall, 'first_token_ms_p50': percentile(first_tokens, 50),
+            'first_token_ms_p99': percentile(first_tokens, 99), 'errors': sum(1 for b in buffers if b.error),
+        }
+
+    def proxy_fairness(self):
+        """
+        End to end through the proxy on a loopback port: one client floods it with twelve
+        requests, a second sends two just after. The second should not wait for the flood.
+        """
+        global ollama
+        ollama = BenchmarkMock(reply_tokens=40)
+        engine = ChatEngine()
+        proxy = ProxyServer(engine, port=0, scheduler=FairScheduler(max_concurrent=2, per_client=2), use_cache=False).start()
+        first_tokens = {'heavy': [], 'light': []}
+        errors = []
+
+        def send(client_id, i):
+            client = OllamaProxyClient(proxy.url, client_id=client_id)
+            started = time.monotonic()
+            try:
+                for n, _ in enumerate(client.chat('bench-fast', [{'role': 'user', 'content': f'{client_id} {i}'}], stream=True)):
+                    if n == 0:
+                        first_tokens[client_id].append((time.monotonic() - started) * 1000)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=send, args=('heavy', i)) for i in range(12)]
+        started = time.monotonic()
+        try:
+            for thread in threads:
+                thread.start()
+            time.sleep(0.05)
+            light = [threading.Thread(target=send, args=('light', i)) for i in range(2)]
+            for thread in light:
+                thread.start()
+            for thread in threads + light:
+                thread.join(60)
+            stats = proxy.stats()
+        finally:
+            proxy.close()
+            engine.close()
+        return {
+            'wall_ms': (time.monotonic() - started) * 1000,
+            'light_first_token_ms_p99': percentile(first_tokens['light'], 99),
+            'heavy_first_token_ms_p99': percentile(first_tokens['heavy'], 99),
+            'queue_wait_ms_p99': stats['queue_wait_ms_p99'], 'errors': len(errors) + stats['errors'],
+        }
+
+    def proxy_warmup(self):
+        """
+        Warm-ups through the proxy: three clients load the same model at once, then one asks for
+        a model the server does not have. Every concurrent client must be answered only after
+        the model has loaded, and the failed load must come back as an HTTP 502 error.
+        """
+        global ollama
+        ollama = BenchmarkMock(load_seconds=0.2)
+        engine = ChatEngine()
+        proxy = ProxyServer(engine, port=0, use_cache=False).start()
+        durations, errors = [], []
+
+        def warm(client_id):
+            started = time.monotonic()
+            try:
+                OllamaProxyClient(proxy.url, client_id=client_id).chat('bench-slow', [])
+            except Exception as e:
+                errors.append(e)
+            durations.append((time.monotonic() - started) * 1000)
+
+        try:
+            threads = [threading.Thread(target=warm, args=(f'client-{i}',)) for i in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(30)
+            started = time.monotonic()
+            try:
+                OllamaProxyClient(proxy.url, client_id='missing').chat('bench-missing', [])
+                failure = None
+            except ConnectionError as e:
+                failure = str(e)
+            failed_ms = (time.monotonic() - started) * 1000
+            stats = proxy.stats()
+        finally:
+            proxy.close()
+            engine.close()
+        if errors:
+            raise RuntimeError(f"proxy warm-up failed: {errors[0]!r}")
+        if min(durations) < ollama.load_seconds * 1000 * 0.9:
+            raise RuntimeError("proxy answered a warm-up before the model had loaded")
+        if failure is None or not failure.startswith("Proxy answered 502") or stats['errors'] != 1:
+            raise RuntimeError(f"failed warm-up was not reported as an upstream error: {failure!r}")
+        return {'warmup_ms_max': max(durations), 'failed_warmup_ms': failed_ms}
+
+    # --- UI scenarios (need a display) ---
+    def ui_scenarios(self):
+        try:
+            root = tk.Tk()
+        except tk.TclError as e:
+            raise _SkipScenario(f"no display: {e}")
+        app = OllamaChatApp(root)
+        try:
+            self._wait(root, lambda: app.user_input['state'] == 'normal')
+            results = {}
+            for name, scenario in (
+                ('ui_rapid_sends', self.ui_rapid_sends), ('ui_long_history', self.ui_long_history),
+                ('ui_theme_toggle', self.ui_theme_toggle), ('ui_code_block_pool', self.ui_code_block_pool),
+            ):
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                metrics = scenario(root, app)
+                current, peak = tracemalloc.get_traced_memory()
+                metrics['memory_growth_kb'] = (current - before) / 1024
+                metrics['memory_peak_kb'] = (peak - before) / 1024
+                results[name] = metrics
+            return results
+        finally:
+            app.library.close()
+            app.client.close()
+            root.destroy()
+
+    @staticmethod
+    def _wait(root, condition, timeout=60.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            root.update()
+            time.sleep(0.001)
+
+    @staticmethod
+    def _probe_event_loop(root, lags):
+        """Measures how late a 10 ms timer fires: a proxy for the Tk event-queue backlog."""
+        scheduled = time.monotonic()
+
+        def fired():
+            lags.append(max(0.0, (time.monotonic() - scheduled) * 1000 - 10))
+            BenchmarkSuite._probe_event_loop(root, lags)
+        return root.after(10, fired)
+
+    def ui_rapid_sends(self, root, app):
+        """Ten prompts sent one after another through the real send path."""
+        lags, totals = [], []
+        probe = [self._probe_event_loop(root, lags)]
+        for i in range(10):
+            app.user_input.insert('1.0', f"Benchmark prompt {i}")
+            started = time.monotonic()
+            app.send_message()
+            self._wait(root, lambda: app.stream_buffer is None)
+            totals.append((time.monotonic() - started) * 1000)
+        root.after_cancel(probe[0])
+        records = list(app.telemetry.turns)[-10:]
+        return {
+            'turn_ms_p50': percentile(totals, 50), 'turn_ms_p99': percentile(totals, 99),
+            'event_loop_lag_ms_p99': percentile(lags, 99),
+            'first_token_ms_p50': percentile([r['first_token_ms'] for r in records if r['first_token_ms']], 50),
+            'frame_render_ms_max': max(r['render_max_ms'] for r in records),
+        }
+
+    def ui_long_history(self, root, app):
+        """Loads a 600-message conversation and redraws it."""
+        mock = BenchmarkMock(reply_tokens=150)
+        app.messages = MessageStore(app.messages[:1])
+        for i in range(300):
+            app.messages.append({'role': 'user', 'content': f"Question {i}"})
+            app.messages.append({'role': 'assistant', 'content': ''.join(mock._reply_tokens())})
+        started = time.perf_counter()
+        app.redraw_history()
+        root.update()
+        return {'redraw_ms': (time.perf_counter() - started) * 1000}
+
+    def ui_theme_toggle(self, root, app):
+        """Twenty theme switches with the long conversation on screen."""
+        times = []
+        for _ in range(20):
+            started = time.perf_counter()
+            app.toggle_theme()
+            root.update()
+            times.append((time.perf_counter() - started) * 1000)
+        return {'toggle_ms_p50': percentile(times, 50), 'toggle_ms_max': max(times)}
+
+    def ui_code_block_pool(self, root, app):
+        """Releases code blocks, takes them again and waits for highlighting: the pool must recycle widgets."""
+        pool = app.code_block_pool
+        colors = COLOR_SCHEMES[app.current_theme.get()]
+        errors = []
+        saved_handler = root.report_callback_exception
+        root.report_callback_exception = lambda *exc: errors.append(exc[1])  # Errors in after() callbacks
+        try:
+            started = time.perf_counter()
+            for round_ in range(3):
+                blocks = [pool.acquire('python', colors) for _ in range(8)]
+                for n, block in enumerate(blocks):
+                    # Distinct code each round so highlighting goes through the worker and the poll
+                    block.append(f"def f_{round_}_{n}(x):\n    return x * {n}\n")
+                    block.finish()
+                    pool.highlight(block)
+                self._wait(root, lambda: pool._poll_job is None)
+                if round_ == 0:
+                    created = pool.created  # Later rounds must be served from the idle list
+                for block in blocks:
+                    pool.release(block)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+        finally:
+            root.report_callback_exception = saved_handler
+        if errors:
+            raise RuntimeError(f"code block highlighting failed: {errors[0]!r}")
+        if pool.created != created:
+            raise RuntimeError("released code blocks were not reused")
+        return {'cycle_ms': elapsed_ms, 'idle_blocks': len(pool._idle)}
+
+    # --- Baselines ---
+    def compare(self):
+        """Returns a list of (scenario, metric, baseline, value) that regressed."""
+        try:
+            with open(self.baseline_path, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        regressions = []
+        for scenario, metrics in self.results.items():
+            for metric, value in metrics.items():
+                reference = baseline.get(scenario, {}).get(metric)
+                if reference is None or value is None:
+                    continue
+                if metric in self.HIGHER_IS_BETTER:
+                    worse = reference - value > max(reference * BENCHMARK_TOLERANCE, BENCHMARK_MIN_DELTA)
+                else:
+                    worse = value - reference > max(reference * BENCHMARK_TOLERANCE, BENCHMARK_MIN_DELTA)
+                if worse:
+                    regressions.append((scenario, metric, reference, value))
+        return regressions
+
+    def save_baseline(self):
+        with open(self.baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(self.results, f, indent=2)
+
+    def report(self):
+        lines = []
+        for scenario, metrics in self.results.items():
+            lines.append(scenario)
+            for metric, value in metrics.items():
+                lines.append(f"  {metric:<26} {'-' if value is None else f'{value:.2f}'}")
+        return '\n'.join(lines)
+
+
+class _SkipScenario(Exception):
+    pass
+
+
+def run_benchmarks(baseline_path=BENCHMARK_BASELINE_FILE, update_baseline=False):
+    """Runs the benchmark suite. Returns a process exit code (1 if anything regressed)."""
+    suite = BenchmarkSuite(baseline_path)
+    suite.run()
+    print(suite.report())
+    if update_baseline:
+        suite.save_baseline()
+        print(f"Baseline written to {suite.baseline_path}.")
+        return 0
+    regressions = suite.compare()
+    if regressions is None:
+        print(f"No baseline at {suite.baseline_path}; run with --update-baseline to create one.")
+        return 0
+    for scenario, metric, reference, value in regressions:
+        print(f"REGRESSION {scenario}.{metric}: {value:.2f} (baseline {reference:.2f})")
+    if not regressions:
+        print("No regressions against the baseline.")
+    return 1 if regressions else 0
+# --- End Benchmark Harness ---
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ollama Local Chat")
+    parser.add_argument('--benchmark', action='store_true', help="run the performance benchmarks headlessly and exit")
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE_FILE, help="baseline file for --benchmark")
+    parser.add_argument('--update-baseline', action='store_true', help="store this --benchmark run as the new baseline")
+    parser.add_argument('--batch', metavar='PROMPTS', help="answer a JSONL file of prompts headlessly and exit")
+    parser.add_argument('--model', default=DEFAULT_MODEL, help="model for --batch prompts that do not name one")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help="prompts streamed at once in --batch")
+    parser.add_argument('--results', help="JSONL results file for --batch (default: PROMPTS.results.jsonl)")
+    parser.add_argument('--output-dir', help="stream each --batch reply into DIR/<id>.md instead of stdout")
+    parser.add_argument('--resume', action='store_true', help="skip prompts already answered in the results file")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the response cache in --batch or --serve")
+    parser.add_argument('--mock', action='store_true', help="answer --batch or --serve requests with the built-in mock model")
+    parser.add_argument('--serve', action='store_true', help="run the shared OpenAI-compatible proxy instead of the GUI")
+    parser.add_argument('--host', default=PROXY_HOST, help="address --serve listens on")
+    parser.add_argument('--port', type=int, default=PROXY_PORT, help="port --serve listens on")
+    parser.add_argument('--proxy', metavar='URL', help="run the GUI as a thin client of a --serve proxy at URL")
+    parser.add_argument('--client-id', help="name this GUI reports to the proxy (default: its address)")
+    parser.add_argument('--archive', nargs=2, metavar=('JSON', 'ARCHIVE'), help="compress a JSON chat history into an archive and exit")
+    parser.add_argument('--unarchive', nargs=2, metavar=('ARCHIVE', 'JSON'), help="write an archive back out as JSON history and exit")
+    args = parser.parse_args()
+    if args.benchmark:
+        sys.exit(run_benchmarks(args.baseline, args.update_baseline))
+    if args.batch:
+        sys.exit(run_batch(args))
+    if args.serve:
+        sys.exit(run_server(args))
+    if args.archive or args.unarchive:
+        sys.exit(run_archive(args))
+    if args.proxy:
+        # Thin client: every model call (and the health check) goes through the proxy
+        ollama = _ollama_module = OllamaProxyClient(args.proxy, client_id=args.client_id)
+
     root = tk.Tk()
     app = OllamaChatApp(root)
     
     # Save history on close
     def on_closing():
         app.save_history()
+        app.persistence.close()
+        app.library.close()
+        app.engine.close()
         root.destroy()
         
     # User memory: The user has a working constraint related to the laptop lid.